@@ -1,14 +1,14 @@
 from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, Form, status, Request, BackgroundTasks
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import pandas as pd
-import fitz  # PyMuPDF
+import numpy as np
 import re
 import os
-import zipfile
 import datetime
 import shutil
 import secrets
@@ -17,11 +17,29 @@ import jwt
 from datetime import timedelta
 from passlib.context import CryptContext
 import concurrent.futures
+import collections
+import csv
+import multiprocessing
+import socket
+import tempfile
+import zipfile
+import logging
 import smtplib
 import os
 from email.message import EmailMessage
-import queue
 import threading
+import time
+import weakref
+import metrics
+from archive import ParallelZipWriter, ShardedZipWriter
+from pdf_template import DEFAULT_LAYOUT, CompiledTemplate, LetterBook, Section, TextLayout, get_save_profile, load_template, render_letter, section_key
+from jobs import JobProgress, JobStore
+from mail_delivery import DeliveryResult, SMTPDeliveryEngine
+from render_cache import RenderCache
+from run_journal import RunJournal, error_report_csv, file_digest, run_key
+from structured_logging import configure_logging
+from work_queue import WorkQueue
+from workbook_reader import HEADER_ROW, WorkbookReader
 
 # Initialize FastAPI app
 app = FastAPI(title="PDF Document Processor", description="API for processing employee documents")
@@ -43,11 +61,115 @@ UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "output"
 TEMPLATES_DIR = "templates"
 STATIC_DIR = "static"
+
+# "overlay" stamps text onto a pre-redacted template, "redact" rewrites the page per placeholder
+RENDER_MODE = "overlay"
+
+# How letters are saved, one of pdf_template.SAVE_PROFILES: "compact" drops the dead
+# objects and duplicate fonts redaction leaves behind and compresses the rest;
+# "fast" skips that work and writes larger files
+SAVE_PROFILE = "compact"
+
+# Number of processes used to render letters; 1 renders in the calling process
+RENDER_WORKERS = os.cpu_count() or 1
+
+# Keep rendered letters in memory (ZIP via writestr, emails from the same bytes) instead of temp_pdfs
+IN_MEMORY_PDFS = True
+
+# Rows read from the workbook per chunk; memory use does not grow with the sheet size
+READ_CHUNK_SIZE = 1000
+
+# Stream the ZIP to the client while letters are rendered instead of building it on disk first
+STREAM_DOWNLOADS = True
+
+# "zip" puts one PDF per employee into an archive and emails each letter;
+# "merged_pdf" writes every letter into one print-ready PDF, ordered by
+# MERGED_SORT_COLUMN (a workbook column), and sends nothing
+OUTPUT_MODES = ("zip", "merged_pdf")
+MERGED_SORT_COLUMN = "Emp ID"
+
+# ZIP entry compression: "stored", "deflate" or "deflate:<level>". The letters are
+# already-compressed PDFs, so deflate buys little; when used, entries are
+# compressed on ARCHIVE_WORKERS threads alongside rendering.
+ARCHIVE_COMPRESSION = "stored"
+ARCHIVE_WORKERS = 4
+
+# Split the output of merge_employee_data_and_zip into several archives: at most
+# SHARD_MAX_BYTES (uncompressed) or SHARD_MAX_ENTRIES letters each, and/or one set
+# of archives per value of the SHARD_BY column. None everywhere writes a single ZIP.
+SHARD_MAX_BYTES = None
+SHARD_MAX_ENTRIES = None
+SHARD_BY = None
+SHARD_INDEX_FIELDS = ("shard", "file", "row", "emp_id", "name")
+
+# Letters already rendered for the same template and replacements are reused from disk,
+# so re-uploading a corrected workbook only renders the rows that changed
+RENDER_CACHE_ENABLED = True
+RENDER_CACHE_DIR = os.path.join(OUTPUT_DIR, "render_cache")
+RENDER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Journal every row's render and email state; a failed or interrupted run of the same
+# workbook and template picks up where it stopped and never re-sends a delivered email.
+# The letters of a journaled run are kept in RUN_LETTERS_DIR/<run id> until it is done,
+# so a resumed run takes the rows the journal lists as rendered from there instead of
+# rendering them again, whether or not the render cache still has them.
+RESUME_RUNS = True
+RUN_JOURNAL_DB = os.path.join(OUTPUT_DIR, "runs.sqlite3")
+RUN_LETTERS_DIR = os.path.join(OUTPUT_DIR, "run_letters")
+
+# Work-queue mode of merge_employee_data_and_zip: the workbook is split into tasks of
+# QUEUE_TASK_ROWS rows in the SQLite queue at WORK_QUEUE_DB. QUEUE_WORKERS local
+# processes, plus any started with `batch.py work`, lease and render them; a task
+# whose worker dies is handed out again, up to QUEUE_MAX_ATTEMPTS times. Workers on
+# other hosts need the queue file on a local disk they share: SQLite's locking is
+# not reliable over network filesystems (NFS, SMB), so do not put it on one.
+WORK_QUEUE_DB = os.path.join(OUTPUT_DIR, "work_queue.sqlite3")
+QUEUE_TASK_ROWS = 500
+QUEUE_WORKERS = os.cpu_count() or 1
+QUEUE_LEASE_SECONDS = 300
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_POLL_SECONDS = 1.0
+EMAIL_MANIFEST_FIELDS = ("row", "emp_id", "name", "email", "file")
+
+# Outgoing mail: letters are sent concurrently over SMTP_CONNECTIONS reused connections
+SMTP_HOST = "smtp.office365.com"
+SMTP_PORT = 587
+SMTP_SENDER = "hrd@algoworks.com"
+SMTP_USERNAME = "hrd@algoworks.com"
+SMTP_PASSWORD = "netscape@1"
+SMTP_CONNECTIONS = 4
+# Trace the SMTP dialogue (smtplib writes it to stderr); only for debugging delivery problems
+SMTP_DEBUG = False
+
+# Log records go through a queue to a background writer thread, one JSON object per line
+LOG_LEVEL = "INFO"
+LOG_JSON = True
+
+# Run uploads as background jobs: /upload returns a job ID and /jobs/{id} reports progress.
+# Takes precedence over STREAM_DOWNLOADS.
+ASYNC_JOBS = True
+JOB_WORKERS = 2
+JOBS_DB = os.path.join(OUTPUT_DIR, "jobs.sqlite3")
+
+# Uploaded workbooks are copied to UPLOAD_DIR this many bytes at a time, and
+# refused once they grow past MAX_UPLOAD_BYTES
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(TEMPLATES_DIR, exist_ok=True)
 os.makedirs(STATIC_DIR, exist_ok=True)
 
+logger = logging.getLogger(__name__)
+
+def start_logging():
+    """Startup handler: route the server's logs through the queued writer.
+
+    Not done at import, so batch.py, benchmarks and worker processes that
+    import this module keep their own logging setup.
+    """
+    configure_logging(LOG_LEVEL, LOG_JSON)
+
 # Create HTML templates
 login_html = """
 <!DOCTYPE html>
@@ -232,6 +354,43 @@ upload_html = """
             </div>
             <button type="submit">Process Documents</button>
         </form>
+
+        {% if async_jobs %}
+        <div id="job-status" class="success-message"></div>
+        <script>
+            document.querySelector("form[action='/upload']").addEventListener("submit", async function (event) {
+                event.preventDefault();
+                const statusBox = document.getElementById("job-status");
+                statusBox.className = "success-message";
+                statusBox.textContent = "Uploading...";
+
+                const response = await fetch("/upload", {method: "POST", body: new FormData(event.target)});
+                if (response.status !== 202) {
+                    // Validation errors come back as the regular page
+                    document.open();
+                    document.write(await response.text());
+                    document.close();
+                    return;
+                }
+
+                const job = await response.json();
+                const poll = async function () {
+                    const state = await (await fetch(job.status_url)).json();
+                    statusBox.textContent = `Status: ${state.status} - ${state.rows_done} of ${state.rows_total} letters, ` +
+                        `${state.emails_sent} emails sent, ${state.emails_failed} failed`;
+                    if (state.status === "done") {
+                        window.location = job.download_url;
+                    } else if (state.status === "failed" || state.status === "interrupted") {
+                        statusBox.className = "error-message";
+                        statusBox.textContent = `Error processing files: ${state.error}`;
+                    } else {
+                        setTimeout(poll, 2000);
+                    }
+                };
+                poll();
+            });
+        </script>
+        {% endif %}
     </div>
 </body>
 </html>
@@ -318,10 +477,27 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
     return current_user
 
 # PDF processing functions
-def replace_text_in_pdf(pdf_path, replacements, output_pdf, texts_to_remove, dynamic_column_value, bonus_column_value, bonus_column_value2):
-    """Replace placeholders in a PDF by redacting old text and inserting new text at the exact position."""
-    doc = fitz.open(pdf_path)
+def replace_text_in_pdf(pdf_path, replacements, output_pdf, texts_to_remove, dynamic_column_value, bonus_column_value, bonus_column_value2, render_mode="redact", layout=None, profile=None):
+    """Replace placeholders in a PDF by redacting old text and inserting new text at the exact position.
+
+    layout and profile default to TEXT_LAYOUT and SAVE_PROFILE.
+    """
+    # Accept either a template path or an already compiled template
+    if isinstance(pdf_path, CompiledTemplate):
+        template = pdf_path
+    else:
+        template = load_template(pdf_path, TEMPLATE_SEARCH_KEYS, CONDITIONAL_SECTIONS)
 
+    all_replacements = letter_replacements(replacements, texts_to_remove, dynamic_column_value, bonus_column_value, bonus_column_value2)
+
+    # Returns the PDF bytes when output_pdf is None, otherwise the output path
+    return render_letter(
+        template, all_replacements, output_pdf, mode=render_mode,
+        layout=TEXT_LAYOUT if layout is None else layout, profile=profile or SAVE_PROFILE
+    )
+
+def letter_replacements(replacements, texts_to_remove, dynamic_column_value, bonus_column_value, bonus_column_value2):
+    """Apply the SDR/comments and bonus rules to replacements and return everything the letter is rendered with."""
     # Handle special replacements based on dynamic_column_value
     if dynamic_column_value == 'sdr':
         replacements['[-]'] = '=>'
@@ -336,58 +512,20 @@ def replace_text_in_pdf(pdf_path, replacements, output_pdf, texts_to_remove, dyn
         replacements['[--]'] = ''
         replacements['[-]'] = ''
 
+    # Sections the row leaves out are blanked (or renumbered) at their anchor rects
+    for section in CONDITIONAL_SECTIONS:
+        if not section.rule(replacements, bonus_column_value, bonus_column_value2):
+            replacements[section_key(section)] = section.otherwise
+
     # Handle bonus values
-    if bonus_column_value is None or replacements.get('[Bonus in INR]', '') == '':
+    if not _has_bonus(replacements, bonus_column_value, bonus_column_value2):
         replacements['[Bonus in INR]'] = ''
-        replacements['II'] = 'I'
-        replacements['I.'] = ''
-        replacements['Your 2024 Bonus is'] = ''
 
-    if bonus_column_value2 is None or replacements.get('[Target in INR]', '') == '':
-        replacements['=> Bonus (at Target)3'] = ''
+    if not _has_target_bonus(replacements, bonus_column_value, bonus_column_value2):
         replacements['[Target in INR]'] = ''
 
     # Combine replacements with texts_to_remove
-    all_replacements = {**replacements, **texts_to_remove}
-
-    for page in doc:
-        for key, value in all_replacements.items():
-            text_instances = page.search_for(key)
-
-            for inst in text_instances:
-                # First redact the original text
-                page.add_redact_annot(inst, text="", fill=(1, 1, 1))
-                page.apply_redactions()
-
-                # Then insert the new text with specified font properties
-                if value:
-                    baseline_x = inst.x0
-                    baseline_y = inst.y1 - 4  # Default offset
-
-                    # Adjust baseline for Employee Type
-                    if key == "[Employee Type]":
-                        baseline_y = inst.y1 - 2
-
-                    # Special handling for 'II' replacement
-                    if key == 'II.':
-                        page.insert_text(
-                            point=(baseline_x, baseline_y - 2),
-                            text=value,
-                            fontsize=11,
-                            fontname="helv-b",  # Bold Helvetica
-                            color=(0, 0, 0)
-                        )
-                    else:
-                        page.insert_text(
-                            point=(baseline_x, baseline_y),
-                            text=value,
-                            fontsize=10,
-                            fontname="helv",  # Regular Helvetica
-                            color=(0, 0, 0)
-                        )
-
-    doc.save(output_pdf)
-    doc.close()
+    return {**replacements, **texts_to_remove}
 
 def format_indian_currency(value):
     """Format a numeric value in Indian currency style with INR prefix."""
@@ -435,159 +573,258 @@ def format_indian_currency(value):
     except (ValueError, TypeError, IndexError, AttributeError):
         return ""
 
-def process_record(row_dict, pdf_template, docs_folder, current_date, placeholder_mapping):
-    """Helper function to process a single record with Indian currency formatting."""
-    replacements = {'[Date]': current_date}
-
-    # Get SDR and Comments values
-    sdr_value = str(row_dict.get('For SDR only', '')).strip()
-    comments_value = str(row_dict.get('Comments (Optional)', '')).strip()
-
-    # Handle bonus values safely
-    bonus_value = str(row_dict.get('2024 Bonus', '')).strip()
-    bonus_value_2 = str(row_dict.get('Bonus 2025 (At Target)', '')).strip()
-
-    # Initialize values
-    texts_to_remove = {}
-    dynamic_column_value = 'both'
-    bonus_column_value = 'fill'
-    bonus_column_value2 = 'fill'
-
-    # Handle SDR and Comments logic
-    if sdr_value.lower() not in ['nan', '', 'na', 'n/a'] and not pd.isna(row_dict.get('For SDR only')):
-        dynamic_column_value = 'sdr'
-        texts_to_remove = {
-            "[For SDRs only]": str(sdr_value),
-            "[Any other employee-specific details that need to be covered in Appraisal Letter]": ""
-        }
-    elif comments_value.lower() not in ['nan', '', 'na', 'n/a'] and not pd.isna(row_dict.get('Comments (Optional)')):
-        dynamic_column_value = 'comments'
-        texts_to_remove = {
-            "[Any other employee-specific details that need to be covered in Appraisal Letter]": str(comments_value)
-        }
-    else:
-        dynamic_column_value = 'none'
-        texts_to_remove = {
-            "[Any other employee-specific details that need to be covered in Appraisal Letter]": ""
-        }
-
-    # Handle bonus values
-    if bonus_value.lower() in ['nan', '', 'na', 'n/a'] or pd.isna(row_dict.get('2024 Bonus')):
-        bonus_column_value = None
+# Columns rendered with format_indian_currency
+CURRENCY_COLUMNS = [
+    '2024 Bonus', 'Basic Salary', 'HRA', 'Other Allowences',
+    'Provident Fund', 'Company Deposit', 'Total Fixed',
+    'Bonus 2025 (At Target)', 'Total CTC'
+]
 
-    if bonus_value_2.lower() in ['nan', '', 'na', 'n/a'] or pd.isna(row_dict.get('Bonus 2025 (At Target)')):
-        bonus_column_value2 = None
+# Inserts the Indian digit-group commas (12,34,567) into a plain "1234567.00" amount
+INDIAN_GROUPING_PATTERN = r'(\d)(?=(?:\d\d)*\d{3}(?!\d))'
 
-    # Process all replacements
+def _parse_amount(text):
+    try:
+        return float(text)
+    except (ValueError, TypeError):
+        return np.nan
+
+def format_indian_currency_column(values):
+    """Vectorized format_indian_currency over a whole column, returning a Series of strings.
+
+    Produces exactly what format_indian_currency returns for each value.
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        numeric = values.astype(float).to_numpy()
+    else:
+        # Same blank rules and str -> float conversion as the scalar version
+        text = values.astype(str).str.strip()
+        blank = values.isna() | text.str.lower().isin(['nan', '', 'na', 'n/a'])
+        numeric = text.str.replace(',', '', regex=False).where(~blank).map(_parse_amount).to_numpy(dtype=float)
+
+    formatted = np.full(len(values), "", dtype=object)
+    finite = np.isfinite(numeric)
+    formatted[finite & (numeric == 0)] = "INR 0.00"
+
+    positive = finite & (numeric > 0)
+    if positive.any():
+        amounts = pd.Series(np.char.mod('%.2f', numeric[positive]))
+        formatted[positive] = ("INR " + amounts.str.replace(INDIAN_GROUPING_PATTERN, r'\1,', regex=True)).to_numpy()
+
+    # Negative amounts are rare and have quirky grouping; let the scalar version handle them
+    for position in np.flatnonzero(finite & (numeric < 0)):
+        formatted[position] = format_indian_currency(values.iloc[position])
+
+    return pd.Series(formatted, index=values.index, dtype=object)
+
+def format_currency_columns(df):
+    """Return a copy of df with every currency column replaced by its ready-to-insert string."""
+    formatted_df = df.copy()
+    for column in CURRENCY_COLUMNS:
+        if column in df.columns:
+            formatted_df[column] = format_indian_currency_column(df[column])
+        else:
+            formatted_df[column] = ""
+    return formatted_df
+
+# Cell values treated as empty throughout the sheet
+BLANK_VALUES = ['nan', '', 'na', 'n/a']
+
+SDR_PLACEHOLDER = "[For SDRs only]"
+DETAILS_PLACEHOLDER = "[Any other employee-specific details that need to be covered in Appraisal Letter]"
+
+# A row ready to render, with every per-row decision already made. index is its
+# position among the sheet's rows, row its sheet row number as Excel shows it
+# (blank rows are skipped by index but counted by row); reports give row.
+PreparedRecord = collections.namedtuple("PreparedRecord", [
+    "index", "replacements", "texts_to_remove", "dynamic_column_value",
+    "bonus_column_value", "bonus_column_value2", "file_name", "email", "name", "emp_id", "row"
+])
+
+def _text_column(df, column, default=''):
+    """Return column as str(value) per cell, or default for every row if it is missing."""
+    if column not in df.columns:
+        return pd.Series(default, index=df.index, dtype=object)
+    return df[column].map(str)
+
+def _blank_mask(df, column):
+    """True where the cell is missing, NaN or one of BLANK_VALUES."""
+    if column not in df.columns:
+        return pd.Series(True, index=df.index)
+    return df[column].isna() | _text_column(df, column).str.strip().str.lower().isin(BLANK_VALUES)
+
+def _safe_file_part(values):
+    return values.str.replace(r'[^\w\s-]', '', regex=True).str.strip().str.replace(' ', '_', regex=False)
+
+def prepare_records(df, current_date, placeholder_mapping, start=0):
+    """Work out every row's replacements, conditional flags and file name column by column.
+
+    Yields PreparedRecord tuples in sheet order; start offsets their index
+    when df is one chunk of a larger sheet. df's index is taken as the rows'
+    sheet row numbers, as WorkbookReader chunks carry them.
+    """
+    formatted = format_currency_columns(df)
+
+    # Placeholder values, one column at a time
+    placeholder_columns = {}
     for pdf_placeholder, excel_col in placeholder_mapping.items():
-        value = row_dict.get(excel_col, "N/A")
-
-        # Special handling for currency columns
-        currency_columns = [
-            '2024 Bonus', 'Basic Salary', 'HRA', 'Other Allowences',
-            'Provident Fund', 'Company Deposit', 'Total Fixed',
-            'Bonus 2025 (At Target)', 'Total CTC'
-        ]
-
-        if excel_col in currency_columns:
-            formatted_value = format_indian_currency(value)
-            replacements[pdf_placeholder] = formatted_value
+        if excel_col in CURRENCY_COLUMNS:
+            placeholder_columns[pdf_placeholder] = formatted[excel_col]
+        elif excel_col in df.columns:
+            text = _text_column(df, excel_col)
+            placeholder_columns[pdf_placeholder] = text.where(df[excel_col].notna() & (text.str.strip() != ""), "")
         else:
-            if pd.notna(value) and str(value).strip() != "":
-                replacements[pdf_placeholder] = str(value)
-            else:
-                replacements[pdf_placeholder] = ""
-
-    # Generate output file name
-    emp_id = str(row_dict.get('Emp ID', ''))
-    safe_emp_id = re.sub(r'[^\w\s-]', '', emp_id).strip().replace(' ', '_')
-    emp_name = str(row_dict.get('Name', ''))
-    safe_emp_name = re.sub(r'[^\w\s-]', '', emp_name).strip().replace(' ', '_')
-    file_name = safe_emp_id + "_" + safe_emp_name
-    pdf_output_path = os.path.join(docs_folder, f"{file_name}.pdf")
-
-    replace_text_in_pdf(pdf_template, replacements, pdf_output_path, texts_to_remove, dynamic_column_value, bonus_column_value, bonus_column_value2)
-    return pdf_output_path, f"{file_name}.pdf"
-
-def send_office365_email(recipient_email, pdf_path, emp_name):
-    """Worker function to send a single email"""
-    print(f"\nAttempting to send email to {recipient_email}")
-    try:
-        msg = EmailMessage()
-        msg["From"] = "hrd@algoworks.com"
-        msg["To"] = recipient_email
-        msg["Subject"] = "Appraisal Letter"
-        msg.set_content(f"Dear {emp_name},\nPlease find attachment for your appraisal letter.")
-
-        # Attach PDF
-        print(f"Attaching PDF: {pdf_path}")
+            placeholder_columns[pdf_placeholder] = pd.Series("N/A", index=df.index, dtype=object)
+
+    # SDR text wins over comments; without either the details placeholder is cleared
+    sdr_present = ~_blank_mask(df, 'For SDR only')
+    comments_present = ~_blank_mask(df, 'Comments (Optional)')
+    dynamic_values = np.select([sdr_present, comments_present], ['sdr', 'comments'], 'none')
+    sdr_text = _text_column(df, 'For SDR only').str.strip()
+    comments_text = _text_column(df, 'Comments (Optional)').str.strip()
+
+    bonus_blank = _blank_mask(df, '2024 Bonus')
+    bonus_blank_2 = _blank_mask(df, 'Bonus 2025 (At Target)')
+
+    file_names = _safe_file_part(_text_column(df, 'Emp ID')) + "_" + _safe_file_part(_text_column(df, 'Name'))
+    emp_ids = _text_column(df, 'Emp ID')
+    names = _text_column(df, 'Name')
+    email_text = _text_column(df, 'Email Id').str.strip()
+    has_email = (email_text != "") & (df['Email Id'].notna() if 'Email Id' in df.columns else False)
+    emails = [email if ok else None for email, ok in zip(email_text.tolist(), has_email.tolist())]
+
+    placeholders = list(placeholder_columns)
+    placeholder_rows = zip(*(placeholder_columns[p].tolist() for p in placeholders))
+    columns = zip(
+        placeholder_rows, dynamic_values.tolist(), sdr_text.tolist(), comments_text.tolist(),
+        bonus_blank.tolist(), bonus_blank_2.tolist(), file_names.tolist(), emails,
+        names.tolist(), emp_ids.tolist(), df.index.tolist()
+    )
+    for position, (values, dynamic, sdr, comments, no_bonus, no_bonus_2, file_name, email, name, emp_id, row) in enumerate(columns):
+        replacements = {'[Date]': current_date}
+        replacements.update(zip(placeholders, values))
+
+        if dynamic == 'sdr':
+            texts_to_remove = {SDR_PLACEHOLDER: sdr, DETAILS_PLACEHOLDER: ""}
+        elif dynamic == 'comments':
+            texts_to_remove = {DETAILS_PLACEHOLDER: comments}
+        else:
+            texts_to_remove = {DETAILS_PLACEHOLDER: ""}
+
+        yield PreparedRecord(
+            start + position, replacements, texts_to_remove, dynamic,
+            None if no_bonus else 'fill', None if no_bonus_2 else 'fill',
+            file_name, email, name, emp_id, row
+        )
+
+def render_prepared_record(record, pdf_template, docs_folder, render_mode="redact", layout=None, profile=None):
+    """Render a PreparedRecord, returning (pdf, arcname) like process_record."""
+    # Without a docs_folder the letter stays in memory and its bytes are returned
+    pdf_output_path = os.path.join(docs_folder, f"{record.file_name}.pdf") if docs_folder else None
+
+    with metrics.ROW_SECONDS.time():
+        pdf = replace_text_in_pdf(
+            pdf_template,
+            dict(record.replacements),
+            pdf_output_path,
+            record.texts_to_remove,
+            record.dynamic_column_value,
+            record.bonus_column_value,
+            record.bonus_column_value2,
+            render_mode,
+            layout,
+            profile
+        )
+    return pdf, f"{record.file_name}.pdf"
+
+def process_record(row_dict, pdf_template, docs_folder, current_date, placeholder_mapping, render_mode="redact"):
+    """Helper function to process a single record with Indian currency formatting."""
+    record = next(prepare_records(pd.DataFrame([row_dict]), current_date, placeholder_mapping))
+    return render_prepared_record(record, pdf_template, docs_folder, render_mode)
+
+def build_appraisal_email(recipient_email, pdf_path, emp_name, pdf_data=None):
+    """Build the appraisal letter email with the PDF attached.
+
+    pdf_data is the letter already held in memory; pdf_path is then only used
+    as the attachment name.
+    """
+    msg = EmailMessage()
+    msg["From"] = SMTP_SENDER
+    msg["To"] = recipient_email
+    msg["Subject"] = "Appraisal Letter"
+    msg.set_content(f"Dear {emp_name},\nPlease find attachment for your appraisal letter.")
+
+    if pdf_data is None:
         with open(pdf_path, "rb") as f:
-            file_data = f.read()
-            file_name = os.path.basename(pdf_path)
-            msg.add_attachment(file_data, maintype="application", subtype="octet-stream", filename=file_name)
-
-        # Send Email with debug enabled
-        print("Connecting to SMTP server...")
-        with smtplib.SMTP("smtp.office365.com", 587) as server:
-            server.set_debuglevel(1)  # Enable debug output
-            print("Starting TLS...")
+            pdf_data = f.read()
+    file_name = os.path.basename(pdf_path)
+    msg.add_attachment(pdf_data, maintype="application", subtype="octet-stream", filename=file_name)
+    return msg
+
+def send_office365_email(recipient_email, pdf_path, emp_name, pdf_data=None):
+    """Send a single email over its own SMTP connection"""
+    try:
+        msg = build_appraisal_email(recipient_email, pdf_path, emp_name, pdf_data)
+
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
+            if SMTP_DEBUG:
+                server.set_debuglevel(1)
             server.starttls()
-            print("Logging in...")
-            server.login("hrd@algoworks.com", "netscape@1")
-            print("Sending message...")
+            server.login(SMTP_USERNAME, SMTP_PASSWORD)
             server.send_message(msg)
-            print(f"✓ SUCCESS: Email sent to {recipient_email}")
+            logger.info("Email sent", extra={"event": "email_sent", "recipient": recipient_email})
             return True
     except FileNotFoundError:
-        print(f"✗ ERROR: PDF file not found: {pdf_path}")
+        logger.error("PDF file not found", extra={"event": "email_failed", "recipient": recipient_email, "pdf": pdf_path})
         return False
     except smtplib.SMTPAuthenticationError:
-        print("✗ ERROR: SMTP Authentication failed. Check username and password.")
+        logger.error("SMTP authentication failed, check username and password", extra={"event": "email_failed", "recipient": recipient_email})
         return False
     except smtplib.SMTPException as e:
-        print(f"✗ ERROR: SMTP error occurred: {str(e)}")
+        logger.error("SMTP error: %s", e, extra={"event": "email_failed", "recipient": recipient_email})
         return False
     except Exception as e:
-        print(f"✗ ERROR: Failed to send email to {recipient_email}: {str(e)}")
+        logger.error("Failed to send email: %s", e, extra={"event": "email_failed", "recipient": recipient_email})
         return False
 
-def email_worker(email_queue):
-    """Worker function to process email queue"""
-    print("\nEmail worker started...")
-    emails_processed = 0
-    emails_succeeded = 0
-    emails_failed = 0
-
-    while True:
-        try:
-            email_data = email_queue.get(timeout=30)  # Wait up to 30 seconds for new items
-            if email_data is None:  # Sentinel value to stop worker
-                print("Received stop signal, finishing up...")
-                break
-
-            recipient_email, pdf_path, emp_name = email_data
-            emails_processed += 1
-            print(f"\nProcessing email {emails_processed}...")
-
-            if send_office365_email(recipient_email, pdf_path, emp_name):
-                emails_succeeded += 1
-            else:
-                emails_failed += 1
-
-            email_queue.task_done()
-
-        except queue.Empty:
-            print("Email queue empty, worker finishing...")
-            break
-        except Exception as e:
-            print(f"✗ ERROR in email worker: {str(e)}")
-            emails_failed += 1
-            email_queue.task_done()
+# Delivery engines of the runs in progress, for the email queue depth gauge
+_email_engines = weakref.WeakSet()
+
+def create_email_engine(progress=None):
+    """Start a pooled SMTP delivery engine that reports per-recipient results."""
+    counts = {"emails_sent": 0, "emails_failed": 0}
+    counts_lock = threading.Lock()
+
+    def on_result(result):
+        metrics.EMAILS_TOTAL.inc(outcome="sent" if result.ok else "failed")
+        with counts_lock:
+            counts["emails_sent" if result.ok else "emails_failed"] += 1
+            current = dict(counts)
+        if result.ok:
+            logger.debug("Email sent", extra={"event": "email_sent", "recipient": result.recipient})
+        else:
+            logger.warning("Failed to send email: %s", result.error, extra={"event": "email_failed", "recipient": result.recipient})
+        if progress:
+            progress(**current)
+
+    engine = SMTPDeliveryEngine(
+        SMTP_HOST,
+        SMTP_PORT,
+        SMTP_USERNAME,
+        SMTP_PASSWORD,
+        connections=SMTP_CONNECTIONS,
+        debug=SMTP_DEBUG,
+        on_result=on_result
+    )
+    _email_engines.add(engine)
+    return engine
 
-    print(f"\nEmail worker finished:")
-    print(f"Total emails processed: {emails_processed}")
-    print(f"Successful: {emails_succeeded}")
-    print(f"Failed: {emails_failed}")
+EMAIL_QUEUE_DEPTH = metrics.Gauge(
+    "appraisal_email_queue_depth",
+    "Emails handed to the SMTP delivery engine and not yet sent.",
+    lambda: sum(engine.pending for engine in list(_email_engines))
+)
 
 # Define the mapping between PDF placeholders and Excel columns
 placeholder_mapping = {
@@ -609,93 +846,1149 @@ placeholder_mapping = {
     '[Any other employee-specific details that need to be covered in Appraisal Letter]': 'Comments (Optional)'
 }
 
-def merge_employee_data_and_zip(excel_file_path, pdf_template, output_folder, zip_name=None):
-    """Main function to process Excel and create ZIP"""
-    print("\nStarting merge and zip process...")
-    os.makedirs(output_folder, exist_ok=True)
-    df = pd.read_excel(excel_file_path)
+# Conditional strings rewritten by replace_text_in_pdf depending on the row
+CONDITIONAL_TEXTS = ['[-]', '[--]']
+
+def _has_bonus(replacements, bonus_column_value, bonus_column_value2):
+    return bonus_column_value is not None and replacements.get('[Bonus in INR]', '') != ''
+
+def _has_target_bonus(replacements, bonus_column_value, bonus_column_value2):
+    return bonus_column_value2 is not None and replacements.get('[Target in INR]', '') != ''
+
+# Parts of the template kept only when their rule holds for the row; rules take
+# (replacements, bonus_column_value, bonus_column_value2). Without a 2024 bonus
+# its item is dropped and the next item is renumbered from II to I.
+CONDITIONAL_SECTIONS = [
+    Section("bonus_item_number", "I.", _has_bonus, occurrence=0),
+    Section("bonus_line", "Your 2024 Bonus is", _has_bonus),
+    Section("next_item_number", "II", _has_bonus, otherwise="I", occurrence=0),
+    Section("target_bonus_line", "=> Bonus (at Target)3", _has_target_bonus),
+]
+
+# Columns the workbook header is resolved against
+EXPECTED_COLUMNS = list(dict.fromkeys([*placeholder_mapping.values(), 'Email Id']))
+
+# Everything the template is scanned for once, up front
+TEMPLATE_SEARCH_KEYS = ['[Date]', *placeholder_mapping, *CONDITIONAL_TEXTS]
+
+# Opt-in layout: amounts end flush with their column and names and titles shrink
+# rather than run off the page. It moves every amount to the right of where the
+# default layout puts it, so set TEXT_LAYOUT to it only once the letters have been
+# checked. Set use_template_font to write with the template's font when it is embedded in full.
+ALIGNED_TEXT_LAYOUT = TextLayout(
+    right_align_keys=frozenset(key for key, column in placeholder_mapping.items() if column in CURRENCY_COLUMNS),
+    fit_keys=frozenset(['[Name]', '[Employee Title]', '[Employee Department]']),
+    use_template_font=False
+)
+
+# How replacement text is laid out; the default writes every value where its placeholder starts
+TEXT_LAYOUT = DEFAULT_LAYOUT
+
+# Render settings of a run, passed to the run functions as one argument. A field
+# left None takes its module setting: mode RENDER_MODE, profile SAVE_PROFILE,
+# layout TEXT_LAYOUT, use_cache RENDER_CACHE_ENABLED, compression
+# ARCHIVE_COMPRESSION, workers RENDER_WORKERS and in_memory IN_MEMORY_PDFS.
+RenderOptions = collections.namedtuple(
+    "RenderOptions", ["mode", "profile", "layout", "use_cache", "compression", "workers", "in_memory"],
+    defaults=(None,) * 7
+)
+
+def resolve_render_options(options=None):
+    """Return options (all unset by default) with every unset field taken from the module settings."""
+    defaults = RenderOptions(
+        RENDER_MODE, SAVE_PROFILE, TEXT_LAYOUT, RENDER_CACHE_ENABLED, ARCHIVE_COMPRESSION, RENDER_WORKERS, IN_MEMORY_PDFS
+    )
+    return RenderOptions(*(default if value is None else value for value, default in zip(options or RenderOptions(), defaults)))
 
-    if zip_name is None:
-        today = datetime.datetime.now().strftime("%Y%m%d")
-        zip_name = f"employee_documents_{today}.zip"
-    zip_path = os.path.join(output_folder, zip_name)
+# Compiled template of a render worker process, loaded once by _init_render_worker
+_worker_template = None
 
-    docs_folder = os.path.join(output_folder, "temp_pdfs")
-    os.makedirs(docs_folder, exist_ok=True)
+def _init_render_worker(template_data):
+    """Initializer for render worker processes: compile the template once per process."""
+    global _worker_template
+    # Timings taken in the worker travel back with each result
+    metrics.start_buffering()
+    _worker_template = CompiledTemplate(template_data, TEMPLATE_SEARCH_KEYS, CONDITIONAL_SECTIONS)
 
-    # Keep track of files to email
-    email_tasks = []
-    generated_pdfs = []
+def _render_record_task(task):
+    """Render one prepared record inside a worker process, reporting failures instead of raising.
 
+    Returns (result, error, metric samples recorded while rendering).
+    """
+    record, docs_folder, render_mode, layout, profile = task
     try:
-        # First, generate all PDFs and create ZIP
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for _, row in df.iterrows():
-                # Process single record
-                pdf_output_path, arcname = process_record(
-                    row.to_dict(),
-                    pdf_template,
-                    docs_folder,
-                    datetime.datetime.now().strftime("%B %d, %Y"),
-                    placeholder_mapping
-                )
+        return render_prepared_record(record, _worker_template, docs_folder, render_mode, layout, profile), None, metrics.drain()
+    except Exception as e:
+        return None, f"{type(e).__name__}: {str(e)}", metrics.drain()
+
+def record_cache_key(record, template, render_mode, layout=None, profile=None):
+    """Render cache key of a record: the template, the replacements its letter is finally rendered with and how.
+
+    layout and profile default to TEXT_LAYOUT and SAVE_PROFILE.
+    """
+    replacements = letter_replacements(
+        dict(record.replacements),
+        record.texts_to_remove,
+        record.dynamic_column_value,
+        record.bonus_column_value,
+        record.bonus_column_value2
+    )
+    return RenderCache.key(
+        template.digest, replacements, render_mode=render_mode, layout=TEXT_LAYOUT if layout is None else layout,
+        save_profile=get_save_profile(profile or SAVE_PROFILE),
+        sections=[(section.name, section.anchor, section.otherwise, section.occurrence) for section in CONDITIONAL_SECTIONS]
+    )
 
-                # Add to ZIP
-                zipf.write(pdf_output_path, arcname=arcname)
-                generated_pdfs.append(pdf_output_path)
-
-                # Store email task if Email Id exists
-                email = row.get('Email Id')
-                if pd.notna(email) and email.strip():
-                    email_tasks.append((email.strip(), pdf_output_path, row['Name']))
-
-        # Now that all PDFs are generated, start email process
-        if email_tasks:
-            # Create email queue and start worker thread
-            email_queue = queue.Queue()
-            print("\nStarting email worker thread...")
-            email_thread = threading.Thread(
-                target=email_worker,
-                args=(email_queue,),
-                daemon=True
+def _cached_result(record, data, docs_folder):
+    """Turn cached letter bytes into the (pdf, arcname) render_prepared_record would have returned."""
+    arcname = f"{record.file_name}.pdf"
+    if docs_folder is None:
+        return data, arcname
+    pdf_output_path = os.path.join(docs_folder, arcname)
+    with open(pdf_output_path, "wb") as f:
+        f.write(data)
+    return pdf_output_path, arcname
+
+def _store_rendered(cache, key, pdf):
+    """Add a freshly rendered letter (bytes or file path) to the cache; a cache failure never fails the row."""
+    try:
+        if not isinstance(pdf, bytes):
+            with open(pdf, "rb") as f:
+                pdf = f.read()
+        cache.put(key, pdf)
+    except OSError as e:
+        logger.warning("Could not store letter in the render cache: %s", e)
+
+def render_records(records, template, docs_folder, options, cache=None, previous=None):
+    """Render PreparedRecords and yield (record, result, error, cached) in input order.
+
+    options is a resolved RenderOptions; its mode, layout, profile and workers
+    are used. A failing row is reported through error instead of aborting the
+    batch. With more than one worker the rows are spread over a process pool.
+    With a RenderCache, letters found in it are returned without rendering
+    (cached is True) and new letters are added to it. previous, if given,
+    returns the bytes of a record's letter rendered by an earlier attempt of
+    the run, or None; such letters are returned as cached without a lookup.
+    """
+    def lookup(record):
+        data = previous(record) if previous is not None else None
+        if data is not None:
+            return None, data
+        if cache is None:
+            return None, None
+        key = record_cache_key(record, template, options.mode, options.layout, options.profile)
+        return key, cache.get(key)
+
+    workers = options.workers
+    if workers <= 1:
+        for record in records:
+            key, data = lookup(record)
+            if data is not None:
+                yield record, _cached_result(record, data, docs_folder), None, True
+                continue
+            try:
+                result = render_prepared_record(record, template, docs_folder, options.mode, options.layout, options.profile)
+            except Exception as e:
+                yield record, None, f"{type(e).__name__}: {str(e)}", False
+                continue
+            if key is not None:
+                _store_rendered(cache, key, result[0])
+            yield record, result, None, False
+        return
+
+    def finish(entry):
+        record, key, cached, future = entry
+        result, error, samples = future.result()
+        metrics.replay(samples)
+        if key is not None and not cached and error is None:
+            _store_rendered(cache, key, result[0])
+        return record, result, error, cached
+
+    # Keep a bounded window of rows in flight so large sheets are not queued up all at once
+    max_pending = workers * 4
+    pending = collections.deque()
+    # Spawned, not forked: the server process runs threads (jobs, SMTP, logging) a fork would copy mid-flight
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_render_worker,
+        initargs=(template.data,)
+    ) as executor:
+        for record in records:
+            key, data = lookup(record)
+            if data is not None:
+                # Cache hits wait their turn in the window so the output order is unchanged
+                future = concurrent.futures.Future()
+                future.set_result((_cached_result(record, data, docs_folder), None, []))
+            else:
+                future = executor.submit(_render_record_task, (record, docs_folder, options.mode, options.layout, options.profile))
+            pending.append((record, key, data is not None, future))
+            while len(pending) >= max_pending or (pending and pending[0][3].done()):
+                yield finish(pending.popleft())
+        while pending:
+            yield finish(pending.popleft())
+
+class ZipStreamBuffer:
+    """Write-only file object for the ZIP writer that hands written bytes to a streaming response."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def in_row_shard(index, row_shard):
+    """True if the row at index belongs to row_shard, a zero-based (index, count) pair; every row does without one."""
+    return row_shard is None or index % row_shard[1] == row_shard[0]
+
+def count_rows(rows, row_shard=None):
+    """Rows a run renders: the sheet's (estimated) row count, or the share of it in row_shard."""
+    total = len(rows) if isinstance(rows, pd.DataFrame) else rows.row_estimate
+    if row_shard is not None:
+        total = len(range(row_shard[0], total, row_shard[1]))
+    return total
+
+def iter_prepared_records(rows, current_date, row_shard=None, row_range=None):
+    """Prepare the records of a DataFrame, or of every chunk of a WorkbookReader as it is read.
+
+    With a row_shard only every row_shard[1]-th row is yielded, starting at row
+    row_shard[0], so that several processes or machines can split one sheet between them.
+    row_range, a (start, first_row, last_row) triple, reads only sheet rows
+    first_row to last_row of a WorkbookReader, numbering them from position start.
+    """
+    if isinstance(rows, pd.DataFrame):
+        # A sheet read by pandas: its rows start right below the header
+        chunks = iter([(0, rows.set_axis(pd.RangeIndex(HEADER_ROW + 1, HEADER_ROW + 1 + len(rows))))])
+    elif row_range is not None:
+        start, first_row, last_row = row_range
+        chunks = rows.chunks(first_row, last_row, start)
+    else:
+        chunks = rows.chunks()
+    while True:
+        with metrics.stage_timer("read_workbook"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        start, df = chunk
+        with metrics.stage_timer("prepare_records"):
+            records = [
+                record for record in prepare_records(df, current_date, placeholder_mapping, start)
+                if in_row_shard(record.index, row_shard)
+            ]
+        yield from records
+
+def open_employee_workbook(excel_file_path, chunk_size=None):
+    """Open a workbook for streaming, resolving its header against the expected columns once."""
+    reader = WorkbookReader(excel_file_path, chunk_size=chunk_size or READ_CHUNK_SIZE, expected_columns=EXPECTED_COLUMNS)
+    if reader.missing_columns:
+        logger.warning(
+            "Columns not found in %s: %s", os.path.basename(excel_file_path), ", ".join(reader.missing_columns),
+            extra={"event": "missing_columns", "columns": reader.missing_columns}
+        )
+    return reader
+
+# Shared by every run in this process; opened on first use
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+def get_render_cache():
+    """Return the process-wide RenderCache, opening it the first time."""
+    global _render_cache
+    with _render_cache_lock:
+        if _render_cache is None:
+            _render_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES)
+        return _render_cache
+
+# Per-row state of every run, for resuming; opened on first use
+_run_journal = None
+_run_journal_lock = threading.Lock()
+
+def get_run_journal():
+    """Return the process-wide RunJournal, opening it the first time."""
+    global _run_journal
+    with _run_journal_lock:
+        if _run_journal is None:
+            _run_journal = RunJournal(RUN_JOURNAL_DB)
+        return _run_journal
+
+def close_run_journal():
+    """Shutdown handler: stop the run journal's heartbeat, if it was opened."""
+    with _run_journal_lock:
+        if _run_journal is not None:
+            _run_journal.close()
+
+def workbook_run_key(excel_file_path, pdf_template, row_shard=None):
+    """Journal key of a run: the workbook content, the template it is rendered with and its row shard, if any."""
+    return run_key(file_digest(excel_file_path), load_template(pdf_template).digest, *(row_shard or ()))
+
+def record_render_failure(record, error, failed_rows, progress=None):
+    """Log a row that failed to render and add it to failed_rows, the rows of the error report."""
+    logger.error(
+        "Row %d failed: %s", record.row, error,
+        extra={"event": "row_failed", "row": record.row, "emp_id": record.emp_id}
+    )
+    failed_rows.append(
+        {"row": record.row, "emp_id": record.emp_id, "name": record.name, "stage": "render", "error": error}
+    )
+    metrics.ROWS_TOTAL.inc(outcome="failed")
+    if progress:
+        progress(rows_failed=len(failed_rows))
+
+class LetterArchive:
+    """The archive side of a run: adds each rendered letter to a single ZIP or to the shards of a ShardedZipWriter.
+
+    zip_file is a path, a write-only file object such as ZipStreamBuffer, or a
+    ShardedZipWriter. Sharded, each letter goes to the shards of its shard_by
+    column value (if given), and finish() writes a CSV listing the shard of
+    every letter to the writer's index_path. Leaving the with block on an
+    error aborts the archive.
+    """
+
+    def __init__(self, zip_file, compression=None, in_memory=True, shard_by=None):
+        self.sharded = isinstance(zip_file, ShardedZipWriter)
+        if shard_by and not self.sharded:
+            raise ValueError("shard_by needs a ShardedZipWriter")
+        self.writer = zip_file if self.sharded else ParallelZipWriter(zip_file, compression or ARCHIVE_COMPRESSION, ARCHIVE_WORKERS)
+        self.in_memory = in_memory
+        self._group = record_column_value(shard_by) if shard_by else (lambda record: None)
+        self._index = []
+
+    def add(self, record, pdf, arcname):
+        """Add a letter: its bytes when in_memory, otherwise the path of its file."""
+        # A sharded writer also takes the letter's group and names the shard it chose
+        placement = {"group": self._group(record)} if self.sharded else {}
+        with metrics.stage_timer("zip_write"):
+            if self.in_memory:
+                shard = self.writer.writestr(arcname, pdf, **placement)
+            else:
+                shard = self.writer.write(pdf, arcname=arcname, **placement)
+        if self.sharded:
+            self._index.append(
+                {"shard": shard, "file": arcname, "row": record.row, "emp_id": record.emp_id, "name": record.name}
             )
-            email_thread.start()
 
-            # Queue all email tasks
-            for email_task in email_tasks:
-                print(f"\nQueuing email for: {email_task[0]}")
-                email_queue.put(email_task)
+    def finish(self, failed_rows=()):
+        """Report rows that could not be rendered alongside the letters, then complete the archive."""
+        if failed_rows:
+            self.writer.writestr("error_report.csv", error_report_csv(failed_rows))
+            logger.warning("%d row(s) failed, see error_report.csv in the ZIP", len(failed_rows), extra={"event": "rows_failed", "rows_failed": len(failed_rows)})
+        self.writer.close()
+        if self.sharded:
+            with open(self.writer.index_path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=SHARD_INDEX_FIELDS)
+                writer.writeheader()
+                writer.writerows(self._index)
+            logger.info(
+                "Letters split over %d archives, see %s", len(self.writer.paths), self.writer.index_path,
+                extra={"event": "shards_written", "shards": [os.path.basename(path) for path in self.writer.paths]}
+            )
 
-            # Signal email worker to stop
-            print("Adding stop signal to email queue...")
-            email_queue.put(None)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.writer.abort()
+
+class LetterMailer:
+    """The email side of a run: hands each rendered letter to the SMTP delivery engine as soon as it is ready.
+
+    The engine is started for the first letter with an Email Id. With a
+    journal_run, every send is journaled and a row an earlier attempt of the
+    run delivered is not sent again. Failed deliveries are collected in errors
+    for the error report. Letters on disk (in_memory False) are removed once
+    their email no longer needs them.
+    """
+
+    def __init__(self, in_memory=True, journal_run=None, progress=None):
+        self.in_memory = in_memory
+        self.journal_run = journal_run
+        self.progress = progress
+        self.errors = []
+        self.skipped = 0
+        self._engine = None
+        self._pdfs = []
+
+    def send(self, record, pdf, arcname):
+        """Queue a letter (bytes when in_memory, otherwise a file path) for its row's Email Id, if it has one."""
+        if record.email and self.journal_run is not None and self.journal_run.already_sent(record.index):
+            self.skipped += 1
+        elif record.email:
+            if self._engine is None:
+                self._engine = create_email_engine(self.progress)
+            # Journaled before the hand-off so a fast delivery cannot be overwritten by "queued"
+            if self.journal_run is not None:
+                self.journal_run.send_state(record.index, record.email, "queued")
+            try:
+                if self.in_memory:
+                    msg = build_appraisal_email(record.email, arcname, record.name, pdf)
+                else:
+                    msg = build_appraisal_email(record.email, pdf, record.name)
+                    self._pdfs.append(pdf)
+                future = self._engine.submit(record.email, msg)
+            except Exception as e:
+                future = concurrent.futures.Future()
+                future.set_result(DeliveryResult(record.email, False, f"{type(e).__name__}: {str(e)}"))
+            future.add_done_callback(lambda done, record=record: self._delivered(record, done.result()))
+            return
+        # Nothing will be sent, so the letter is no longer needed
+        if not self.in_memory:
+            os.remove(pdf)
+
+    def _delivered(self, record, result):
+        """Done callback of an email: journal its outcome and collect failures for the error report."""
+        if self.journal_run is not None:
+            self.journal_run.send_state(record.index, record.email, "sent" if result.ok else "failed", result.error)
+        if not result.ok:
+            self.errors.append(
+                {"row": record.row, "emp_id": record.emp_id, "name": record.name, "stage": "email", "error": result.error}
+            )
 
-            # Wait for email worker to finish (with timeout)
-            print("Waiting for email worker to finish...")
-            email_thread.join(timeout=120)  # Increased timeout to 2 minutes
+    def wait(self):
+        """Wait for every queued email and log how many were sent and which recipients failed."""
+        if self._engine is None:
+            return
+        logger.info("Waiting for emails to finish sending", extra={"event": "emails_waiting", "emails_pending": self._engine.pending})
+        results = self._engine.close()
+        self._engine = None
+        failed = [result for result in results if not result.ok]
+        logger.info(
+            "Emails sent: %d, failed: %d", len(results) - len(failed), len(failed),
+            extra={"event": "emails_done", "emails_sent": len(results) - len(failed), "emails_failed": len(failed),
+                   "emails_skipped": self.skipped, "failed_recipients": {result.recipient: result.error for result in failed}}
+        )
 
-    except Exception as e:
-        print(f"Error during processing: {str(e)}")
-        raise
-    finally:
-        # Clean up PDF files only after emails are sent
-        for pdf_file in generated_pdfs:
+    def close(self):
+        """Stop the engine, letting in-flight deliveries record their state, and remove the letters kept for it."""
+        if self._engine is not None:
+            self._engine.close()
+            self._engine = None
+        for pdf_file in self._pdfs:
             if os.path.exists(pdf_file):
                 try:
                     os.remove(pdf_file)
                 except Exception as e:
-                    print(f"Warning: Could not delete temporary file {pdf_file}: {str(e)}")
+                    logger.warning("Could not delete temporary file %s: %s", pdf_file, e)
+        self._pdfs.clear()
+
+def write_employee_zip(zip_file, rows, pdf_template, output_folder, options=None, progress=None, resume_key=None, error_report_path=None, shard_by=None, row_shard=None):
+    """Render every row into a ZIP written to zip_file, yielding after each entry.
+
+    rows is a DataFrame or a WorkbookReader, whose chunks are rendered as they
+    are read. options is a RenderOptions; its unset fields come from the module
+    settings. Each letter goes into the archive through LetterArchive, so
+    zip_file may be a path, a write-only file object such as ZipStreamBuffer or
+    a ShardedZipWriter (letters grouped by their shard_by column value), and is
+    handed to LetterMailer to be emailed as soon as it is ready. Once the
+    archive is complete the generator yields None; resumed, it waits for the
+    emails and cleans up. progress, if given, is called with updated
+    rows_total/rows_done/rows_failed and email counts. Stage timings go to the
+    /metrics histograms and are summed per run. With row_shard, a zero-based
+    (index, count) pair, only that slice of the rows is rendered.
+
+    A row that fails to render or send is listed in error_report.csv in the
+    ZIP (render failures) and in the CSV at error_report_path (render and
+    email failures, written once the emails are done) instead of aborting the
+    run. With resume_key the rows are journaled, and a run with the same key
+    that failed or was interrupted is resumed: emails it delivered are not
+    sent again, and letters it rendered are read back from RUN_LETTERS_DIR
+    instead of being rendered again.
+    """
+    options = resolve_render_options(options)
+    run_started = time.perf_counter()
+    stage_totals = {}
+    metrics.set_run_totals(stage_totals)
+    outcome = "failed"
+
+    # Locate every placeholder once for the whole run
+    template = load_template(pdf_template, TEMPLATE_SEARCH_KEYS, CONDITIONAL_SECTIONS)
+    cache = get_render_cache() if options.use_cache else None
+    journal_run = get_run_journal().start(resume_key) if resume_key and RESUME_RUNS else None
+    run_letters = None
+    # Rows whose letter an earlier attempt of the run rendered
+    resumed_rows = set()
+    if journal_run is not None:
+        if journal_run.resumed:
+            logger.info("Resuming interrupted run", extra={"event": "run_resumed", "run_id": journal_run.id})
+        run_letters = RenderCache(os.path.join(RUN_LETTERS_DIR, journal_run.id), max_bytes=None)
+
+    def previous(record):
+        if journal_run is None or not journal_run.already_rendered(record.index):
+            return None
+        data = run_letters.get(str(record.index))
+        if data is not None:
+            resumed_rows.add(record.index)
+        return data
+
+    docs_folder = None
+    if not options.in_memory:
+        docs_folder = os.path.join(output_folder, "temp_pdfs", secrets.token_hex(8))
+        os.makedirs(docs_folder, exist_ok=True)
+
+    mailer = LetterMailer(options.in_memory, journal_run, progress)
+    failed_rows = []
+    rows_done = 0
+    cache_hits = cache_misses = 0
+    if progress:
+        progress(rows_total=count_rows(rows, row_shard))
+
+    try:
+        with LetterArchive(zip_file, options.compression, options.in_memory, shard_by) as archive:
+            # Every per-row decision is made column by column before rendering starts
+            current_date = datetime.datetime.now().strftime("%B %d, %Y")
+            records = iter_prepared_records(rows, current_date, row_shard)
+
+            # Results come back in sheet order, so the ZIP layout does not depend on worker timing
+            for record, result, error, cached in render_records(records, template, docs_folder, options, cache, previous):
+                if journal_run is not None:
+                    # Kept before the row is journaled as rendered, so a resumed run always finds it
+                    if error is None and record.index not in resumed_rows:
+                        _store_rendered(run_letters, str(record.index), result[0])
+                    journal_run.rendered(record.index, record.emp_id, record.name, error)
+                if error is not None:
+                    record_render_failure(record, error, failed_rows, progress)
+                    continue
+                pdf, arcname = result
+                archive.add(record, pdf, arcname)
+                mailer.send(record, pdf, arcname)
+
+                # One summary record per row instead of a line per step
+                logger.debug(
+                    "Row rendered",
+                    extra={"event": "row_rendered", "row": record.row, "emp_id": record.emp_id,
+                           "file": arcname, "email_queued": bool(record.email), "cached": cached}
+                )
+                # Letters of an earlier attempt count as neither a hit nor a miss
+                if cache is not None and record.index not in resumed_rows:
+                    if cached:
+                        cache_hits += 1
+                    else:
+                        cache_misses += 1
+                    metrics.RENDER_CACHE_TOTAL.inc(result="hit" if cached else "miss")
+                rows_done += 1
+                metrics.ROWS_TOTAL.inc(outcome="rendered")
+                if progress:
+                    progress(rows_done=rows_done)
+                yield record.index
+                # A streaming response may resume the generator on another thread
+                metrics.set_run_totals(stage_totals)
+
+            archive.finish(failed_rows)
+
+        # The archive is complete; let a streaming caller flush the central directory
+        yield None
+        metrics.set_run_totals(stage_totals)
+
+        # Wait for the remaining emails and report every recipient that failed
+        mailer.wait()
+        errors = sorted(failed_rows + mailer.errors, key=lambda error: error["row"])
+        if error_report_path and errors:
+            with open(error_report_path, "w", newline="", encoding="utf-8") as f:
+                f.write(error_report_csv(errors))
+            logger.warning("%d row(s) failed, see %s", len(errors), error_report_path, extra={"event": "error_report", "errors": len(errors)})
+        outcome = "ok"
+
+    except GeneratorExit:
+        # The consumer stopped early, e.g. a download was cancelled
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        logger.exception("Error during processing: %s", e, extra={"event": "run_error"})
+        raise
+    finally:
+        metrics.set_run_totals(None)
+        run_seconds = time.perf_counter() - run_started
+        # In-flight deliveries record their state before the run is closed; the letters kept for them go after
+        mailer.close()
+        if journal_run is not None:
+            journal_run.finish({"ok": "done", "cancelled": "interrupted"}.get(outcome, "failed"))
+            # Only a run that may be resumed needs its letters
+            if outcome == "ok":
+                shutil.rmtree(run_letters.directory, ignore_errors=True)
+        metrics.RUN_SECONDS.observe(run_seconds, outcome=outcome)
+        # Stages run by render workers are summed over all workers, so they can exceed the wall time
+        logger.info(
+            "Run %s after %.2fs (render cache: %d hits, %d misses)", outcome, run_seconds, cache_hits, cache_misses,
+            extra={"event": "run_finished", "outcome": outcome, "seconds": round(run_seconds, 3),
+                   "rows_done": rows_done, "rows_failed": len(failed_rows), "rows_resumed": len(resumed_rows),
+                   "emails_skipped": mailer.skipped,
+                   "cache_hits": cache_hits, "cache_misses": cache_misses,
+                   "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stage_totals.items()}}
+        )
 
         # Clean up temp folder
         try:
-            if os.path.exists(docs_folder):
+            if docs_folder and os.path.exists(docs_folder):
                 shutil.rmtree(docs_folder)
         except Exception as e:
-            print(f"Warning: Could not delete temporary folder {docs_folder}: {str(e)}")
+            logger.warning("Could not delete temporary folder %s: %s", docs_folder, e)
+
+def _natural_key(text):
+    """Sort key that orders embedded numbers by value, so EMP2 comes before EMP10."""
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part.lower()) for part in re.split(r'(\d+)', text) if part]
+
+def record_column_value(column):
+    """Return a function giving a PreparedRecord's value of a workbook column, e.g. 'Department'."""
+    placeholder = next((p for p, excel_col in placeholder_mapping.items() if excel_col == column), None)
+    if placeholder is None:
+        raise ValueError(f"Unknown column {column!r}, expected one of: {', '.join(placeholder_mapping.values())}")
+    return lambda record: record.replacements[placeholder]
+
+def record_sort_key(column):
+    """Return a sort key for PreparedRecords by the value of a workbook column."""
+    value = record_column_value(column)
+    return lambda record: _natural_key(value(record))
+
+def write_merged_letters(output_pdf, rows, pdf_template, options=None, progress=None, sort_by=None, error_report_path=None, row_shard=None):
+    """Render every row into one print-ready PDF at output_pdf, ordered by the sort_by column.
+
+    Each letter starts on a new page under a bookmark "<Emp ID> <Name>"; rows
+    with the same sort value keep their sheet order. Every row is prepared
+    before rendering starts, since the order depends on the whole sheet.
+    options is a RenderOptions; its archive settings do not apply. Nothing is
+    emailed. Rows that fail to render are left out of the PDF and listed in
+    the CSV at error_report_path. Returns the number of letters written.
+    """
+    options = resolve_render_options(options)
+    run_started = time.perf_counter()
+    stage_totals = {}
+    metrics.set_run_totals(stage_totals)
+    outcome = "failed"
+
+    template = load_template(pdf_template, TEMPLATE_SEARCH_KEYS, CONDITIONAL_SECTIONS)
+    sort_key = record_sort_key(sort_by or MERGED_SORT_COLUMN)
+    cache = get_render_cache() if options.use_cache else None
+
+    failed_rows = []
+    rows_done = 0
+    if progress:
+        progress(rows_total=count_rows(rows, row_shard))
+
+    try:
+        current_date = datetime.datetime.now().strftime("%B %d, %Y")
+        # sorted() is stable, so ties stay in sheet order
+        records = sorted(iter_prepared_records(rows, current_date, row_shard), key=sort_key)
+
+        with LetterBook(output_pdf) as book:
+            for record, result, error, cached in render_records(records, template, None, options, cache):
+                if error is not None:
+                    record_render_failure(record, error, failed_rows, progress)
+                    continue
+
+                pdf, _arcname = result
+                with metrics.stage_timer("merge_pdf"):
+                    book.add(pdf, f"{record.emp_id} {record.name}")
+                if cache is not None:
+                    metrics.RENDER_CACHE_TOTAL.inc(result="hit" if cached else "miss")
+                rows_done += 1
+                metrics.ROWS_TOTAL.inc(outcome="rendered")
+                if progress:
+                    progress(rows_done=rows_done)
+
+        if error_report_path and failed_rows:
+            with open(error_report_path, "w", newline="", encoding="utf-8") as f:
+                f.write(error_report_csv(failed_rows))
+            logger.warning("%d row(s) failed, see %s", len(failed_rows), error_report_path, extra={"event": "error_report", "errors": len(failed_rows)})
+        outcome = "ok"
+        return rows_done
+    except Exception as e:
+        logger.exception("Error during processing: %s", e, extra={"event": "run_error"})
+        raise
+    finally:
+        metrics.set_run_totals(None)
+        run_seconds = time.perf_counter() - run_started
+        metrics.RUN_SECONDS.observe(run_seconds, outcome=outcome)
+        logger.info(
+            "Merged PDF run %s after %.2fs", outcome, run_seconds,
+            extra={"event": "run_finished", "outcome": outcome, "seconds": round(run_seconds, 3),
+                   "rows_done": rows_done, "rows_failed": len(failed_rows), "output_mode": "merged_pdf",
+                   "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stage_totals.items()}}
+        )
 
-    print("\nZIP file created successfully.")
+def open_work_queue(queue_db=None):
+    """Open the work queue at queue_db (WORK_QUEUE_DB by default) with the configured lease and retry limits."""
+    return WorkQueue(queue_db or WORK_QUEUE_DB, QUEUE_LEASE_SECONDS, QUEUE_MAX_ATTEMPTS)
+
+def enqueue_workbook(queue, excel_file_path, pdf_template, output_folder, render_mode=None, task_rows=None):
+    """Split a workbook into row-range tasks on the work queue and return (run ID, row count).
+
+    Each task covers task_rows non-blank rows: positions start to stop, found
+    in sheet rows first_row to last_row, so a worker reads just its own rows.
+    """
+    task_rows = task_rows or QUEUE_TASK_ROWS
+    # (position, sheet row) of the first row of every task
+    task_starts = []
+    total = 0
+    last_row = HEADER_ROW
+    with open_employee_workbook(excel_file_path) as reader:
+        for start, df in reader.chunks():
+            sheet_rows = df.index.tolist()
+            for offset in range(-start % task_rows, len(sheet_rows), task_rows):
+                task_starts.append((start + offset, sheet_rows[offset]))
+            total = start + len(sheet_rows)
+            last_row = sheet_rows[-1]
+    params = {
+        # Workers may run from another directory, so every path is absolute
+        "excel": os.path.abspath(excel_file_path),
+        "template": os.path.abspath(pdf_template),
+        "parts": os.path.abspath(os.path.join(output_folder, "queue_parts")),
+        "render_mode": render_mode or RENDER_MODE,
+        # Fixed once, so a run that spans midnight dates every letter alike
+        "current_date": datetime.datetime.now().strftime("%B %d, %Y"),
+        "rows_total": total,
+        "task_rows": task_rows,
+    }
+    payloads = []
+    for number, (start, first_row) in enumerate(task_starts):
+        following = task_starts[number + 1] if number + 1 < len(task_starts) else (total, last_row + 1)
+        payloads.append({"start": start, "stop": following[0], "first_row": first_row, "last_row": following[1] - 1})
+    return queue.create_run(params, payloads), total
+
+def render_queue_task(queue, task, worker, workers=1):
+    """Render a task's rows into a part archive, keeping the lease alive, and return the task result.
+
+    The result lists the part archive, the rows that failed and the rows
+    with an email address, for the coordinator to assemble.
+    """
+    params = queue.run_params(task.run_id)
+    payload = task.payload
+    template = load_template(params["template"], TEMPLATE_SEARCH_KEYS, CONDITIONAL_SECTIONS)
+    options = resolve_render_options(RenderOptions(mode=params["render_mode"], workers=workers))
+    cache = get_render_cache() if options.use_cache else None
+    parts_folder = os.path.join(params["parts"], task.run_id)
+    os.makedirs(parts_folder, exist_ok=True)
+    # Unique per attempt: a worker presumed dead may still be writing its own part
+    part_path = os.path.join(parts_folder, f"part_{task.id:06d}_{secrets.token_hex(4)}.zip")
+    temp_path = f"{part_path}.tmp"
+
+    errors = []
+    emails = []
+    letters = 0
+    last_heartbeat = time.monotonic()
+    try:
+        with open_employee_workbook(params["excel"]) as reader, ParallelZipWriter(temp_path) as zipf:
+            # Only the task's own sheet rows are read, numbered from the positions found when it was queued
+            records = iter_prepared_records(
+                reader, params["current_date"], row_range=(payload["start"], payload["first_row"], payload["last_row"])
+            )
+            for record, result, error, _cached in render_records(records, template, None, options, cache):
+                if error is not None:
+                    errors.append(
+                        {"row": record.row, "emp_id": record.emp_id, "name": record.name, "stage": "render", "error": error}
+                    )
+                    metrics.ROWS_TOTAL.inc(outcome="failed")
+                else:
+                    pdf, arcname = result
+                    zipf.writestr(arcname, pdf)
+                    letters += 1
+                    metrics.ROWS_TOTAL.inc(outcome="rendered")
+                    if record.email:
+                        emails.append(
+                            {"row": record.row, "emp_id": record.emp_id, "name": record.name, "email": record.email, "file": arcname}
+                        )
+                if time.monotonic() - last_heartbeat > queue.lease_seconds / 3:
+                    if not queue.heartbeat(task, worker):
+                        raise RuntimeError(f"Lost the lease on task {task.id}")
+                    last_heartbeat = time.monotonic()
+        os.replace(temp_path, part_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return {"archive": part_path, "letters": letters, "errors": errors, "emails": emails}
+
+def run_queue_worker(run_id=None, workers=1, worker=None, queue_db=None):
+    """Claim and render work-queue tasks, of run_id if given, until none are pending. Returns the tasks done.
+
+    Meant to own its process (a spawned local worker or `batch.py work`): it
+    sets up logging if nothing has, and buffers the process's metrics into
+    each task result, for the coordinator to record on its /metrics.
+    """
+    configure_logging(LOG_LEVEL, LOG_JSON)
+    metrics.start_buffering()
+    queue = open_work_queue(queue_db)
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    done = 0
+    while True:
+        task = queue.claim(worker, run_id)
+        if task is None:
+            return done
+        logger.info(
+            "Rendering rows %d to %d", task.payload["first_row"], task.payload["last_row"],
+            extra={"event": "task_claimed", "task": task.id, "run_id": task.run_id, "attempt": task.attempts, "worker": worker}
+        )
+        metrics.drain()
+        try:
+            result = render_queue_task(queue, task, worker, workers)
+        except Exception as e:
+            logger.exception("Task %d failed: %s", task.id, e, extra={"event": "task_failed", "task": task.id, "worker": worker})
+            queue.fail(task, worker, f"{type(e).__name__}: {str(e)}")
+            continue
+        result["metrics"] = metrics.drain()
+        if queue.complete(task, worker, result):
+            done += 1
+        else:
+            # Another worker took the task over after our lease ran out; its part is the one kept
+            os.remove(result["archive"])
+            logger.warning("Task %d was taken over by another worker", task.id, extra={"event": "task_lease_lost", "task": task.id})
+
+def run_queued_merge(queue, run_id, zip_path, error_report_path, manifest_path, local_workers=None, progress=None, compression=None):
+    """Coordinate a work-queue run: keep local workers going until every task is settled, then assemble.
+
+    Letters are copied from the part archives into zip_path in sheet order.
+    Rows that failed, including the rows of tasks that ran out of attempts,
+    go to error_report.csv in the ZIP and to error_report_path, and the rows
+    to email are listed in manifest_path (EMAIL_MANIFEST_FIELDS); nothing is
+    sent from here. With local_workers 0 the tasks are left to workers
+    started elsewhere with `batch.py work`.
+    """
+    if local_workers is None:
+        local_workers = QUEUE_WORKERS
+    processes = []
+
+    # Spawned, not forked: a fork of the threaded server would inherit a log queue nobody drains and locks held by its threads
+    context = multiprocessing.get_context("spawn")
+
+    def start_workers(count):
+        for _ in range(count):
+            process = context.Process(target=run_queue_worker, args=(run_id,), kwargs={"queue_db": queue.db_path})
+            process.start()
+            processes.append(process)
+
+    params = queue.run_params(run_id)
+    start_workers(local_workers)
+    try:
+        while True:
+            counts = queue.progress(run_id)
+            if progress:
+                progress(rows_done=min(counts["done"] * params["task_rows"], params["rows_total"]))
+            if not counts["pending"] and not counts["leased"]:
+                break
+            # Tasks handed back after a worker died need someone to pick them up
+            if counts["pending"] and local_workers and not any(process.is_alive() for process in processes):
+                start_workers(min(local_workers, counts["pending"]))
+            time.sleep(QUEUE_POLL_SECONDS)
+    finally:
+        for process in processes:
+            process.join()
+
+    errors = []
+    emails = []
+    parts_folder = None
+    with ParallelZipWriter(zip_path, compression or ARCHIVE_COMPRESSION, ARCHIVE_WORKERS) as zipf:
+        for task, state, result, error in queue.tasks(run_id):
+            first_row, last_row = task.payload["first_row"], task.payload["last_row"]
+            if state != "done":
+                errors.append({
+                    "row": first_row, "emp_id": "", "name": "", "stage": "queue",
+                    "error": f"Rows {first_row} to {last_row} not rendered after {task.attempts} attempt(s): {error}"
+                })
+                continue
+            parts_folder = os.path.dirname(result["archive"])
+            metrics.replay(result.get("metrics", []))
+            with zipfile.ZipFile(result["archive"]) as part:
+                for info in part.infolist():
+                    zipf.writestr(info.filename, part.read(info))
+            errors.extend(result["errors"])
+            emails.extend(result["emails"])
+        if errors:
+            zipf.writestr("error_report.csv", error_report_csv(errors))
+
+    with open(manifest_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=EMAIL_MANIFEST_FIELDS)
+        writer.writeheader()
+        writer.writerows(emails)
+    if errors:
+        with open(error_report_path, "w", newline="", encoding="utf-8") as f:
+            f.write(error_report_csv(errors))
+        logger.warning("%d row(s) failed, see %s", len(errors), error_report_path, extra={"event": "error_report", "errors": len(errors)})
+    if parts_folder:
+        shutil.rmtree(parts_folder, ignore_errors=True)
+    return zip_path
+
+def merge_employee_data_and_zip(excel_file_path, pdf_template, output_folder, zip_name=None, options=None, progress=None, output_mode="zip", sort_by=None, shard_max_bytes=None, shard_max_entries=None, shard_by=None, chunk_size=None, row_shard=None, work_queue=False, queue_workers=None, queue_db=None, allow_shards=True):
+    """Main function to process Excel and create ZIP
+
+    options is a RenderOptions; its unset fields come from the module settings.
+    With output_mode "merged_pdf" the letters go into one PDF named after
+    zip_name instead, sorted by the sort_by column (MERGED_SORT_COLUMN by
+    default), and no emails are sent. Returns the path of the output file.
+
+    With any of shard_max_bytes, shard_max_entries or shard_by (SHARD_* by
+    default) the ZIP is split into shards named after zip_name, and the path
+    returned is that of the index CSV listing each letter's shard. Callers
+    that can only hand back a single ZIP, like the web downloads, pass
+    allow_shards=False to have sharding settings rejected with a ValueError
+    before anything is rendered.
+
+    row_shard, a zero-based (index, count) pair, renders only every count-th
+    row starting at index; chunk_size overrides READ_CHUNK_SIZE.
+
+    With work_queue the rows are rendered through the durable work queue by
+    queue_workers local processes (QUEUE_WORKERS by default) and any external
+    workers on the queue at queue_db (WORK_QUEUE_DB by default), and the rows
+    to email are written to <zip stem>_emails.csv instead of being sent. Queue
+    workers render with options' mode and their own process's other settings.
+    """
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode {output_mode!r}, expected one of {', '.join(OUTPUT_MODES)}")
+    options = resolve_render_options(options)
+    logger.info("Starting merge and zip process", extra={"event": "run_started", "excel": os.path.basename(excel_file_path), "output_mode": output_mode})
+    os.makedirs(output_folder, exist_ok=True)
+
+    if zip_name is None:
+        today = datetime.datetime.now().strftime("%Y%m%d")
+        zip_name = f"employee_documents_{today}.zip"
+    zip_path = os.path.join(output_folder, zip_name)
+    error_report_path = f"{os.path.splitext(zip_path)[0]}_errors.csv"
+
+    if output_mode == "merged_pdf":
+        pdf_path = f"{os.path.splitext(zip_path)[0]}.pdf"
+        with open_employee_workbook(excel_file_path, chunk_size) as reader:
+            write_merged_letters(pdf_path, reader, pdf_template, options, progress, sort_by, error_report_path, row_shard)
+        logger.info("Merged PDF created", extra={"event": "merged_pdf_created", "pdf": pdf_path})
+        return pdf_path
+
+    if work_queue:
+        if row_shard or shard_max_bytes or shard_max_entries or shard_by:
+            raise ValueError("The work queue splits the rows itself and writes a single ZIP")
+        queue = open_work_queue(queue_db)
+        run_id, total = enqueue_workbook(queue, excel_file_path, pdf_template, output_folder, options.mode)
+        logger.info("Queued %d rows", total, extra={"event": "run_queued", "run_id": run_id, "rows_total": total})
+        if progress:
+            progress(rows_total=total)
+        run_queued_merge(
+            queue, run_id, zip_path, error_report_path, f"{os.path.splitext(zip_path)[0]}_emails.csv",
+            queue_workers, progress, options.compression
+        )
+        logger.info("ZIP file created", extra={"event": "zip_created", "zip": zip_path, "run_id": run_id})
+        return zip_path
+
+    shard_max_bytes = shard_max_bytes or SHARD_MAX_BYTES
+    shard_max_entries = shard_max_entries or SHARD_MAX_ENTRIES
+    shard_by = shard_by or SHARD_BY
+    if not allow_shards and (shard_max_bytes or shard_max_entries or shard_by):
+        raise ValueError("Sharded archives are only written by batch runs; unset SHARD_MAX_BYTES, SHARD_MAX_ENTRIES and SHARD_BY to download a single ZIP")
+    output = zip_path
+    if shard_max_bytes or shard_max_entries or shard_by:
+        output = ShardedZipWriter(
+            output_folder, os.path.splitext(zip_name)[0], options.compression, ARCHIVE_WORKERS,
+            max_bytes=shard_max_bytes, max_entries=shard_max_entries
+        )
+
+    # Rows are read in chunks and rendered as they arrive instead of loading the whole sheet
+    with open_employee_workbook(excel_file_path, chunk_size) as reader:
+        for _ in write_employee_zip(
+            output, reader, pdf_template, output_folder, options, progress,
+            resume_key=workbook_run_key(excel_file_path, pdf_template, row_shard),
+            error_report_path=error_report_path,
+            shard_by=shard_by,
+            row_shard=row_shard
+        ):
+            pass
+
+    if isinstance(output, ShardedZipWriter):
+        logger.info("ZIP shards created", extra={"event": "zip_created", "zips": output.paths, "index": output.index_path})
+        return output.index_path
+    logger.info("ZIP file created", extra={"event": "zip_created", "zip": zip_path})
     return zip_path
 
+def stream_employee_zip(rows, pdf_template, output_folder, options=None, resume_key=None):
+    """Yield the bytes of the employee ZIP as each letter is added to it.
+
+    Only the entry being written is buffered, and letters without an email
+    address are dropped as soon as they are in the archive. A WorkbookReader
+    passed as rows is closed when the stream ends. A cancelled download leaves
+    a resumable run behind when resume_key is given. The stream ends with the
+    archive's central directory; the emails still in flight are waited for on
+    a background thread, so a slow mail server does not hold the download open.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    buffer = ZipStreamBuffer()
+    run = write_employee_zip(buffer, rows, pdf_template, output_folder, options, resume_key=resume_key)
+    try:
+        for index in run:
+            data = buffer.drain()
+            if index is None:
+                # The archive is complete; hand the rest of the run over before sending its last bytes
+                threading.Thread(target=_finish_run, args=(run,), name="email-delivery").start()
+                if data:
+                    yield data
+                return
+            if data:
+                yield data
+    finally:
+        if isinstance(rows, WorkbookReader):
+            rows.close()
+
+def _finish_run(run):
+    """Drive a write_employee_zip run past its archive: wait for its emails, write its reports and clean up."""
+    try:
+        for _ in run:
+            pass
+    except Exception:
+        # write_employee_zip has logged it; there is no response left to report it on
+        pass
+
+# Background upload jobs, tracked in SQLite so their state survives a restart;
+# the store is opened when the server starts, so importing this module leaves it alone
+job_store = None
+job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="render-job")
+
+def open_job_store():
+    """Startup handler: open the job store and start keeping this server's jobs alive."""
+    global job_store
+    job_store = JobStore(JOBS_DB)
+    job_store.start()
+
+def close_job_store():
+    """Shutdown handler: stop the job store's heartbeat."""
+    if job_store is not None:
+        job_store.stop()
+
+def run_render_job(job_id, excel_path, zip_name):
+    """Render an uploaded workbook off the event loop and record the outcome in the job store."""
+    job_store.update(job_id, status="running")
+    progress = JobProgress(job_store, job_id)
+    try:
+        zip_path = merge_employee_data_and_zip(
+            excel_path,
+            'template.pdf',
+            OUTPUT_DIR,
+            zip_name=zip_name,
+            progress=progress,
+            allow_shards=False
+        )
+        progress.flush()
+        job_store.update(job_id, status="done", artifact_path=zip_path)
+    except Exception as e:
+        progress.flush()
+        job_store.update(job_id, status="failed", error=str(e))
+    finally:
+        if os.path.exists(excel_path):
+            os.remove(excel_path)
+
+class UploadTooLarge(Exception):
+    """An upload went over MAX_UPLOAD_BYTES."""
+
+async def save_upload(upload, directory, max_bytes=None, chunk_size=None):
+    """Copy an UploadFile into a new, uniquely named file in directory, chunk by chunk, and return its path.
+
+    Only one chunk is held in memory at a time. The file keeps the upload's
+    extension, which decides how the workbook is read. An upload larger than
+    max_bytes (MAX_UPLOAD_BYTES by default) is removed and UploadTooLarge raised.
+    """
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+    chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+    suffix = os.path.splitext(os.path.basename(upload.filename or ""))[1].lower()
+    fd, path = tempfile.mkstemp(prefix="upload_", suffix=suffix, dir=directory)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = await upload.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"The workbook is larger than the {max_bytes // (1024 * 1024)} MB upload limit")
+                # Disk writes stay off the event loop
+                await run_in_threadpool(f.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+class UploadLimitMiddleware:
+    """Refuse POST /upload bodies larger than MAX_UPLOAD_BYTES before the form is parsed.
+
+    A Content-Length over the limit is answered with 413 without reading the
+    body. Otherwise the bytes are counted as they arrive and the request is cut
+    off with 413 once the count passes the limit, so an oversized or chunked
+    upload is never spooled to disk in full.
+    """
+
+    def __init__(self, app, paths=("/upload",)):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = MAX_UPLOAD_BYTES
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length", b"").decode("latin-1")
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            await self.refuse(scope, receive, send, max_bytes)
+            return
+
+        size = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal size, too_large
+            if too_large:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                size += len(message.get("body", b""))
+                if size > max_bytes:
+                    # Reported as a disconnect so the form parser stops and drops what it spooled
+                    too_large = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # Whatever the app answers to a cut-off body is replaced by the 413 below
+            if too_large and not response_started:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not too_large or response_started:
+                raise
+        if too_large and not response_started:
+            await self.refuse(scope, receive, send, max_bytes)
+
+    async def refuse(self, scope, receive, send, max_bytes):
+        response = templates.TemplateResponse(
+            "upload.html",
+            {
+                "request": Request(scope),
+                "error": f"The workbook is larger than the {max_bytes // (1024 * 1024)} MB upload limit"
+            },
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            headers={"Connection": "close"}
+        )
+        await response(scope, receive, send)
+
+app.add_middleware(UploadLimitMiddleware)
+
+def get_user_job(job_id, current_user):
+    """Return the job if it belongs to current_user, raising the matching HTTP error otherwise."""
+    if current_user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    job = job_store.get(job_id)
+    if job is None or job["owner"] != current_user.username:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
+
 # Save HTML templates
 def create_template_files():
     with open(os.path.join(TEMPLATES_DIR, "login.html"), "w") as f:
@@ -707,7 +2000,7 @@ def create_template_files():
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request, current_user: User = Depends(get_current_active_user)):
     if current_user is not None:
-        return templates.TemplateResponse("upload.html", {"request": request})
+        return templates.TemplateResponse("upload.html", {"request": request, "async_jobs": ASYNC_JOBS})
     return templates.TemplateResponse("login.html", {"request": request})
 
 @app.post("/login")
@@ -733,6 +2026,11 @@ async def login(request: Request, username: str = Form(...), password: str = For
     )
     return response
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Stage timings, row/email counters and email queue depth in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/logout")
 async def logout():
     response = RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
@@ -759,20 +2057,50 @@ async def upload_files(
             }
         )
 
-    # Save uploaded file temporarily
-    excel_path = os.path.join(UPLOAD_DIR, excel_file.filename)
+    # Oversized bodies were already refused by UploadLimitMiddleware before the form was parsed
+    excel_path = None
+    keep_excel = False
 
     try:
-        with open(excel_path, "wb") as f:
-            f.write(await excel_file.read())
+        # Save uploaded file temporarily, streamed in chunks to a unique path so concurrent uploads do not collide
+        excel_path = await save_upload(excel_file, UPLOAD_DIR)
 
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         zip_filename = f"employee_documents_{timestamp}.zip"
+
+        if ASYNC_JOBS:
+            # The job owns the uploaded workbook from here on and removes it when done
+            job_id = job_store.create(current_user.username, excel_path, zip_filename)
+            job_executor.submit(run_render_job, job_id, excel_path, zip_filename)
+            keep_excel = True
+            return JSONResponse(
+                {
+                    "job_id": job_id,
+                    "status_url": f"/jobs/{job_id}",
+                    "download_url": f"/jobs/{job_id}/download"
+                },
+                status_code=status.HTTP_202_ACCEPTED
+            )
+
+        if STREAM_DOWNLOADS:
+            # Open the sheet now so a broken workbook still gets the error page;
+            # rows are read while streaming and the upload is removed afterwards
+            reader = open_employee_workbook(excel_path)
+            keep_excel = True
+            background_tasks.add_task(os.remove, excel_path)
+            return StreamingResponse(
+                stream_employee_zip(reader, 'template.pdf', OUTPUT_DIR, resume_key=workbook_run_key(excel_path, 'template.pdf')),
+                media_type="application/zip",
+                headers={"Content-Disposition": f'attachment; filename="{zip_filename}"'},
+                background=background_tasks
+            )
+
         zip_path = merge_employee_data_and_zip(
             excel_path,
             'template.pdf',
             OUTPUT_DIR,
-            zip_name=zip_filename
+            zip_name=zip_filename,
+            allow_shards=False
         )
 
         # Schedule deletion of the ZIP file after sending response
@@ -784,6 +2112,15 @@ async def upload_files(
             media_type="application/zip"
         )
 
+    except UploadTooLarge as e:
+        return templates.TemplateResponse(
+            "upload.html",
+            {
+                "request": request,
+                "error": str(e)
+            },
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        )
     except Exception as e:
         return templates.TemplateResponse(
             "upload.html",
@@ -793,11 +2130,51 @@ async def upload_files(
             }
         )
     finally:
-        if os.path.exists(excel_path):
+        if not keep_excel and excel_path and os.path.exists(excel_path):
             os.remove(excel_path)
 
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, current_user: User = Depends(get_current_active_user)):
+    job = get_user_job(job_id, current_user)
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "rows_total": job["rows_total"],
+        "rows_done": job["rows_done"],
+        "rows_failed": job["rows_failed"],
+        "emails_sent": job["emails_sent"],
+        "emails_failed": job["emails_failed"],
+        "error": job["error"]
+    }
+
+@app.get("/jobs/{job_id}/download")
+async def job_download(
+    job_id: str,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_active_user)
+):
+    job = get_user_job(job_id, current_user)
+    if job["status"] != "done" or not job["artifact_path"] or not os.path.exists(job["artifact_path"]):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Job is {job['status']}, no download available")
+
+    # Same as the synchronous path: the ZIP is removed once it has been sent
+    background_tasks.add_task(os.remove, job["artifact_path"])
+    job_store.update(job_id, artifact_path=None)
+
+    return FileResponse(
+        path=job["artifact_path"],
+        filename=job["artifact_name"],
+        media_type="application/zip"
+    )
+
 # Register the startup event handler and create templates when app starts
+app.add_event_handler("startup", start_logging)
 app.add_event_handler("startup", create_template_files)
+app.add_event_handler("startup", open_job_store)
+app.add_event_handler("shutdown", close_job_store)
+app.add_event_handler("shutdown", close_run_journal)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,340 @@
+import collections
+import concurrent.futures
+import os
+import re
+import struct
+import time
+import zlib
+
+# "stored" copies the letters as they are (they are compressed PDFs already);
+# "deflate" or "deflate:<level 0-9>" trades CPU for a smaller archive.
+ARCHIVE_COMPRESSIONS = ("stored", "deflate")
+DEFAULT_DEFLATE_LEVEL = 6
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIR = struct.Struct("<IHHHHIIH")
+_ZIP64_END_OF_CENTRAL_DIR = struct.Struct("<IQHHIIQQQQ")
+_ZIP64_LOCATOR = struct.Struct("<IIQI")
+
+# Sizes, offsets and entry counts from these limits on go into ZIP64 records, and
+# the classic field holds the sentinel instead (the limits only differ in tests)
+_ZIP64_LIMIT = _ZIP64_SENTINEL = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = _ZIP64_COUNT_SENTINEL = 0xFFFF
+# Bit 11: file names are UTF-8
+_UTF8_FLAG = 0x800
+# Made by Unix, so the 0o600 permissions in the external attributes are honoured
+_MADE_BY_UNIX = 3 << 8
+
+_Entry = collections.namedtuple("_Entry", ["name", "method", "crc", "compressed_size", "size", "offset", "dos_time", "dos_date"])
+
+
+def parse_compression(spec):
+    """Return (method, level) for "stored", "deflate" or "deflate:<level>"."""
+    name, _, level = spec.partition(":")
+    if name not in ARCHIVE_COMPRESSIONS:
+        raise ValueError(f"Unknown archive compression {spec!r}, expected one of {', '.join(ARCHIVE_COMPRESSIONS)}")
+    if name == "stored":
+        if level:
+            raise ValueError("stored archives take no compression level")
+        return ZIP_STORED, None
+    level = int(level) if level else DEFAULT_DEFLATE_LEVEL
+    if not 0 <= level <= 9:
+        raise ValueError(f"Deflate level must be between 0 and 9, got {level}")
+    return ZIP_DEFLATED, level
+
+
+def _compress_entry(data, method, level):
+    """Return (crc, compressed data) of an entry; runs on the compression threads."""
+    crc = zlib.crc32(data)
+    if method == ZIP_STORED:
+        return crc, data
+    # zlib releases the GIL while compressing, so entries are deflated in parallel
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return crc, compressor.compress(data) + compressor.flush()
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ParallelZipWriter:
+    """Write a ZIP archive whose entries are compressed on a thread pool and written in submission order.
+
+    Accepts a path or a write-only file object (such as ZipStreamBuffer); the
+    archive is only ever appended to, since every entry's CRC and sizes are
+    known before its header is written. ZIP64 records are added when the
+    archive outgrows the classic format (over 65,535 entries or 4 GiB).
+    The writestr/write methods mirror zipfile.ZipFile.
+
+    At most max_pending entries are held in memory waiting to be written.
+    Several writers can share one executor, which is then left running by close().
+    """
+
+    def __init__(self, file, compression="stored", workers=4, max_pending=None, executor=None):
+        self.method, self.level = parse_compression(compression)
+        if isinstance(file, (str, bytes)) or hasattr(file, "__fspath__"):
+            self._file = open(file, "wb")
+            self._owns_file = True
+        else:
+            self._file = file
+            self._owns_file = False
+        self._offset = 0
+        self._entries = []
+        self._pending = collections.deque()
+        self._max_pending = max_pending or max(1, workers) * 4
+        # Stored entries only need a CRC, which is not worth a thread hand-off
+        self._executor = None
+        self._owns_executor = executor is None
+        if self.method != ZIP_STORED:
+            if executor is not None:
+                self._executor = executor
+            elif workers > 1:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zip")
+        self._closed = False
+
+    def writestr(self, arcname, data):
+        """Add an entry with the given content (bytes, or str written as UTF-8)."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        timestamp = time.time()
+        if self._executor is None:
+            self._write_entry(arcname, len(data), timestamp, *_compress_entry(data, self.method, self.level))
+            return
+        future = self._executor.submit(_compress_entry, data, self.method, self.level)
+        self._pending.append((arcname, len(data), timestamp, future))
+        self._write_ready()
+
+    def write(self, filename, arcname=None):
+        """Add the file at filename, stored under arcname (its base name by default)."""
+        with open(filename, "rb") as f:
+            data = f.read()
+        self.writestr(arcname or filename.replace("\\", "/").rsplit("/", 1)[-1], data)
+
+    def _write_ready(self, wait_all=False):
+        """Write compressed entries from the head of the queue, waiting while too many are pending."""
+        while self._pending and (wait_all or len(self._pending) > self._max_pending or self._pending[0][3].done()):
+            arcname, size, timestamp, future = self._pending.popleft()
+            self._write_entry(arcname, size, timestamp, *future.result())
+
+    def _write_entry(self, arcname, size, timestamp, crc, data):
+        name = arcname.encode("utf-8")
+        dos_time, dos_date = _dos_datetime(timestamp)
+        compressed_size = len(data)
+
+        extra = b""
+        header_sizes = (compressed_size, size)
+        if size >= _ZIP64_LIMIT or compressed_size >= _ZIP64_LIMIT:
+            extra = struct.pack("<HHQQ", 0x0001, 16, size, compressed_size)
+            header_sizes = (_ZIP64_SENTINEL, _ZIP64_SENTINEL)
+        version = 45 if extra else 20
+
+        header = _LOCAL_HEADER.pack(
+            0x04034B50, version, _UTF8_FLAG, self.method, dos_time, dos_date, crc,
+            *header_sizes, len(name), len(extra)
+        )
+        self._file.write(header + name + extra)
+        self._file.write(data)
+        self._entries.append(_Entry(name, self.method, crc, compressed_size, size, self._offset, dos_time, dos_date))
+        self._offset += len(header) + len(name) + len(extra) + compressed_size
+
+    def _write_central_directory(self):
+        start = self._offset
+        for entry in self._entries:
+            zip64_fields = []
+            size, compressed_size, offset = entry.size, entry.compressed_size, entry.offset
+            if size >= _ZIP64_LIMIT:
+                zip64_fields.append(size)
+                size = _ZIP64_SENTINEL
+            if compressed_size >= _ZIP64_LIMIT:
+                zip64_fields.append(compressed_size)
+                compressed_size = _ZIP64_SENTINEL
+            if offset >= _ZIP64_LIMIT:
+                zip64_fields.append(offset)
+                offset = _ZIP64_SENTINEL
+            extra = b""
+            if zip64_fields:
+                extra = struct.pack(f"<HH{len(zip64_fields)}Q", 0x0001, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if extra else 20
+
+            header = _CENTRAL_HEADER.pack(
+                0x02014B50, _MADE_BY_UNIX | version, version, _UTF8_FLAG, entry.method, entry.dos_time,
+                entry.dos_date, entry.crc, compressed_size, size, len(entry.name), len(extra), 0, 0, 0,
+                0o600 << 16, offset
+            )
+            self._file.write(header + entry.name + extra)
+            self._offset += len(header) + len(entry.name) + len(extra)
+
+        count = len(self._entries)
+        directory_size = self._offset - start
+        if count >= _ZIP64_COUNT_LIMIT or start >= _ZIP64_LIMIT or directory_size >= _ZIP64_LIMIT:
+            zip64_end = self._offset
+            self._file.write(_ZIP64_END_OF_CENTRAL_DIR.pack(
+                0x06064B50, _ZIP64_END_OF_CENTRAL_DIR.size - 12, _MADE_BY_UNIX | 45, 45, 0, 0,
+                count, count, directory_size, start
+            ))
+            self._file.write(_ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_end, 1))
+            if count >= _ZIP64_COUNT_LIMIT:
+                count = _ZIP64_COUNT_SENTINEL
+            if start >= _ZIP64_LIMIT:
+                start = _ZIP64_SENTINEL
+            if directory_size >= _ZIP64_LIMIT:
+                directory_size = _ZIP64_SENTINEL
+        self._file.write(_END_OF_CENTRAL_DIR.pack(0x06054B50, 0, 0, count, count, directory_size, start, 0))
+
+    def close(self):
+        """Write the remaining entries and the central directory."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._write_ready(wait_all=True)
+            self._write_central_directory()
+            self._file.flush()
+        finally:
+            if self._executor is not None and self._owns_executor:
+                self._executor.shutdown(wait=True)
+            if self._owns_file:
+                self._file.close()
+
+    def abort(self):
+        """Stop without finishing the archive, e.g. after an error."""
+        self._closed = True
+        if self._executor is not None and self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        for _arcname, _size, _timestamp, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Local and central header bytes of an entry, besides its name
+_ENTRY_OVERHEAD = _LOCAL_HEADER.size + _CENTRAL_HEADER.size
+
+
+class _Shard:
+    def __init__(self, name, writer):
+        self.name = name
+        self.writer = writer
+        self.entries = 0
+        self.size = 0
+
+
+def _shard_label(group):
+    # Groups are column values, so they are reduced to something safe in a file name
+    return re.sub(r"[^\w-]+", "_", str(group)).strip("_") or "none"
+
+
+class ShardedZipWriter:
+    """Spread entries over several ZIP archives in directory instead of one.
+
+    Shards are named <stem>_<n>.zip, or <stem>_<group>_<n>.zip for entries
+    written with a group; every group gets shards of its own. A shard is
+    closed and the next one started when it holds max_entries entries or
+    the next entry would take it past max_bytes (entries are counted at
+    their uncompressed size, so deflated shards come out smaller). The
+    current shard of every group stays open, so the shards fill side by
+    side as entries arrive, and they share one pool of compression threads.
+
+    writestr/write return the file name of the shard the entry went to.
+    paths lists every shard written and index_path is where the caller's
+    index of them belongs.
+    """
+
+    def __init__(self, directory, stem, compression="stored", workers=4, max_bytes=None, max_entries=None):
+        method, _level = parse_compression(compression)
+        self.directory = directory
+        self.stem = stem
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.index_path = os.path.join(directory, f"{stem}_index.csv")
+        self.paths = []
+        self._workers = workers
+        self._open = {}
+        self._numbers = collections.Counter()
+        self._executor = None
+        if method != ZIP_STORED and workers > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zip")
+
+    def _is_full(self, shard, size):
+        if not shard.entries:
+            # An entry larger than max_bytes still gets a shard, on its own
+            return False
+        if self.max_entries and shard.entries >= self.max_entries:
+            return True
+        return bool(self.max_bytes) and shard.size + size > self.max_bytes
+
+    def _shard(self, group, size):
+        shard = self._open.get(group)
+        if shard is not None and self._is_full(shard, size):
+            shard.writer.close()
+            shard = None
+        if shard is None:
+            label = self.stem if group is None else f"{self.stem}_{_shard_label(group)}"
+            # Numbered per label, so groups that reduce to the same label cannot collide
+            self._numbers[label] += 1
+            name = f"{label}_{self._numbers[label]:03d}.zip"
+            path = os.path.join(self.directory, name)
+            shard = _Shard(name, ParallelZipWriter(path, self.compression, self._workers, executor=self._executor))
+            self._open[group] = shard
+            self.paths.append(path)
+        return shard
+
+    def writestr(self, arcname, data, group=None):
+        """Add an entry to the current shard of group."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        size = len(data) + _ENTRY_OVERHEAD + 2 * len(arcname.encode("utf-8"))
+        shard = self._shard(group, size)
+        shard.writer.writestr(arcname, data)
+        shard.entries += 1
+        shard.size += size
+        return shard.name
+
+    def write(self, filename, arcname=None, group=None):
+        """Add the file at filename to the current shard of group."""
+        with open(filename, "rb") as f:
+            data = f.read()
+        return self.writestr(arcname or filename.replace("\\", "/").rsplit("/", 1)[-1], data, group)
+
+    def close(self):
+        """Finish every open shard."""
+        try:
+            for shard in self._open.values():
+                shard.writer.close()
+            self._open.clear()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def abort(self):
+        """Stop without finishing the open shards."""
+        for shard in self._open.values():
+            shard.writer.abort()
+        self._open.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,149 @@
+"""Render appraisal letters for a workbook from the command line.
+
+    python batch.py render employee_data.xlsx --template template.pdf --output output --workers 8
+    python batch.py render employee_data.xlsx --shard 2/3
+    python batch.py merge output/employee_documents.zip output/*_shard*of3.zip
+    python batch.py render employee_data.xlsx --queue --queue-workers 4
+    python batch.py work --queue-db /srv/queue/work_queue.sqlite3
+
+--shard i/n renders every n-th row of the sheet, starting at row i. n machines
+given the same workbook and template, one per shard, cover every row exactly
+once; their archives hold distinct letters, and merge combines them (and their
+error reports) into a single archive. Rows with an Email Id are emailed by the
+shard that renders them.
+
+--queue splits the workbook into tasks on the durable work queue
+(--queue-db, app.WORK_QUEUE_DB by default) and assembles the ZIP once they are
+all done; "work" starts one more worker process on the same queue, and exits
+when nothing is left to claim. Queued runs write an email manifest instead of
+sending. Workers on several hosts must be given the same --queue-db, on a disk
+they all reach; SQLite's locking is not reliable on network filesystems (NFS,
+SMB), so the queue file must not sit on one.
+"""
+import argparse
+import csv
+import datetime
+import io
+import os
+import sys
+import zipfile
+
+from archive import ARCHIVE_COMPRESSIONS, ParallelZipWriter
+from run_journal import error_report_csv
+from structured_logging import configure_logging
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Name of the render failure report inside an archive
+ERROR_REPORT_NAME = "error_report.csv"
+
+
+def parse_shard(spec):
+    """Return the zero-based (index, count) of an "i/n" shard, 1 <= i <= n."""
+    try:
+        number, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n, e.g. 2/4, got {spec!r}")
+    if not 1 <= number <= count:
+        raise argparse.ArgumentTypeError(f"shard {number} is not between 1 and {count}")
+    return number - 1, count
+
+
+def render(args):
+    workbook = os.path.abspath(args.workbook)
+    template = os.path.abspath(args.template)
+    output = os.path.abspath(args.output)
+
+    # The app module resolves static/, templates/ and its own output/ relative to the working directory
+    os.chdir(ROOT)
+    import app
+
+    zip_name = args.zip_name
+    if zip_name is None:
+        today = datetime.datetime.now().strftime("%Y%m%d")
+        suffix = f"_shard{args.shard[0] + 1}of{args.shard[1]}" if args.shard else ""
+        zip_name = f"employee_documents_{today}{suffix}.zip"
+
+    path = app.merge_employee_data_and_zip(
+        workbook, template, output,
+        zip_name=zip_name,
+        options=app.RenderOptions(
+            mode=args.render_mode,
+            use_cache=False if args.no_cache else None,
+            compression=args.compression,
+            workers=args.workers
+        ),
+        chunk_size=args.chunk_size,
+        row_shard=args.shard,
+        work_queue=args.queue,
+        queue_workers=args.queue_workers,
+        queue_db=args.queue_db
+    )
+    print(path)
+
+
+def work(args):
+    os.chdir(ROOT)
+    import app
+
+    done = app.run_queue_worker(args.run, workers=args.workers or 1, queue_db=args.queue_db)
+    print(f"{done} task(s) done")
+
+
+def merge(args):
+    """Combine shard archives into one, with a single error report sorted by row."""
+    errors = []
+    with ParallelZipWriter(args.output, args.compression) as target:
+        for path in args.archives:
+            with zipfile.ZipFile(path) as source:
+                for info in source.infolist():
+                    data = source.read(info)
+                    if info.filename == ERROR_REPORT_NAME:
+                        errors.extend(csv.DictReader(io.StringIO(data.decode("utf-8"))))
+                    else:
+                        target.writestr(info.filename, data)
+        if errors:
+            errors.sort(key=lambda error: int(error["row"]))
+            target.writestr(ERROR_REPORT_NAME, error_report_csv(errors))
+    print(args.output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    render_parser = commands.add_parser("render", help="render a workbook's letters into a ZIP")
+    render_parser.add_argument("workbook", help="employee workbook (.xlsx)")
+    render_parser.add_argument("--template", default=os.path.join(ROOT, "template.pdf"))
+    render_parser.add_argument("--output", default="output", help="folder the ZIP and error report are written to")
+    render_parser.add_argument("--zip-name", help="archive file name (default: employee_documents_<date>[_shard<i>of<n>].zip)")
+    render_parser.add_argument("--workers", type=int, help="render processes (default: app.RENDER_WORKERS)")
+    render_parser.add_argument("--chunk-size", type=int, help="rows read from the workbook at a time (default: app.READ_CHUNK_SIZE)")
+    render_parser.add_argument("--shard", type=parse_shard, metavar="I/N", help="render only every N-th row, starting at row I")
+    render_parser.add_argument("--render-mode", choices=("redact", "overlay"), help="default: app.RENDER_MODE")
+    render_parser.add_argument("--compression", help=f"one of {', '.join(ARCHIVE_COMPRESSIONS)}, or deflate:<level>")
+    render_parser.add_argument("--no-cache", action="store_true", help="render every letter even if it is in the render cache")
+    render_parser.add_argument("--queue", action="store_true", help="render through the durable work queue")
+    render_parser.add_argument("--queue-workers", type=int, help="local queue worker processes (default: app.QUEUE_WORKERS)")
+    render_parser.add_argument("--queue-db", type=os.path.abspath, help="work queue file (default: app.WORK_QUEUE_DB); not on a network filesystem")
+    render_parser.set_defaults(handler=render)
+
+    work_parser = commands.add_parser("work", help="render tasks from the work queue until none are left")
+    work_parser.add_argument("--run", help="only take tasks of this queue run")
+    work_parser.add_argument("--workers", type=int, help="render processes per task (default: 1)")
+    work_parser.add_argument("--queue-db", type=os.path.abspath, help="work queue file (default: app.WORK_QUEUE_DB); not on a network filesystem")
+    work_parser.set_defaults(handler=work)
+
+    merge_parser = commands.add_parser("merge", help="combine the archives of several shards into one")
+    merge_parser.add_argument("output", help="archive to write")
+    merge_parser.add_argument("archives", nargs="+", help="shard archives to combine")
+    merge_parser.add_argument("--compression", default="stored", help=f"one of {', '.join(ARCHIVE_COMPRESSIONS)}, or deflate:<level>")
+    merge_parser.set_defaults(handler=merge)
+
+    args = parser.parse_args(argv)
+    configure_logging("INFO", json_format=False)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
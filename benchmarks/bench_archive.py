@@ -0,0 +1,66 @@
+"""Compare archive size and assembly time of the ZIP compression settings.
+
+Run from the repository root:
+
+    python benchmarks/bench_archive.py [template.pdf] [letters]
+
+A sample of distinct letters is rendered once and then written repeatedly, so
+only archive assembly is timed.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archive import ParallelZipWriter  # noqa: E402
+from bench_render_modes import SAMPLE_REPLACEMENTS  # noqa: E402
+from pdf_template import load_template, render_letter  # noqa: E402
+
+COMPRESSIONS = ("stored", "deflate:1", "deflate:6", "deflate:9")
+WORKER_COUNTS = (1, 4)
+SAMPLE_LETTERS = 50
+
+
+def render_sample(template):
+    """Render SAMPLE_LETTERS letters that differ in name and employee ID."""
+    letters = []
+    for i in range(SAMPLE_LETTERS):
+        replacements = dict(SAMPLE_REPLACEMENTS, **{'[Employee ID]': f'AW{1000 + i}', '[Name]': f'Employee {i}'})
+        letters.append(render_letter(template, replacements))
+    return letters
+
+
+def time_archive(letters, count, compression, workers, path):
+    """Return (seconds, archive bytes) of writing count letters with compression on workers threads."""
+    start = time.perf_counter()
+    with ParallelZipWriter(path, compression, workers) as zipf:
+        for i in range(count):
+            zipf.writestr(f"letter_{i}.pdf", letters[i % len(letters)])
+    return time.perf_counter() - start, os.path.getsize(path)
+
+
+def main():
+    pdf_template = sys.argv[1] if len(sys.argv) > 1 else "template.pdf"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    letters = render_sample(load_template(pdf_template, SAMPLE_REPLACEMENTS))
+    raw_bytes = sum(len(letters[i % len(letters)]) for i in range(count))
+    print(f"{count} letters, {raw_bytes / 1e6:.1f} MB uncompressed")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for compression in COMPRESSIONS:
+            for workers in WORKER_COUNTS:
+                if compression == "stored" and workers > 1:
+                    # Stored entries are never handed to the thread pool
+                    continue
+                seconds, size = time_archive(letters, count, compression, workers, os.path.join(output_dir, "bench.zip"))
+                print(
+                    f"{compression:>10} x{workers}: {size / 1e6:8.1f} MB ({size / raw_bytes:6.1%}) "
+                    f"in {seconds:6.2f}s ({count / seconds:8.1f} letters/s)"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Time every stage of letter generation on synthetic workbooks and save the results as JSON.
+
+Run from the repository root:
+
+    python benchmarks/bench_pipeline.py --rows 1000 10000 100000
+    python benchmarks/bench_pipeline.py --rows 1000 --cases app_merge inc_merge --compare old.json
+    python benchmarks/bench_pipeline.py --cases save_profile_fast save_profile_compact
+
+Each case runs in a fresh process so its peak RSS is its own. The per-letter
+cases (process_record, replace_text_in_pdf, save_profile_<profile>) render the
+first --sample rows; the save profile cases also report bytes_per_letter and
+save_seconds_per_letter. The merge cases render the whole workbook. The generated workbooks have no
+email addresses, so nothing is sent.
+"""
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic_workbook import generate_workbook  # noqa: E402
+
+
+def _peak_rss_mb(children=False):
+    """Peak resident set size in MB of this process or of its largest child, None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _sample_frame(workbook, sample):
+    import pandas as pd
+    return pd.read_excel(workbook, nrows=sample)
+
+
+def bench_format_indian_currency(workbook, template, work_dir, options):
+    import app
+    import pandas as pd
+    df = pd.read_excel(workbook)
+    values = [value for column in app.CURRENCY_COLUMNS if column in df.columns for value in df[column].tolist()]
+
+    start = time.perf_counter()
+    for value in values:
+        app.format_indian_currency(value)
+    return len(values), "values", time.perf_counter() - start
+
+
+def bench_format_currency_columns(workbook, template, work_dir, options):
+    import app
+    import pandas as pd
+    df = pd.read_excel(workbook)
+
+    start = time.perf_counter()
+    app.format_currency_columns(df)
+    return len(df) * len(app.CURRENCY_COLUMNS), "values", time.perf_counter() - start
+
+
+def bench_process_record(workbook, template, work_dir, options):
+    import app
+    rows = _sample_frame(workbook, options["sample"]).to_dict("records")
+    current_date = datetime.datetime.now().strftime("%B %d, %Y")
+    compiled = app.load_template(template, app.TEMPLATE_SEARCH_KEYS, app.CONDITIONAL_SECTIONS)
+
+    start = time.perf_counter()
+    for row in rows:
+        app.process_record(row, compiled, None, current_date, app.placeholder_mapping, app.RENDER_MODE)
+    return len(rows), "letters", time.perf_counter() - start
+
+
+def bench_replace_text_in_pdf(workbook, template, work_dir, options):
+    import app
+    current_date = datetime.datetime.now().strftime("%B %d, %Y")
+    records = list(app.prepare_records(_sample_frame(workbook, options["sample"]), current_date, app.placeholder_mapping))
+    compiled = app.load_template(template, app.TEMPLATE_SEARCH_KEYS, app.CONDITIONAL_SECTIONS)
+
+    start = time.perf_counter()
+    for record in records:
+        app.replace_text_in_pdf(
+            compiled, dict(record.replacements), None, record.texts_to_remove, record.dynamic_column_value,
+            record.bonus_column_value, record.bonus_column_value2, app.RENDER_MODE
+        )
+    return len(records), "letters", time.perf_counter() - start
+
+
+def bench_save_profile(profile, workbook, template, work_dir, options):
+    """Render the sample rows with one save profile, measuring the letters' size and the time spent saving them."""
+    import app
+    import metrics
+    from pdf_template import render_letter
+    current_date = datetime.datetime.now().strftime("%B %d, %Y")
+    records = list(app.prepare_records(_sample_frame(workbook, options["sample"]), current_date, app.placeholder_mapping))
+    compiled = app.load_template(template, app.TEMPLATE_SEARCH_KEYS, app.CONDITIONAL_SECTIONS)
+    letters = [
+        app.letter_replacements(
+            dict(record.replacements), record.texts_to_remove, record.dynamic_column_value,
+            record.bonus_column_value, record.bonus_column_value2
+        )
+        for record in records
+    ]
+    # Warm up once so an overlay base is built outside the timed loop
+    render_letter(compiled, dict(letters[0]), mode=app.RENDER_MODE, layout=app.TEXT_LAYOUT, profile=profile)
+
+    totals = {}
+    size = 0
+    metrics.set_run_totals(totals)
+    start = time.perf_counter()
+    try:
+        for replacements in letters:
+            size += len(render_letter(compiled, replacements, mode=app.RENDER_MODE, layout=app.TEXT_LAYOUT, profile=profile))
+    finally:
+        metrics.set_run_totals(None)
+    seconds = time.perf_counter() - start
+    return len(letters), "letters", seconds, {
+        "bytes_per_letter": size / len(letters),
+        "save_seconds_per_letter": totals.get("save", 0.0) / len(letters),
+    }
+
+
+def bench_zip_assembly(workbook, template, work_dir, options):
+    """Write one ZIP entry per workbook row, reusing a sample of rendered letters so only the archive is timed."""
+    import app
+    from archive import ParallelZipWriter
+    current_date = datetime.datetime.now().strftime("%B %d, %Y")
+    records = list(app.prepare_records(_sample_frame(workbook, options["sample"]), current_date, app.placeholder_mapping))
+    compiled = app.load_template(template, app.TEMPLATE_SEARCH_KEYS, app.CONDITIONAL_SECTIONS)
+    letters = [app.render_prepared_record(record, compiled, None, app.RENDER_MODE)[0] for record in records]
+
+    start = time.perf_counter()
+    with ParallelZipWriter(os.path.join(work_dir, "assembly.zip"), app.ARCHIVE_COMPRESSION, app.ARCHIVE_WORKERS) as zipf:
+        for index in range(options["rows"]):
+            zipf.writestr(f"letter_{index}.pdf", letters[index % len(letters)])
+    return options["rows"], "letters", time.perf_counter() - start
+
+
+def bench_app_merge(workbook, template, work_dir, options):
+    import app
+    start = time.perf_counter()
+    # The render cache would turn repeated runs into cache reads
+    app.merge_employee_data_and_zip(
+        workbook, template, work_dir, zip_name="app.zip",
+        options=app.RenderOptions(use_cache=False, workers=options["workers"])
+    )
+    return options["rows"], "letters", time.perf_counter() - start
+
+
+def bench_inc_merge(workbook, template, work_dir, options):
+    import inc
+    start = time.perf_counter()
+    inc.merge_employee_data_and_zip(workbook, template, work_dir, zip_name="inc.zip")
+    return options["rows"], "letters", time.perf_counter() - start
+
+
+def bench_inc_with_mail_merge(workbook, template, work_dir, options):
+    import inc_with_mail
+    start = time.perf_counter()
+    inc_with_mail.merge_employee_data_and_zip(workbook, template, work_dir, zip_name="inc_with_mail.zip")
+    return options["rows"], "letters", time.perf_counter() - start
+
+
+CASES = {
+    "format_indian_currency": bench_format_indian_currency,
+    "format_currency_columns": bench_format_currency_columns,
+    "process_record": bench_process_record,
+    "replace_text_in_pdf": bench_replace_text_in_pdf,
+    "zip_assembly": bench_zip_assembly,
+    # One case per pdf_template.SAVE_PROFILES entry, named here so listing the cases does not load PyMuPDF
+    **{f"save_profile_{profile}": functools.partial(bench_save_profile, profile) for profile in ("fast", "compact", "smallest", "web")},
+    "app_merge": bench_app_merge,
+    "inc_merge": bench_inc_merge,
+    "inc_with_mail_merge": bench_inc_with_mail_merge,
+}
+
+
+def _run_case(name, workbook, template, options, results):
+    """Run one case in this (fresh) process and put its measurements on the results queue."""
+    # The app modules resolve static/, uploads/ and output/ relative to the working directory
+    os.chdir(ROOT)
+    baseline = _peak_rss_mb()
+    with tempfile.TemporaryDirectory() as work_dir, contextlib.redirect_stdout(io.StringIO()):
+        # A case may return a dict of extra measurements after its timing
+        items, unit, seconds, *extra = CASES[name](workbook, template, work_dir, options)
+    results.put({
+        **(extra[0] if extra else {}),
+        "items": items,
+        "unit": unit,
+        "seconds": seconds,
+        "per_second": items / seconds if seconds else None,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": _peak_rss_mb(),
+        "peak_child_rss_mb": _peak_rss_mb(children=True),
+    })
+
+
+def run_case(name, workbook, template, options):
+    """Run a case in a spawned process and return its measurements, or an error entry."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run_case, args=(name, workbook, template, options, results))
+    process.start()
+    process.join()
+    if results.empty():
+        return {"error": f"exited with code {process.exitcode}"}
+    return results.get()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the throughput of each case against the same case in an earlier results file."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["case"], r["rows"]): r for r in baseline["results"] if r.get("per_second")}
+    print(f"\nCompared with {baseline.get('commit') or baseline_path}:")
+    for result in results:
+        before = previous.get((result["case"], result["rows"]))
+        if before and result.get("per_second"):
+            print(f"{result['case']:>24} {result['rows']:>7}: {result['per_second'] / before['per_second']:6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000], help="workbook sizes, e.g. 1000 10000 100000")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--template", default=os.path.join(ROOT, "template.pdf"))
+    parser.add_argument("--sample", type=int, default=200, help="rows rendered by the per-letter cases")
+    parser.add_argument("--workers", type=int, default=None, help="render workers for app_merge (default: app.RENDER_WORKERS)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare throughput against")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"{(commit or 'unknown')[:12]}.json")
+    template = os.path.abspath(args.template)
+
+    results = []
+    with tempfile.TemporaryDirectory() as workbook_dir:
+        for rows in args.rows:
+            workbook = os.path.join(workbook_dir, f"employees_{rows}.xlsx")
+            generate_workbook(workbook, rows, seed=args.seed)
+            options = {"rows": rows, "sample": min(args.sample, rows), "workers": args.workers}
+
+            for name in args.cases:
+                result = {"case": name, "rows": rows, **run_case(name, workbook, template, options)}
+                results.append(result)
+                if "error" in result:
+                    print(f"{name:>24} {rows:>7}: failed, {result['error']}")
+                    continue
+                peak = f"{result['peak_rss_mb']:8.1f} MB" if result["peak_rss_mb"] is not None else "     n/a"
+                size = f", {result['bytes_per_letter'] / 1024:.1f} KB/letter" if "bytes_per_letter" in result else ""
+                print(
+                    f"{name:>24} {rows:>7}: {result['per_second']:10.1f} {result['unit']}/s "
+                    f"({result['items']} in {result['seconds']:.2f}s), peak RSS {peak}{size}"
+                )
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "template": os.path.basename(template),
+            "seed": args.seed,
+            "results": results,
+        }, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
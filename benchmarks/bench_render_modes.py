@@ -0,0 +1,64 @@
+"""Compare per-letter render time of the "redact" and "overlay" render modes.
+
+Run from the repository root:
+
+    python benchmarks/bench_render_modes.py [template.pdf] [letters]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_template import RENDER_MODES, load_template, render_letter  # noqa: E402
+
+SAMPLE_REPLACEMENTS = {
+    '[Date]': 'March 31, 2025',
+    '[Employee ID]': 'AW1042',
+    '[Name]': 'Priya Sharma',
+    '[Employee Department]': 'Engineering',
+    '[Employee Title]': 'Senior Software Engineer',
+    '[Employee Type]': 'Full Time',
+    '[Bonus in INR]': 'INR 1,25,000.00',
+    '[Basic in INR]': 'INR 7,50,000.00',
+    '[HRA in INR]': 'INR 3,75,000.00',
+    '[Other Allowance in INR]': 'INR 2,10,000.00',
+    '[Provident Fund in INR]': 'INR 90,000.00',
+    '[Company Deposit in INR]': 'INR 21,600.00',
+    '[Total Fixed in INR]': 'INR 14,46,600.00',
+    '[Target in INR]': 'INR 1,50,000.00',
+    '[Total CTC in INR]': 'INR 15,96,600.00',
+    '[-]': '',
+    '[--]': '',
+    '[Any other employee-specific details that need to be covered in Appraisal Letter]': '',
+}
+
+
+def time_mode(template, mode, letters, output_dir):
+    """Return the mean seconds per letter for mode."""
+    # Warm up once so the overlay base is built outside the timed loop, as in a real run
+    render_letter(template, dict(SAMPLE_REPLACEMENTS), os.path.join(output_dir, "warmup.pdf"), mode=mode)
+
+    start = time.perf_counter()
+    for i in range(letters):
+        render_letter(template, dict(SAMPLE_REPLACEMENTS), os.path.join(output_dir, f"{mode}_{i}.pdf"), mode=mode)
+    return (time.perf_counter() - start) / letters
+
+
+def main():
+    pdf_template = sys.argv[1] if len(sys.argv) > 1 else "template.pdf"
+    letters = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    template = load_template(pdf_template, SAMPLE_REPLACEMENTS)
+    results = {}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for mode in RENDER_MODES:
+            results[mode] = time_mode(template, mode, letters, output_dir)
+            print(f"{mode:>8}: {results[mode] * 1000:8.2f} ms/letter ({1 / results[mode]:7.1f} letters/s)")
+
+    print(f"Overlay speedup: {results['redact'] / results['overlay']:.2f}x over {letters} letters")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Generate synthetic employee workbooks with the columns app.py, inc.py and inc_with_mail.py read.
+
+Run from the repository root:
+
+    python benchmarks/synthetic_workbook.py [rows] [output.xlsx]
+
+The mix of SDR text, comments and blank bonus cells follows the ratios in
+DEFAULT_MIX, and the same seed always produces the same sheet. Email Id is
+left empty unless an email domain is given, so benchmark runs never send mail.
+"""
+import random
+import sys
+
+import openpyxl
+
+COLUMNS = [
+    'Emp ID', 'Name', 'Department', 'Employee Title', 'Employee Type', '2024 Bonus', 'Basic Salary', 'HRA',
+    'Other Allowences', 'Provident Fund', 'Company Deposit', 'Total Fixed', 'Bonus 2025 (At Target)',
+    'Total CTC', 'For SDR only', 'Comments (Optional)', 'Email Id'
+]
+
+# Share of rows with SDR text, with comments, with a blank 2024 bonus and with a blank target bonus
+DEFAULT_MIX = {"sdr": 0.1, "comments": 0.25, "no_bonus": 0.15, "no_target": 0.1}
+
+FIRST_NAMES = [
+    'Aarav', 'Priya', 'Rohan', 'Ananya', 'Vikram', 'Sneha', 'Arjun', 'Kavya', 'Rahul', 'Meera',
+    'Siddharth', 'Ishita', 'Karthik', 'Neha', 'Aditya', 'Pooja', 'Venkatesh', 'Lakshmi', 'Harpreet', 'Farhan'
+]
+LAST_NAMES = [
+    'Sharma', 'Iyer', 'Reddy', 'Patel', 'Nair', 'Gupta', 'Menon', 'Singh', 'Khan', 'Das',
+    'Subramanian', 'Chatterjee', 'Kulkarni', 'Bhattacharya', 'Fernandes', 'Rao', 'Joshi', 'Mehta'
+]
+DEPARTMENTS = ['Engineering', 'Sales', 'Marketing', 'Finance', 'Human Resources', 'Customer Success', 'Operations']
+TITLES = [
+    'Software Engineer', 'Senior Software Engineer', 'Staff Engineer', 'Sales Development Representative',
+    'Account Executive', 'Marketing Manager', 'Financial Analyst', 'HR Business Partner',
+    'Customer Success Manager', 'Principal Engineer, Platform Infrastructure and Developer Productivity'
+]
+EMPLOYEE_TYPES = ['Full Time', 'Full Time', 'Full Time', 'Contract', 'Intern']
+SDR_NOTES = [
+    'Your quarterly SDR incentive will continue as per the FY25 plan.',
+    'SDR accelerators apply once 120% of the pipeline target is reached.',
+]
+COMMENTS = [
+    'Congratulations on your promotion.',
+    'Your relocation allowance will be paid with the April payroll.',
+    'Thank you for leading the platform migration this year.',
+]
+# Cells HR leaves in place of a bonus that does not apply
+BLANK_BONUS_VALUES = [None, '', 'NA', 'N/A']
+
+
+def employee_row(index, rng, mix=DEFAULT_MIX, email_domain=None):
+    """Return one row of values in COLUMNS order."""
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    basic = round(rng.uniform(300000, 2500000), -3)
+    hra = round(basic * 0.5, 2)
+    other = round(rng.uniform(50000, 600000), 2)
+    provident_fund = round(basic * 0.12, 2)
+    company_deposit = round(basic * 0.0288, 2)
+    total_fixed = round(basic + hra + other + provident_fund + company_deposit, 2)
+    target = round(total_fixed * rng.choice([0.1, 0.15, 0.2]), 2)
+
+    bonus = rng.choice(BLANK_BONUS_VALUES) if rng.random() < mix["no_bonus"] else round(rng.uniform(0, target), 2)
+    if rng.random() < mix["no_target"]:
+        target = rng.choice(BLANK_BONUS_VALUES)
+    sdr = rng.choice(SDR_NOTES) if rng.random() < mix["sdr"] else None
+    comments = rng.choice(COMMENTS) if rng.random() < mix["comments"] else None
+    email = f"{first}.{last}{index}@{email_domain}".lower() if email_domain else None
+
+    return [
+        f"AW{index + 1:06d}", f"{first} {last}", rng.choice(DEPARTMENTS), rng.choice(TITLES),
+        rng.choice(EMPLOYEE_TYPES), bonus, basic, hra, other, provident_fund, company_deposit, total_fixed,
+        target, total_fixed + (target if isinstance(target, float) else 0), sdr, comments, email
+    ]
+
+
+def generate_workbook(path, rows, seed=0, mix=DEFAULT_MIX, email_domain=None):
+    """Write a workbook of rows synthetic employees to path and return the path."""
+    rng = random.Random(seed)
+    # Write-only mode streams rows to disk, so 100k-row sheets stay cheap to build
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Employees")
+    sheet.append(COLUMNS)
+    for index in range(rows):
+        sheet.append(employee_row(index, rng, mix, email_domain))
+    workbook.save(path)
+    return path
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    path = sys.argv[2] if len(sys.argv) > 2 else f"employees_{rows}.xlsx"
+    generate_workbook(path, rows)
+    print(f"Wrote {rows} rows to {path}")
+
+
+if __name__ == "__main__":
+    main()
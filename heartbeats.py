@@ -0,0 +1,108 @@
+import contextlib
+import datetime
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+# Rows of a SQLite table that belong to a process carry its owner ID and a
+# heartbeat (time.time()) that the process keeps fresh while it runs. A row
+# whose heartbeat is older than the stale limit, or missing, was left behind by
+# a process that stopped, and may be taken over by another one.
+
+# How often an owner refreshes its rows' heartbeat, and how old a heartbeat may get before its owner counts as gone
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 60
+
+
+def now_stamp():
+    """The current local time as an ISO timestamp, for created_at/updated_at columns."""
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def owner_id():
+    """A new owner ID, unique across hosts and processes: host:pid:random."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+@contextlib.contextmanager
+def connect(db_path):
+    """Open a connection that commits on success and is always closed."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def refresh(conn, table, owner_column, owner, statuses):
+    """Set the heartbeat of owner's rows of table whose status is one of statuses. Returns how many."""
+    marks = ", ".join("?" * len(statuses))
+    return conn.execute(
+        f"UPDATE {table} SET heartbeat = ? WHERE {owner_column} = ? AND status IN ({marks})",
+        (time.time(), owner, *statuses)
+    ).rowcount
+
+
+def expire_stale(conn, table, owner_column, owner, statuses, stale_seconds, fields, where="", params=()):
+    """Set fields on other owners' rows of table in statuses whose heartbeat is stale or missing. Returns how many.
+
+    where, an extra SQL condition with its params, narrows the rows further.
+    """
+    marks = ", ".join("?" * len(statuses))
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    condition = f" AND ({where})" if where else ""
+    return conn.execute(
+        f"UPDATE {table} SET {assignments} WHERE status IN ({marks}) AND {owner_column} IS NOT ? "
+        f"AND (heartbeat IS NULL OR heartbeat < ?){condition}",
+        (*fields.values(), *statuses, owner, time.time() - stale_seconds, *params)
+    ).rowcount
+
+
+class Heartbeat:
+    """Calls beat every interval seconds on a daemon thread, from start() until stop().
+
+    stop() sets the thread's stop event and waits for it to finish; a later
+    start() begins a new thread. A database error in beat is retried on the
+    next beat.
+    """
+
+    def __init__(self, beat, interval=HEARTBEAT_SECONDS, name="heartbeat"):
+        self.beat = beat
+        self.interval = interval
+        self.name = name
+        self._lock = threading.Lock()
+        self._stopped = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stopped,), name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self, stopped):
+        while not stopped.wait(self.interval):
+            try:
+                self.beat()
+            except sqlite3.Error:
+                # A locked or briefly unavailable database is retried on the next beat
+                pass
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopped.set()
+        if thread is not threading.current_thread():
+            thread.join()
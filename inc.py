@@ -1,50 +1,27 @@
 import pandas as pd
-import fitz  # PyMuPDF
 import re
 import os
-import zipfile
+from archive import ParallelZipWriter
 import datetime
 import shutil
+import logging
+from pdf_template import load_template, render_letter_bytes, replace_text_in_pdf
+from structured_logging import configure_logging
+from workbook_reader import WorkbookReader
 
-def replace_text_in_pdf(pdf_path, replacements, output_pdf):
-    """Replace placeholders in a PDF by redacting old text and inserting new text at the exact position."""
-    doc = fitz.open(pdf_path)
-    
-    for page in doc:
-        for key, value in replacements.items():
-            text_instances = page.search_for(key)
-            for inst in text_instances:
-                # Redact the placeholder text
-                page.add_redact_annot(inst, text="", fill=(1, 1, 1))  # White fill
-                page.apply_redactions()
-                
-                # Calculate the baseline position of the placeholder text
-                baseline_x = inst.x0  # Left edge of the placeholder
-                baseline_y = inst.y1 - 4  # Adjust for baseline alignment (4 is a small offset for better alignment)
-                
-                # Special handling for [Employee Type] if needed
-                if key == "[Employee Type]":
-                    baseline_y = inst.y1 - 2  # Adjust offset specifically for this placeholder
-                
-                # Insert the new text at the same position
-                page.insert_text(
-                    (baseline_x, baseline_y),
-                    value,
-                    fontsize=10,  # Adjust to match your template's font size
-                    color=(0, 0, 0),
-                    fontname="helv",  # Adjust to match your template's font if known
-                )
-    
-    doc.save(output_pdf)
-    doc.close()
+logger = logging.getLogger(__name__)
 
-def merge_employee_data_and_zip(excel_file, pdf_template, output_folder, zip_name=None, batch_size=50):
+def merge_employee_data_and_zip(excel_file, pdf_template, output_folder, zip_name=None, batch_size=50, render_mode="overlay", in_memory=True, render_cache=None, compression="stored", save_profile=None):
     """
     Read employee data from Excel, replace placeholders in PDF document,
     and create a single zip file containing all documents.
+
+    With a RenderCache, letters rendered before with the same template and
+    replacements are reused instead of rendered again. compression is
+    "stored", "deflate" or "deflate:<level>", and save_profile one of
+    pdf_template.SAVE_PROFILES (the default profile when None).
     """
     os.makedirs(output_folder, exist_ok=True)
-    df = pd.read_excel(excel_file)
     
     # Verify these column names match your Excel file's actual column names
     placeholder_mapping = {
@@ -63,28 +40,44 @@ def merge_employee_data_and_zip(excel_file, pdf_template, output_folder, zip_nam
         '[Target in INR]': 'Bonus 2025 (At Target)',
         '[Total CTC in INR]': 'Total CTC'
     }
+
+    # Stream the first sheet in batch_size chunks instead of loading it whole
+    reader = WorkbookReader(excel_file, chunk_size=batch_size, expected_columns=[*placeholder_mapping.values(), 'Email Id'])
     
     current_date = datetime.datetime.now().strftime("%B %d, %Y")
+
+    # Locate every placeholder once for the whole run
+    template = load_template(pdf_template, ['[Date]', *placeholder_mapping])
+
+    # Counts at the start of the run, for the hit/miss summary
+    if render_cache is not None:
+        cache_hits, cache_misses = render_cache.hits, render_cache.misses
+
     docs_folder = os.path.join(output_folder, "temp_pdfs")
-    os.makedirs(docs_folder, exist_ok=True)
+    if not in_memory:
+        os.makedirs(docs_folder, exist_ok=True)
     
     if zip_name is None:
         today = datetime.datetime.now().strftime("%Y%m%d")
         zip_name = f"employee_documents_{today}.zip"
     zip_path = os.path.join(output_folder, zip_name)
     
-    total_employees = len(df)
+    total_employees = 0
     
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for start_idx in range(0, total_employees, batch_size):
-            end_idx = min(start_idx + batch_size, total_employees)
-            batch = df.iloc[start_idx:end_idx]
-            print(f"Processing batch {start_idx//batch_size + 1}: employees {start_idx+1} to {end_idx}")
+    with reader, ParallelZipWriter(zip_path, compression) as zipf:
+        # Batches are streamed from the workbook, so memory use does not grow with the sheet
+        for start_idx, batch in reader.chunks():
+            end_idx = start_idx + len(batch)
+            total_employees = end_idx
+            logger.info(
+                "Processing batch %d: employees %d to %d", start_idx // batch_size + 1, start_idx + 1, end_idx,
+                extra={"event": "batch_started", "batch": start_idx // batch_size + 1}
+            )
             
             for _, row in batch.iterrows():
                 replacements = {'[Date]': current_date}
                 for pdf_placeholder, excel_col in placeholder_mapping.items():
-                    if excel_col in df.columns:
+                    if excel_col in batch.columns:
                         value = row[excel_col]
                         if pd.notna(value) and value != "":
                             replacements[pdf_placeholder] = str(value)
@@ -96,19 +89,34 @@ def merge_employee_data_and_zip(excel_file, pdf_template, output_folder, zip_nam
                 emp_name = str(row['Name'])
                 safe_emp_name = re.sub(r'[^\w\s-]', '', emp_name).strip().replace(' ', '_')
                 file_name = safe_emp_id+"_"+safe_emp_name
-                pdf_output_path = os.path.join(docs_folder, f"{file_name}.pdf")
-                
-                replace_text_in_pdf(pdf_template, replacements, pdf_output_path)
-                zipf.write(pdf_output_path, arcname=f"{file_name}.pdf")
-                os.remove(pdf_output_path)
-                print(f"  Processed employee ID: {emp_id}")
+                if in_memory:
+                    pdf_data = render_letter_bytes(template, replacements, render_mode, render_cache, save_profile)
+                    zipf.writestr(f"{file_name}.pdf", pdf_data)
+                else:
+                    pdf_output_path = os.path.join(docs_folder, f"{file_name}.pdf")
+                    if render_cache is None:
+                        replace_text_in_pdf(template, replacements, pdf_output_path, render_mode, save_profile)
+                    else:
+                        with open(pdf_output_path, 'wb') as f:
+                            f.write(render_letter_bytes(template, replacements, render_mode, render_cache, save_profile))
+                    zipf.write(pdf_output_path, arcname=f"{file_name}.pdf")
+                    os.remove(pdf_output_path)
+                logger.debug("Row rendered", extra={"event": "row_rendered", "emp_id": emp_id, "file": f"{file_name}.pdf"})
     
     if os.path.exists(docs_folder):
         shutil.rmtree(docs_folder)
-    print(f"Processed {total_employees} employees. All documents saved in single zip file: {zip_path}")
+    extra = {"event": "run_finished", "rows_done": total_employees}
+    if render_cache is not None:
+        extra["cache_hits"] = render_cache.hits - cache_hits
+        extra["cache_misses"] = render_cache.misses - cache_misses
+    logger.info(
+        "Processed %d employees. All documents saved in single zip file: %s", total_employees, zip_path,
+        extra=extra
+    )
     return zip_path
 
 if __name__ == "__main__":
+    configure_logging("INFO", json_format=False)
     excel_file = "employee_data.xlsx"
     pdf_template = "template.pdf"
     output_folder = "output"
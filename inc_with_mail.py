@@ -1,65 +1,66 @@
 import pandas as pd
-import fitz  # PyMuPDF
 import re
 import os
-import zipfile
+from archive import ParallelZipWriter
 import datetime
 import shutil
+import logging
+from pdf_template import load_template, render_letter_bytes, replace_text_in_pdf
+from workbook_reader import WorkbookReader
 import threading
 import queue
+import time
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import formatdate
 from email import encoders
+from mail_delivery import DeliveryResult, TokenBucket
+from structured_logging import configure_logging
 
-def replace_text_in_pdf(pdf_path, replacements, output_pdf):
-    """Replace placeholders in a PDF by redacting old text and inserting new text at the exact position."""
-    doc = fitz.open(pdf_path)
-    
-    for page in doc:
-        for key, value in replacements.items():
-            text_instances = page.search_for(key)
-            for inst in text_instances:
-                # Redact the placeholder text
-                page.add_redact_annot(inst, text="", fill=(1, 1, 1))  # White fill
-                page.apply_redactions()
-                
-                # Calculate the baseline position of the placeholder text
-                baseline_x = inst.x0  # Left edge of the placeholder
-                baseline_y = inst.y1 - 4  # Adjust for baseline alignment (4 is a small offset for better alignment)
-                
-                # Special handling for [Employee Type] if needed
-                if key == "[Employee Type]":
-                    baseline_y = inst.y1 - 2  # Adjust offset specifically for this placeholder
-                
-                # Insert the new text at the same position
-                page.insert_text(
-                    (baseline_x, baseline_y),
-                    value,
-                    fontsize=10,  # Adjust to match your template's font size
-                    color=(0, 0, 0),
-                    fontname="helv",  # Adjust to match your template's font if known
-                )
-    
-    doc.save(output_pdf)
-    doc.close()
+logger = logging.getLogger(__name__)
 
-def send_email_worker(email_queue, sender_email, aws_region):
-    """Worker function to send emails from a queue using AWS SES."""
-    # Create SES client
-    ses_client = boto3.client('ses', region_name=aws_region)
-    
+# A message SES throttles is retried after 1, 2, 4... times this many seconds
+THROTTLE_BACKOFF_SECONDS = 1
+
+def create_ses_client(aws_region, endpoint_url=None):
+    """Create the SES client shared by all email workers (boto3 clients are thread-safe).
+
+    endpoint_url points the client at a local stub of the SES API for testing.
+    """
+    return boto3.client('ses', region_name=aws_region, endpoint_url=endpoint_url)
+
+def ses_max_send_rate(ses_client, default=1.0):
+    """Return the account's SES MaxSendRate (messages per second), or default if it cannot be read."""
+    try:
+        return float(ses_client.get_send_quota()['MaxSendRate'])
+    except (ClientError, BotoCoreError, KeyError, TypeError, ValueError) as e:
+        logger.warning("Could not read SES send quota, using %s message(s)/s: %s", default, e)
+        return default
+
+def send_email_worker(email_queue, sender_email, ses_client, rate_limiter, results, max_retries=3):
+    """Worker function to send emails from a queue using AWS SES.
+
+    Runs until it receives the None sentinel, so it keeps waiting while rows
+    are still being rendered. Every message gets a DeliveryResult in results.
+    """
     while True:
+        email_data = email_queue.get()
         try:
-            email_data = email_queue.get(block=False)
             if email_data is None:  # Sentinel value to stop the worker
                 break
-                
-            recipient_email, subject, body, attachment_path = email_data
-            
+
+            # attachment is either a file path or the PDF bytes with their file name
+            recipient_email, subject, body, attachment = email_data
+            if isinstance(attachment, tuple):
+                attachment_name, attachment_data = attachment
+            else:
+                attachment_name = os.path.basename(attachment)
+                with open(attachment, 'rb') as f:
+                    attachment_data = f.read()
+
             # Create email message
             msg = MIMEMultipart()
             msg['From'] = sender_email
@@ -67,43 +68,68 @@ def send_email_worker(email_queue, sender_email, aws_region):
             msg['Date'] = formatdate(localtime=True)
             msg['Subject'] = subject
             msg.attach(MIMEText(body, 'plain'))
-            
+
             # Attach the PDF
-            with open(attachment_path, 'rb') as attachment:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(attachment.read())
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', f'attachment; filename="{os.path.basename(attachment_path)}"')
-                msg.attach(part)
-            
-            # Send email through SES
-            try:
-                response = ses_client.send_raw_email(
-                    Source=sender_email,
-                    Destinations=[recipient_email],
-                    RawMessage={'Data': msg.as_string()}
-                )
-                print(f"Email sent to {recipient_email}, SES MessageId: {response['MessageId']}")
-            except ClientError as e:
-                print(f"Failed to send email to {recipient_email}: {e.response['Error']['Message']}")
-                
-        except queue.Empty:
-            # No more emails in queue
-            break
-            
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(attachment_data)
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', f'attachment; filename="{attachment_name}"')
+            msg.attach(part)
+            raw_message = msg.as_string()
+
+            # Send email through SES, staying under the account's send rate
+            for attempt in range(max_retries + 1):
+                rate_limiter.acquire()
+                try:
+                    response = ses_client.send_raw_email(
+                        Source=sender_email,
+                        Destinations=[recipient_email],
+                        RawMessage={'Data': raw_message}
+                    )
+                    result = DeliveryResult(recipient_email, True, None, response['MessageId'])
+                    logger.debug(
+                        "Email sent",
+                        extra={"event": "email_sent", "recipient": recipient_email, "message_id": response['MessageId']}
+                    )
+                    break
+                except ClientError as e:
+                    error = e.response['Error']
+                    if error.get('Code') == 'Throttling' and attempt < max_retries:
+                        # Sending rate exceeded despite the limiter (quota shared with other senders); back off
+                        time.sleep(THROTTLE_BACKOFF_SECONDS * 2 ** attempt)
+                        continue
+                    result = DeliveryResult(recipient_email, False, error.get('Message', str(e)))
+                    logger.warning("Failed to send email: %s", result.error, extra={"event": "email_failed", "recipient": recipient_email})
+                    break
+                except BotoCoreError as e:
+                    # No response from SES at all (endpoint unreachable, no credentials)
+                    result = DeliveryResult(recipient_email, False, str(e))
+                    logger.warning("Failed to send email: %s", result.error, extra={"event": "email_failed", "recipient": recipient_email})
+                    break
+            results.append(result)
+
+        except Exception as e:
+            # Never let one bad message stop the worker
+            results.append(DeliveryResult(email_data[0], False, str(e)))
+            logger.warning("Failed to send email: %s", e, extra={"event": "email_failed", "recipient": email_data[0]})
+
         finally:
             email_queue.task_done()
 
-def merge_employee_data_and_zip(excel_file, pdf_template, output_folder, sender_email=None, aws_region=None, zip_name=None, batch_size=50):
+def merge_employee_data_and_zip(excel_file, pdf_template, output_folder, sender_email=None, aws_region=None, zip_name=None, batch_size=50, render_mode="overlay", in_memory=True, email_workers=5, ses_client=None, ses_endpoint_url=None, max_send_rate=None, render_cache=None, compression="stored", save_profile=None):
     """
     Read employee data from Excel, replace placeholders in PDF document,
     create a zip file containing all documents, and send individual PDFs via email.
+
+    Emails go out through email_workers threads sharing one SES client while
+    rendering continues, throttled to max_send_rate messages per second (the
+    account's SES quota by default). Pass ses_client or ses_endpoint_url to
+    send against a local SES stub. With a RenderCache, letters rendered before
+    with the same template and replacements are reused instead of rendered again.
+    compression is "stored", "deflate" or "deflate:<level>", and save_profile
+    one of pdf_template.SAVE_PROFILES (the default profile when None).
     """
     os.makedirs(output_folder, exist_ok=True)
-    df = pd.read_excel(excel_file)
-    
-    # Check if Email Id column exists for email sending
-    send_emails = sender_email is not None and aws_region is not None and 'Email Id' in df.columns
     
     # Placeholder mapping
     placeholder_mapping = {
@@ -122,106 +148,140 @@ def merge_employee_data_and_zip(excel_file, pdf_template, output_folder, sender_
         '[Target in INR]': 'Bonus 2025 (At Target)',
         '[Total CTC in INR]': 'Total CTC'
     }
+
+    # Stream the first sheet in batch_size chunks instead of loading it whole
+    reader = WorkbookReader(excel_file, chunk_size=batch_size, expected_columns=[*placeholder_mapping.values(), 'Email Id'])
+
+    # Check if Email Id column exists for email sending
+    send_emails = sender_email is not None and aws_region is not None and 'Email Id' in reader.columns
     
     current_date = datetime.datetime.now().strftime("%B %d, %Y")
+
+    # Locate every placeholder once for the whole run
+    template = load_template(pdf_template, ['[Date]', *placeholder_mapping])
+
+    # Counts at the start of the run, for the hit/miss summary
+    if render_cache is not None:
+        cache_hits, cache_misses = render_cache.hits, render_cache.misses
+
     docs_folder = os.path.join(output_folder, "temp_pdfs")
-    os.makedirs(docs_folder, exist_ok=True)
+    if not in_memory:
+        os.makedirs(docs_folder, exist_ok=True)
     
     if zip_name is None:
         today = datetime.datetime.now().strftime("%Y%m%d")
         zip_name = f"employee_documents_{today}.zip"
     zip_path = os.path.join(output_folder, zip_name)
     
-    total_employees = len(df)
+    total_employees = 0
     
-    # Create a queue for email tasks if email sending is enabled
-    email_queue = queue.Queue() if send_emails else None
+    # Bounded queue, so rendering waits instead of piling up letters when SES is the bottleneck
+    email_queue = queue.Queue(maxsize=email_workers * 20) if send_emails else None
+    email_results = []
     
     # Start email worker threads if email sending is enabled
-    email_workers = []
+    email_threads = []
     if send_emails:
-        num_email_workers = 5  # Number of concurrent email sending threads
-        for _ in range(num_email_workers):
+        if ses_client is None:
+            ses_client = create_ses_client(aws_region, ses_endpoint_url)
+        if max_send_rate is None:
+            max_send_rate = ses_max_send_rate(ses_client)
+        rate_limiter = TokenBucket(max_send_rate)
+        for _ in range(email_workers):
             worker = threading.Thread(
                 target=send_email_worker,
-                args=(email_queue, sender_email, aws_region),
+                args=(email_queue, sender_email, ses_client, rate_limiter, email_results),
                 daemon=True
             )
             worker.start()
-            email_workers.append(worker)
+            email_threads.append(worker)
     
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for start_idx in range(0, total_employees, batch_size):
-            end_idx = min(start_idx + batch_size, total_employees)
-            batch = df.iloc[start_idx:end_idx]
-            print(f"Processing batch {start_idx//batch_size + 1}: employees {start_idx+1} to {end_idx}")
+    try:
+        with reader, ParallelZipWriter(zip_path, compression) as zipf:
+            # Batches are streamed from the workbook, so memory use does not grow with the sheet
+            for start_idx, batch in reader.chunks():
+                end_idx = start_idx + len(batch)
+                total_employees = end_idx
+                logger.info(
+                    "Processing batch %d: employees %d to %d", start_idx // batch_size + 1, start_idx + 1, end_idx,
+                    extra={"event": "batch_started", "batch": start_idx // batch_size + 1}
+                )
             
-            for _, row in batch.iterrows():
-                replacements = {'[Date]': current_date}
-                for pdf_placeholder, excel_col in placeholder_mapping.items():
-                    if excel_col in df.columns:
-                        value = row[excel_col]
-                        if pd.notna(value) and value != "":
-                            replacements[pdf_placeholder] = str(value)
-                        else:
-                            replacements[pdf_placeholder] = "N/A"  # Handle missing data
-                
-                emp_id = str(row['Emp ID'])
-                safe_emp_id = re.sub(r'[^\w\s-]', '', emp_id).strip().replace(' ', '_')
-                emp_name = str(row['Name'])
-                safe_emp_name = re.sub(r'[^\w\s-]', '', emp_name).strip().replace(' ', '_')
-                file_name = safe_emp_id+"_"+safe_emp_name
-                pdf_output_path = os.path.join(docs_folder, f"{file_name}.pdf")
+                for _, row in batch.iterrows():
+                    replacements = {'[Date]': current_date}
+                    for pdf_placeholder, excel_col in placeholder_mapping.items():
+                        if excel_col in batch.columns:
+                            value = row[excel_col]
+                            if pd.notna(value) and value != "":
+                                replacements[pdf_placeholder] = str(value)
+                            else:
+                                replacements[pdf_placeholder] = "N/A"  # Handle missing data
                 
-                # Create the PDF
-                replace_text_in_pdf(pdf_template, replacements, pdf_output_path)
-                
-                # Add to zip file
-                zipf.write(pdf_output_path, arcname=f"{file_name}.pdf")
+                    emp_id = str(row['Emp ID'])
+                    safe_emp_id = re.sub(r'[^\w\s-]', '', emp_id).strip().replace(' ', '_')
+                    emp_name = str(row['Name'])
+                    safe_emp_name = re.sub(r'[^\w\s-]', '', emp_name).strip().replace(' ', '_')
+                    file_name = safe_emp_id+"_"+safe_emp_name
+                    # Create the PDF and add it to the zip file
+                    if in_memory:
+                        pdf_data = render_letter_bytes(template, replacements, render_mode, render_cache, save_profile)
+                        zipf.writestr(f"{file_name}.pdf", pdf_data)
+                        attachment = (f"{file_name}.pdf", pdf_data)
+                    else:
+                        pdf_output_path = os.path.join(docs_folder, f"{file_name}.pdf")
+                        if render_cache is None:
+                            replace_text_in_pdf(template, replacements, pdf_output_path, render_mode, save_profile)
+                        else:
+                            with open(pdf_output_path, 'wb') as f:
+                                f.write(render_letter_bytes(template, replacements, render_mode, render_cache, save_profile))
+                        zipf.write(pdf_output_path, arcname=f"{file_name}.pdf")
+                        attachment = pdf_output_path
                 
-                # Queue email task if email sending is enabled and email is available
-                if send_emails:
-                    email = row.get('Email Id')
-                    if pd.notna(email) and email != "":
-                        # Hardcoded subject
-                        subject = "Appraisal Letter"
+                    # Queue email task if email sending is enabled and email is available
+                    if send_emails:
+                        email = row.get('Email Id')
+                        if pd.notna(email) and email != "":
+                            # Hardcoded subject
+                            subject = "Appraisal Letter"
                         
-                        # Email body with name from Excel
-                        body = f"Dear {row['Name']},\nPlease find attachment for your apprisal letter."
+                            # Email body with name from Excel
+                            body = f"Dear {row['Name']},\nPlease find attachment for your apprisal letter."
                         
-                        # Add to email queue
-                        email_queue.put((email, subject, body, pdf_output_path))
+                            # Add to email queue
+                            email_queue.put((email, subject, body, attachment))
                 
-                print(f"  Processed employee ID: {emp_id}")
-    
-    # If email sending is enabled, wait for the queue to process (with a timeout)
-    if send_emails:
-        # Start a thread to wait for queue completion with timeout
-        def wait_with_timeout(queue, timeout):
-            try:
-                queue.join()
-            except Exception as e:
-                print(f"Error while waiting for email queue: {str(e)}")
-        
-        completion_thread = threading.Thread(
-            target=wait_with_timeout,
-            args=(email_queue, 25),  # 25 second timeout to leave 5 seconds margin
-            daemon=True
-        )
-        completion_thread.start()
-        completion_thread.join(timeout=25)  # Wait up to 25 seconds
-    
-    # Clean up temporary files
-    if os.path.exists(docs_folder):
-        shutil.rmtree(docs_folder)
-    
-    print(f"Processed {total_employees} employees. All documents saved in single zip file: {zip_path}")
-    if send_emails:
-        print("Email sending continues in the background.")
+                    logger.debug("Row rendered", extra={"event": "row_rendered", "emp_id": emp_id, "file": f"{file_name}.pdf"})
+    finally:
+        # Also after a render or zip error: stop the workers once the queue is drained and report per message
+        if send_emails:
+            for _ in email_threads:
+                email_queue.put(None)
+            for worker in email_threads:
+                worker.join()
+
+            failed = [result for result in email_results if not result.ok]
+            logger.info(
+                "Emails sent: %d, failed: %d", len(email_results) - len(failed), len(failed),
+                extra={"event": "emails_done", "failed_recipients": {result.recipient: result.error for result in failed}}
+            )
+
+        # Clean up temporary files
+        if os.path.exists(docs_folder):
+            shutil.rmtree(docs_folder)
+
+    extra = {"event": "run_finished", "rows_done": total_employees}
+    if render_cache is not None:
+        extra["cache_hits"] = render_cache.hits - cache_hits
+        extra["cache_misses"] = render_cache.misses - cache_misses
+    logger.info(
+        "Processed %d employees. All documents saved in single zip file: %s", total_employees, zip_path,
+        extra=extra
+    )
     
     return zip_path
 
 if __name__ == "__main__":
+    configure_logging("INFO", json_format=False)
     excel_file = "employee_data.xlsx"
     pdf_template = "template.pdf"
     output_folder = "output"
@@ -0,0 +1,148 @@
+import threading
+import time
+import uuid
+
+import heartbeats
+from heartbeats import HEARTBEAT_SECONDS, STALE_SECONDS, Heartbeat, now_stamp
+
+# Job lifecycle: queued -> running -> done | failed. Every job belongs to the
+# server that created it, which refreshes the heartbeat of its unfinished jobs;
+# a queued or running job whose heartbeat goes stale was cut off by that
+# server stopping, and is marked interrupted.
+JOB_STATUSES = ("queued", "running", "done", "failed", "interrupted")
+UNFINISHED_STATUSES = ("queued", "running")
+
+JOB_FIELDS = (
+    "id", "owner", "status", "created_at", "updated_at", "excel_path", "artifact_path",
+    "artifact_name", "rows_total", "rows_done", "rows_failed", "emails_sent", "emails_failed", "error"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    excel_path TEXT,
+    artifact_path TEXT,
+    artifact_name TEXT,
+    rows_total INTEGER NOT NULL DEFAULT 0,
+    rows_done INTEGER NOT NULL DEFAULT 0,
+    rows_failed INTEGER NOT NULL DEFAULT 0,
+    emails_sent INTEGER NOT NULL DEFAULT 0,
+    emails_failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    server_id TEXT,
+    heartbeat REAL
+)
+"""
+
+
+class JobStore:
+    """SQLite-backed record of upload jobs and their progress.
+
+    Jobs are owned by server_id (this process by default). While the
+    heartbeat thread started by start() runs, it keeps this server's
+    unfinished jobs fresh and marks those of servers whose heartbeat is older
+    than stale_seconds as interrupted, so opening the store from another
+    process never touches jobs that are still running.
+    """
+
+    def __init__(self, db_path, server_id=None, heartbeat_seconds=HEARTBEAT_SECONDS, stale_seconds=STALE_SECONDS):
+        self.db_path = db_path
+        self.server_id = server_id or heartbeats.owner_id()
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._heartbeat = Heartbeat(self._beat, heartbeat_seconds, name="job-heartbeat")
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+
+    def _connect(self):
+        return heartbeats.connect(self.db_path)
+
+    def create(self, owner, excel_path=None, artifact_name=None):
+        """Insert a queued job, owned by this server, and return its ID."""
+        job_id = uuid.uuid4().hex
+        now = now_stamp()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, owner, status, created_at, updated_at, excel_path, artifact_name, server_id, heartbeat) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (job_id, owner, now, now, excel_path, artifact_name, self.server_id, time.time())
+            )
+        return job_id
+
+    def heartbeat(self):
+        """Mark this server's unfinished jobs as alive."""
+        with self._lock, self._connect() as conn:
+            heartbeats.refresh(conn, "jobs", "server_id", self.server_id, UNFINISHED_STATUSES)
+
+    def expire_stale(self):
+        """Mark unfinished jobs of other servers interrupted once their heartbeat is stale. Returns how many."""
+        with self._lock, self._connect() as conn:
+            return heartbeats.expire_stale(
+                conn, "jobs", "server_id", self.server_id, UNFINISHED_STATUSES, self.stale_seconds,
+                {"status": "interrupted", "error": "Server stopped while the job was running", "updated_at": now_stamp()}
+            )
+
+    def _beat(self):
+        self.heartbeat()
+        self.expire_stale()
+
+    def start(self):
+        """Recover jobs of servers that are gone and keep this server's jobs alive on a background thread."""
+        self.expire_stale()
+        self._heartbeat.start()
+
+    def stop(self):
+        """Stop the heartbeat thread."""
+        self._heartbeat.stop()
+
+    def update(self, job_id, **fields):
+        """Set the given columns of a job."""
+        unknown = set(fields) - set(JOB_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        fields["updated_at"] = now_stamp()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        """Return a job as a dict, or None if it does not exist."""
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(JOB_FIELDS, row))
+
+
+class JobProgress:
+    """Progress callback for a job that writes to the store at most once per interval."""
+
+    def __init__(self, store, job_id, interval=1.0):
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+        self._counts = {}
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, **counts):
+        with self._lock:
+            self._counts.update(counts)
+            now = time.monotonic()
+            if now - self._last_write < self.interval:
+                return
+            self._last_write = now
+            counts = dict(self._counts)
+        self.store.update(self.job_id, **counts)
+
+    def flush(self):
+        """Write the latest counts regardless of the interval."""
+        with self._lock:
+            counts = dict(self._counts)
+        if counts:
+            self.store.update(self.job_id, **counts)
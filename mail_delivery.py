@@ -0,0 +1,171 @@
+import concurrent.futures
+import smtplib
+import threading
+import time
+from collections import namedtuple
+
+from metrics import stage_timer
+
+# Outcome of delivering one message; message_id is set when the provider returns one
+DeliveryResult = namedtuple("DeliveryResult", ["recipient", "ok", "error", "message_id"], defaults=(None,))
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing rate acquisitions per second with bursts up to capacity."""
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SMTPDeliveryEngine:
+    """Send messages concurrently over a fixed number of reusable, authenticated SMTP connections.
+
+    Each worker thread owns one connection, opened (STARTTLS + login) on first
+    use and reused for up to max_messages_per_connection messages. A dropped
+    connection is reopened and the message retried once. pending counts the
+    messages submitted but not yet delivered or failed; once max_pending
+    (connections * 20 by default) are waiting, submit() blocks, so a slow
+    server holds up rendering instead of letting the run pile up in memory.
+    """
+
+    def __init__(self, host, port, username, password, connections=4, max_messages_per_connection=100,
+                 debug=False, on_result=None, max_pending=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_messages_per_connection = max_messages_per_connection
+        self.debug = debug
+        self.on_result = on_result
+        self.results = []
+        self._local = threading.local()
+        self._open_connections = set()
+        self._lock = threading.Lock()
+        self._futures = []
+        self.pending = 0
+        self._slots = threading.BoundedSemaphore(max_pending or connections * 20)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections, thread_name_prefix="smtp")
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=60)
+        if self.debug:
+            server.set_debuglevel(1)
+        server.starttls()
+        server.login(self.username, self.password)
+        with self._lock:
+            self._open_connections.add(server)
+        return server
+
+    def _disconnect(self, server):
+        with self._lock:
+            self._open_connections.discard(server)
+        try:
+            server.quit()
+        except smtplib.SMTPException:
+            server.close()
+        except OSError:
+            pass
+
+    def _connection(self):
+        """Return this thread's connection, opening or recycling it as needed."""
+        server = getattr(self._local, "server", None)
+        if server is not None and self._local.sent >= self.max_messages_per_connection:
+            self._disconnect(server)
+            server = None
+        if server is None:
+            server = self._connect()
+            self._local.server = server
+            self._local.sent = 0
+        return server
+
+    def _drop_connection(self):
+        server = getattr(self._local, "server", None)
+        if server is not None:
+            self._local.server = None
+            self._disconnect(server)
+
+    def _send(self, recipient, message):
+        result = DeliveryResult(recipient, False, "Delivery did not complete")
+        try:
+            with stage_timer("smtp_send"):
+                try:
+                    self._connection().send_message(message)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # The server closed an idle connection; reconnect and retry once
+                    self._drop_connection()
+                    self._connection().send_message(message)
+            self._local.sent += 1
+            result = DeliveryResult(recipient, True, None)
+        except smtplib.SMTPAuthenticationError:
+            self._drop_connection()
+            result = DeliveryResult(recipient, False, "SMTP authentication failed")
+        except (smtplib.SMTPException, OSError) as e:
+            self._drop_connection()
+            result = DeliveryResult(recipient, False, str(e))
+        except Exception as e:
+            # e.g. a header that cannot be encoded; the message fails, the engine carries on.
+            # The connection may be mid-transaction, so it is not reused.
+            self._drop_connection()
+            result = DeliveryResult(recipient, False, f"{type(e).__name__}: {str(e)}")
+        finally:
+            # Every submitted message is settled exactly once, whatever happened above
+            with self._lock:
+                self.results.append(result)
+                self.pending -= 1
+            self._slots.release()
+        if self.on_result:
+            self.on_result(result)
+        return result
+
+    def submit(self, recipient, message):
+        """Queue a message for delivery and return a future resolving to its DeliveryResult.
+
+        Blocks while max_pending messages are already waiting.
+        """
+        self._slots.acquire()
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self._executor.submit(self._send, recipient, message)
+        except BaseException:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+            raise
+        self._futures.append(future)
+        return future
+
+    def close(self):
+        """Wait for every queued message, close all connections and return the results."""
+        concurrent.futures.wait(self._futures)
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            connections = list(self._open_connections)
+        for server in connections:
+            self._disconnect(server)
+        return list(self.results)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
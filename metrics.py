@@ -0,0 +1,210 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# Buckets in seconds, from a single text write up to a whole run
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+# Render worker processes buffer their observations here instead of recording
+# them, and ship them back to the parent with each result (see replay).
+_buffer = None
+
+# Per-thread stage totals of the run currently being processed (see set_run_totals)
+_local = threading.local()
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = [*zip(labelnames, key), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry[name] = self
+
+    def _record(self, value, labels):
+        raise NotImplementedError
+
+    def _observe(self, value, labels):
+        if _buffer is not None:
+            _buffer.append((self.name, labels, value))
+        else:
+            self._record(value, labels)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonic count, optionally split by labels."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._observe(amount, labels)
+
+    def _record(self, value, labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _samples(self):
+        with self._lock:
+            return [("", key, (), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Current value read from function at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def _samples(self):
+        return [("", (), (), self.function())]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, exposed as cumulative buckets plus sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self._observe(value, labels)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _record(self, value, labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip((*self.buckets, float("inf")), counts):
+                    cumulative += count
+                    samples.append(("_bucket", key, (("le", _format_value(bound)),), cumulative))
+                samples.append(("_sum", key, (), total))
+                samples.append(("_count", key, (), cumulative))
+        return samples
+
+
+STAGE_SECONDS = Histogram(
+    "appraisal_stage_seconds", "Time spent in each stage of letter generation.", ["stage"]
+)
+ROW_SECONDS = Histogram("appraisal_row_seconds", "Time to render one letter.")
+RUN_SECONDS = Histogram("appraisal_run_seconds", "Time to process one uploaded workbook.", ["outcome"])
+ROWS_TOTAL = Counter("appraisal_rows_total", "Workbook rows processed.", ["outcome"])
+SEARCH_HITS_TOTAL = Counter("appraisal_pdf_search_hits_total", "Placeholder occurrences found in templates.")
+REDACTIONS_TOTAL = Counter("appraisal_pdf_redactions_total", "Redaction annotations applied.")
+EMAILS_TOTAL = Counter("appraisal_emails_total", "Appraisal emails delivered.", ["outcome"])
+RENDER_CACHE_TOTAL = Counter("appraisal_render_cache_total", "Render cache lookups.", ["result"])
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Time a stage into STAGE_SECONDS and into the current run's totals, if any."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        _add_to_run(stage, elapsed)
+
+
+def _add_to_run(stage, elapsed):
+    totals = getattr(_local, "totals", None)
+    if totals is not None:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+
+
+def set_run_totals(totals):
+    """Add the per-stage seconds of everything this thread times (or replays) to totals, or stop with None.
+
+    A generator that may be resumed on another thread sets it again after every yield.
+    """
+    _local.totals = totals
+
+
+def start_buffering():
+    """Buffer observations made in this process so they can be returned to the parent."""
+    global _buffer
+    _buffer = []
+
+
+def drain():
+    """Return and clear the buffered observations."""
+    if _buffer is None:
+        return []
+    samples = list(_buffer)
+    _buffer.clear()
+    return samples
+
+
+def replay(samples):
+    """Record observations drained from a worker process; a process that buffers its own passes them on."""
+    if _buffer is not None:
+        _buffer.extend(samples)
+        return
+    for name, labels, value in samples:
+        _registry[name]._record(value, labels)
+        if name == STAGE_SECONDS.name:
+            _add_to_run(labels["stage"], value)
+
+
+def render():
+    """Return every registered metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return "\n".join(metric.render() for metric in metrics) + "\n"
@@ -0,0 +1,489 @@
+import hashlib
+import string
+import threading
+from collections import OrderedDict, namedtuple
+
+import fitz  # PyMuPDF
+
+from metrics import REDACTIONS_TOTAL, SEARCH_HITS_TOTAL, stage_timer
+from render_cache import RenderCache
+
+# A single occurrence of a placeholder in the template, with the font context
+# of the text it replaces (taken from the span underneath the match).
+PlaceholderHit = namedtuple("PlaceholderHit", ["page", "rect", "fontsize", "fontname", "color"])
+
+# "redact" rewrites the page for every placeholder hit; "overlay" starts from a
+# copy of the template with the placeholders already redacted and only stamps text.
+RENDER_MODES = ("redact", "overlay")
+
+# How replacement text is laid out: right_align_keys end flush with the right
+# edge of their placeholder column, fit_keys shrink down to min_fontsize to stay
+# inside the page margin, and use_template_font writes with the template's own
+# font (when it is embedded in full) instead of Helvetica.
+TextLayout = namedtuple(
+    "TextLayout",
+    ["right_align_keys", "fit_keys", "use_template_font", "min_fontsize", "margin"],
+    defaults=(frozenset(), frozenset(), False, 6, 36)
+)
+DEFAULT_LAYOUT = TextLayout()
+
+# A part of the template that only some letters keep. anchor is the text that
+# marks it, located once per template and then applied by rect: a letter that
+# leaves the section out gets the anchor blanked, or overwritten with otherwise.
+# Unlike a placeholder search, the anchor must match whole words and case
+# (punctuation around it aside), so "II" finds "II." but not "III", and "I."
+# does not hit the end of "Hi.".
+# occurrence keeps one match (0 is the first) instead of all of them. rule
+# belongs to the caller, which decides per row whether the section stays.
+Section = namedtuple("Section", ["name", "anchor", "rule", "otherwise", "occurrence"], defaults=("", None))
+
+# How a letter is written out: garbage (0-4) drops unused objects, and from 3
+# also merges duplicates such as the font resources redaction leaves behind;
+# deflate compresses uncompressed streams and fonts; use_objstms packs objects
+# into compressed object streams; linear linearizes for fast web view (newer
+# MuPDF releases ignore it).
+SaveProfile = namedtuple("SaveProfile", ["garbage", "deflate", "use_objstms", "linear"], defaults=(0, False, False, False))
+SAVE_PROFILES = {
+    # What a plain doc.save() writes: quickest to save, largest file
+    "fast": SaveProfile(),
+    "compact": SaveProfile(garbage=3, deflate=True, use_objstms=True),
+    # garbage=4 also compares stream contents when merging duplicates; slower again
+    "smallest": SaveProfile(garbage=4, deflate=True, use_objstms=True),
+    "web": SaveProfile(garbage=3, deflate=True, linear=True),
+}
+DEFAULT_SAVE_PROFILE = "compact"
+
+# PyMuPDF is not thread-safe. Every entry point of this module that touches a
+# document holds this lock, so threads of one process (e.g. the server's job
+# threads) render one at a time; parallel rendering uses processes.
+FITZ_LOCK = threading.RLock()
+
+# Keep a few compiled templates around; the key is the template content hash,
+# so editing template.pdf automatically produces a new entry.
+TEMPLATE_CACHE_SIZE = 4
+_template_cache = OrderedDict()
+
+
+def _span_color(srgb):
+    """Convert a PyMuPDF sRGB integer into an (r, g, b) tuple of floats."""
+    return tuple(c / 255 for c in ((srgb >> 16) & 255, (srgb >> 8) & 255, srgb & 255))
+
+
+class CompiledTemplate:
+    """A template PDF scanned once, with the location of every placeholder recorded."""
+
+    def __init__(self, data, search_keys=(), sections=()):
+        self.data = data
+        self.digest = hashlib.sha256(data).hexdigest()
+        self._source = fitz.open(stream=data, filetype="pdf")
+        self.page_count = self._source.page_count
+        self._spans = {}
+        self._words = {}
+        self._bases = {}
+        self._fonts = {}
+        self._right_edges = {}
+        self.hits = {}
+        for key in search_keys:
+            self.locate(key)
+        for section in sections:
+            self.anchor(section)
+
+    def _page_spans(self, page):
+        spans = self._spans.get(page.number)
+        if spans is None:
+            spans = []
+            for block in page.get_text("dict")["blocks"]:
+                for line in block.get("lines", []):
+                    for span in line["spans"]:
+                        spans.append((fitz.Rect(span["bbox"]), span["size"], span["font"], span["color"]))
+            self._spans[page.number] = spans
+        return spans
+
+    def _font_context(self, page, rect):
+        """Return (fontsize, fontname, color) of the text span under rect."""
+        for bbox, size, font, color in self._page_spans(page):
+            if bbox.intersects(rect):
+                return size, font, _span_color(color)
+        return None, None, (0, 0, 0)
+
+    def locate(self, key):
+        """Return every hit for key, searching the pristine template only the first time."""
+        hits = self.hits.get(key)
+        if hits is None:
+            hits = []
+            with stage_timer("template_search"):
+                for page in self._source:
+                    for rect in page.search_for(key):
+                        hits.append(PlaceholderHit(page.number, tuple(rect), *self._font_context(page, rect)))
+            SEARCH_HITS_TOTAL.inc(len(hits))
+            self.hits[key] = hits
+        return hits
+
+    def _page_words(self, page):
+        words = self._words.get(page.number)
+        if words is None:
+            words = [(fitz.Rect(word[:4]), word[4]) for word in page.get_text("words")]
+            self._words[page.number] = words
+        return words
+
+    def anchor(self, section):
+        """Return the hits of a section's anchor, registered under section_key(section) for rendering."""
+        key = section_key(section)
+        hits = self.hits.get(key)
+        if hits is None:
+            hits = []
+            expected = "".join(section.anchor.split()).strip(string.punctuation)
+            with stage_timer("template_search"):
+                for page in self._source:
+                    words = self._page_words(page)
+                    for rect in page.search_for(section.anchor):
+                        # The words centred in the match must spell the anchor exactly, so a
+                        # match that cuts into a longer word or differs in case is dropped
+                        inside = "".join(text for bbox, text in words if rect.contains((bbox.tl + bbox.br) / 2))
+                        if inside.strip(string.punctuation) == expected:
+                            hits.append(PlaceholderHit(page.number, tuple(rect), *self._font_context(page, rect)))
+            if section.occurrence is not None:
+                hits = hits[section.occurrence:section.occurrence + 1]
+            SEARCH_HITS_TOTAL.inc(len(hits))
+            self.hits[key] = hits
+        return hits
+
+    def hits_on_page(self, key, page_number):
+        return [hit for hit in self.locate(key) if hit.page == page_number]
+
+    def template_font(self, fontname):
+        """Return (Font, GlyphWidths) for a font embedded in the template, or None.
+
+        Subset fonts (named like "ABCDEF+Calibri") only carry the glyphs the
+        template uses, so they are not used for replacement text.
+        """
+        if fontname in self._fonts:
+            return self._fonts[fontname]
+        font = None
+        for page in self._source:
+            for xref, _ext, _type, basefont, _name, _encoding in page.get_fonts():
+                if basefont != fontname or "+" in basefont:
+                    continue
+                content = self._source.extract_font(xref)[3]
+                if content:
+                    font = fitz.Font(fontbuffer=content)
+                    font = (font, GlyphWidths(font))
+                break
+            if font is not None:
+                break
+        self._fonts[fontname] = font
+        return font
+
+    def column_right_edge(self, hit, keys, tolerance=2):
+        """Return the right edge of the column hit sits in: the largest x1 among hits of keys starting at the same x."""
+        cache_key = (hit.page, round(hit.rect[0] / tolerance), frozenset(keys))
+        edge = self._right_edges.get(cache_key)
+        if edge is None:
+            edge = max(
+                other.rect[2]
+                for key in keys
+                for other in self.hits_on_page(key, hit.page)
+                if abs(other.rect[0] - hit.rect[0]) <= tolerance
+            )
+            self._right_edges[cache_key] = edge
+        return max(edge, hit.rect[2])
+
+    def open(self):
+        """Open a fresh, writable copy of the template."""
+        return fitz.open(stream=self.data, filetype="pdf")
+
+    def redacted_base(self, keys):
+        """Return the template bytes with every hit of keys redacted, built once per set of keys."""
+        keys = frozenset(key for key in keys if self.locate(key))
+        base = self._bases.get(keys)
+        if base is None:
+            doc = self.open()
+            for page in doc:
+                rects = [hit.rect for key in keys for hit in self.hits_on_page(key, page.number)]
+                if not rects:
+                    continue
+                for rect in rects:
+                    page.add_redact_annot(fitz.Rect(rect), text="", fill=(1, 1, 1))
+                # One content stream rewrite per page instead of one per hit
+                with stage_timer("apply_redactions"):
+                    page.apply_redactions()
+                REDACTIONS_TOTAL.inc(len(rects))
+            base = doc.tobytes()
+            doc.close()
+            self._bases[keys] = base
+        return base
+
+
+def section_key(section):
+    """Replacements key of a section: set it to section.otherwise to leave the section out of a letter."""
+    return f"section:{section.name}"
+
+
+def load_template(pdf_path, search_keys=(), sections=()):
+    """Return the compiled template for pdf_path, reusing it while the file content is unchanged."""
+    with open(pdf_path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    with FITZ_LOCK:
+        template = _template_cache.get(digest)
+        if template is None:
+            template = CompiledTemplate(data)
+            _template_cache[digest] = template
+            while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+                _template_cache.popitem(last=False)
+        else:
+            _template_cache.move_to_end(digest)
+
+        for key in search_keys:
+            template.locate(key)
+        for section in sections:
+            template.anchor(section)
+    return template
+
+
+class GlyphWidths:
+    """Advance widths of a font at size 1, filled in per character as text is measured."""
+
+    def __init__(self, font):
+        self.font = font
+        self._widths = {}
+
+    def text_width(self, text, fontsize):
+        widths = self._widths
+        total = 0.0
+        for char in text:
+            width = widths.get(char)
+            if width is None:
+                width = widths[char] = self.font.glyph_advance(ord(char))
+            total += width
+        return total * fontsize
+
+
+# Builtin fonts and their width tables, shared by every letter rendered in this process
+_builtin_fonts = {}
+
+
+def builtin_font(name):
+    """Return (Font, GlyphWidths) for a builtin PyMuPDF font such as "helv" or "hebo"."""
+    font = _builtin_fonts.get(name)
+    if font is None:
+        builtin = fitz.Font(name)
+        font = _builtin_fonts[name] = (builtin, GlyphWidths(builtin))
+    return font
+
+
+def _text_style(key, hit, template, layout):
+    """Return (font, widths, fontsize, baseline offset from the rect bottom) for a placeholder."""
+    # Special handling for 'II' replacement: bold, slightly larger and raised
+    if key == 'II.':
+        return (*builtin_font("hebo"), 11, 6)
+
+    # Adjust baseline for Employee Type
+    offset = 2 if key == "[Employee Type]" else 4
+
+    if layout.use_template_font and template is not None and hit is not None and hit.fontname:
+        font = template.template_font(hit.fontname)
+        if font is not None:
+            return (*font, hit.fontsize or 10, offset)
+    return (*builtin_font("helv"), 10, offset)
+
+
+def write_replacements(page, insertions, template=None, layout=None):
+    """Write every (key, value, rect, hit) insertion of a page in a single batched text write.
+
+    Right-aligned keys end at the right edge of their placeholder column, and
+    fit keys shrink their font size so the text stays inside the page margin.
+    """
+    layout = layout or DEFAULT_LAYOUT
+    writer = fitz.TextWriter(page.rect)
+
+    for key, value, rect, hit in insertions:
+        font, widths, fontsize, offset = _text_style(key, hit, template, layout)
+        x = rect.x0
+        y = rect.y1 - offset
+
+        if key in layout.fit_keys:
+            max_width = page.rect.width - layout.margin - x
+            width = widths.text_width(value, fontsize)
+            if width > max_width > 0:
+                fontsize = max(layout.min_fontsize, fontsize * max_width / width)
+
+        if key in layout.right_align_keys:
+            right_edge = template.column_right_edge(hit, layout.right_align_keys) if template and hit else rect.x1
+            x = right_edge - widths.text_width(value, fontsize)
+
+        writer.append((x, y), value, font=font, fontsize=fontsize)
+
+    if insertions:
+        with stage_timer("write_text"):
+            writer.write_text(page, color=(0, 0, 0))
+
+
+def get_save_profile(profile=None):
+    """Return the SaveProfile for a SAVE_PROFILES name, a SaveProfile, or None (DEFAULT_SAVE_PROFILE)."""
+    if isinstance(profile, SaveProfile):
+        return profile
+    name = profile or DEFAULT_SAVE_PROFILE
+    if name not in SAVE_PROFILES:
+        raise ValueError(f"Unknown save profile {name!r}, expected one of {', '.join(SAVE_PROFILES)}")
+    return SAVE_PROFILES[name]
+
+
+def save_options(profile=None):
+    """Keyword arguments for Document.save/tobytes under profile."""
+    profile = get_save_profile(profile)
+    options = {
+        "garbage": profile.garbage,
+        "deflate": profile.deflate,
+        "deflate_fonts": profile.deflate,
+        "use_objstms": int(profile.use_objstms),
+    }
+    # Only passed when asked for, since builds without linearization warn about it
+    if profile.linear:
+        options["linear"] = True
+    return options
+
+
+def finish_letter(doc, output_pdf, profile=None):
+    """Save doc to output_pdf under a save profile, or return its bytes when output_pdf is None."""
+    options = save_options(profile)
+    try:
+        with stage_timer("save"):
+            if output_pdf is None:
+                return doc.tobytes(**options)
+            doc.save(output_pdf, **options)
+            return output_pdf
+    finally:
+        doc.close()
+
+
+def render_letter(template, replacements, output_pdf=None, mode="redact", layout=None, profile=None):
+    """Redact every placeholder hit and write its replacement, using the precomputed rects.
+
+    profile is a SAVE_PROFILES name or a SaveProfile. Returns the PDF bytes
+    when output_pdf is None, otherwise the output path.
+    """
+    if mode == "overlay":
+        return render_letter_overlay(template, replacements, output_pdf, layout, profile)
+    if mode != "redact":
+        raise ValueError(f"Unknown render mode: {mode}")
+    with FITZ_LOCK:
+        return _render_letter_redact(template, replacements, output_pdf, layout, profile)
+
+
+def _render_letter_redact(template, replacements, output_pdf, layout, profile):
+    with stage_timer("open"):
+        doc = template.open()
+
+    for page in doc:
+        insertions = []
+        for key, value in replacements.items():
+            for hit in template.hits_on_page(key, page.number):
+                rect = fitz.Rect(hit.rect)
+                page.add_redact_annot(rect, text="", fill=(1, 1, 1))
+                with stage_timer("apply_redactions"):
+                    page.apply_redactions()
+                REDACTIONS_TOTAL.inc()
+
+                if value:
+                    insertions.append((key, value, rect, hit))
+
+        # All of the page's text goes in with one write, after its redactions
+        write_replacements(page, insertions, template, layout)
+
+    return finish_letter(doc, output_pdf, profile)
+
+
+def render_letter_overlay(template, replacements, output_pdf=None, layout=None, profile=None):
+    """Stamp the replacements onto a pre-redacted copy of the template."""
+    with FITZ_LOCK:
+        # Rows replace different sets of conditional strings, so the base is cached per key set
+        base = template.redacted_base(replacements)
+        with stage_timer("open"):
+            doc = fitz.open(stream=base, filetype="pdf")
+
+        for page in doc:
+            insertions = [
+                (key, value, fitz.Rect(hit.rect), hit)
+                for key, value in replacements.items() if value
+                for hit in template.hits_on_page(key, page.number)
+            ]
+            write_replacements(page, insertions, template, layout)
+
+        return finish_letter(doc, output_pdf, profile)
+
+
+def replace_text_in_pdf(pdf_path, replacements, output_pdf=None, render_mode="redact", save_profile=None):
+    """Render one letter from a template path or CompiledTemplate, for the standalone scripts.
+
+    Returns the PDF bytes when output_pdf is None, otherwise the output path.
+    """
+    template = pdf_path if isinstance(pdf_path, CompiledTemplate) else load_template(pdf_path)
+    return render_letter(template, replacements, output_pdf, mode=render_mode, profile=save_profile)
+
+
+def render_letter_bytes(template, replacements, render_mode, render_cache=None, save_profile=None):
+    """Render a letter to bytes, reusing it from render_cache (a RenderCache) when it was rendered before."""
+    if render_cache is None:
+        return replace_text_in_pdf(template, replacements, None, render_mode, save_profile)
+    key = RenderCache.key(
+        template.digest, replacements, render_mode=render_mode, save_profile=get_save_profile(save_profile)
+    )
+    pdf_data = render_cache.get(key)
+    if pdf_data is None:
+        pdf_data = replace_text_in_pdf(template, replacements, None, render_mode, save_profile)
+        render_cache.put(key, pdf_data)
+    return pdf_data
+
+
+class LetterBook:
+    """Many letters written back to back into one PDF, with a bookmark at the start of each.
+
+    Letters are appended with add() and the book is saved by close(). The
+    default "smallest" profile merges identical objects down to stream
+    content, so the template's fonts, images and (in overlay mode) page
+    content, which every letter shares, are stored once and each further
+    letter costs little more than its text.
+    """
+
+    def __init__(self, output_pdf, profile="smallest"):
+        self.output_pdf = output_pdf
+        self.profile = profile
+        with FITZ_LOCK:
+            self._doc = fitz.open()
+        self._toc = []
+
+    def add(self, pdf, title):
+        """Append a letter, given as PDF bytes or a path, under a bookmark titled title."""
+        with FITZ_LOCK:
+            letter = fitz.open(stream=pdf, filetype="pdf") if isinstance(pdf, bytes) else fitz.open(pdf)
+            try:
+                self._toc.append([1, title, self._doc.page_count + 1])
+                self._doc.insert_pdf(letter)
+            finally:
+                letter.close()
+
+    def close(self):
+        """Write the bookmarks and save the book to output_pdf."""
+        with FITZ_LOCK:
+            try:
+                self._doc.set_toc(self._toc)
+                with stage_timer("save"):
+                    self._doc.save(self.output_pdf, **save_options(self.profile))
+            finally:
+                self._doc.close()
+
+    def abort(self):
+        """Discard the book without saving it."""
+        with FITZ_LOCK:
+            self._doc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import secrets
+import threading
+
+# Part of every key; bump it when a rendering change alters the letters for the same inputs
+RENDER_CACHE_VERSION = 1
+
+# Upper bound on the cache directory size; the least recently used letters are evicted beyond it
+RENDER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def _json_default(value):
+    # Sets (e.g. the keys of a TextLayout) have no stable order, so they are keyed sorted
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Cannot key {type(value).__name__}")
+
+
+class RenderCache:
+    """Rendered letters on disk, addressed by a hash of the template and the letter's replacements.
+
+    A letter is stored as <directory>/<key[:2]>/<key>.pdf. Reading a letter
+    bumps its modification time, and when the directory grows past max_bytes
+    the least recently used letters are removed until it is back under 90% of
+    the limit; with max_bytes None nothing is evicted. Writes go through a
+    temporary file and os.replace, so several processes can share a directory.
+    """
+
+    def __init__(self, directory, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _path, size, _mtime in self._entries())
+
+    @staticmethod
+    def key(template_digest, replacements, **options):
+        """Return the cache key of a letter: template hash, final replacements and render options."""
+        payload = json.dumps(
+            [RENDER_CACHE_VERSION, template_digest, replacements, options],
+            sort_keys=True, ensure_ascii=False, default=_json_default
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pdf")
+
+    def _entries(self):
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".pdf"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        """Return the cached letter for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store a rendered letter, evicting old letters if the cache is over its size limit."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._size += len(data)
+            over_limit = self.max_bytes is not None and self._size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used letters until the cache is under 90% of max_bytes."""
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[2])
+            size = sum(entry[1] for entry in entries)
+            target = self.max_bytes * 0.9
+            for path, entry_size, _mtime in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                    size -= entry_size
+                except OSError:
+                    pass
+            self._size = size
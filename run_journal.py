@@ -0,0 +1,219 @@
+import csv
+import hashlib
+import io
+import sqlite3
+import threading
+import time
+import uuid
+
+import heartbeats
+from heartbeats import HEARTBEAT_SECONDS, STALE_SECONDS, Heartbeat, now_stamp
+
+# Run lifecycle: running -> done | failed | interrupted. A run that is not
+# done is resumed by the next run with the same key. A running run belongs to
+# the process that started it, which keeps its heartbeat fresh; one whose
+# heartbeat goes stale was cut off by that process dying and counts as interrupted.
+RUN_STATUSES = ("running", "done", "failed", "interrupted")
+
+# send_state of a row: queued (handed to the mail engine), sent or failed.
+# Rows without an email address have no send_state.
+SEND_STATES = ("queued", "sent", "failed")
+
+ERROR_REPORT_FIELDS = ("row", "emp_id", "name", "stage", "error")
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS runs (
+        id TEXT PRIMARY KEY,
+        run_key TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        owner TEXT,
+        heartbeat REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS runs_by_key ON runs (run_key, status)",
+    """
+    CREATE TABLE IF NOT EXISTS run_rows (
+        run_id TEXT NOT NULL,
+        row_index INTEGER NOT NULL,
+        emp_id TEXT,
+        name TEXT,
+        recipient TEXT,
+        render_state TEXT,
+        send_state TEXT,
+        error TEXT,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (run_id, row_index)
+    )
+    """,
+)
+
+
+def run_key(*parts):
+    """Key identifying a run by its inputs, e.g. the workbook bytes and the template digest."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RunJournal:
+    """SQLite record of every run's per-row render and send state, used to resume interrupted runs.
+
+    Runs are owned by this journal (one per process); while any of them is
+    open, a heartbeat thread keeps them fresh, and it stops when the last one
+    finishes or the journal is closed. Another
+    process's run is only taken over when its heartbeat is older than
+    stale_seconds, so opening the journal never disturbs a run in progress.
+    """
+
+    def __init__(self, db_path, owner=None, heartbeat_seconds=HEARTBEAT_SECONDS, stale_seconds=STALE_SECONDS):
+        self.db_path = db_path
+        self.owner = owner or heartbeats.owner_id()
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._active = set()
+        self._heartbeat = Heartbeat(self.heartbeat, heartbeat_seconds, name="journal-heartbeat")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return heartbeats.connect(self.db_path)
+
+    def start(self, key):
+        """Return a JournalRun for key, resuming the latest unfinished run with that key if there is one.
+
+        A run that is in progress, in this process or (going by its heartbeat)
+        any other, is never shared; a second run with the same key starts from scratch.
+        """
+        with self._lock, self._connect() as conn:
+            now = time.time()
+            stamp = now_stamp()
+            # Runs of other processes that stopped beating were cut off
+            heartbeats.expire_stale(
+                conn, "runs", "owner", self.owner, ("running",), self.stale_seconds,
+                {"status": "interrupted", "updated_at": stamp}, "run_key = ?", (key,)
+            )
+            row = conn.execute(
+                "SELECT id FROM runs WHERE run_key = ? AND status IN ('failed', 'interrupted') "
+                "ORDER BY updated_at DESC LIMIT 1",
+                (key,)
+            ).fetchone()
+            # Taken only if still unclaimed when written, so two processes cannot both resume it
+            resumed = row is not None and row[0] not in self._active and conn.execute(
+                "UPDATE runs SET status = 'running', owner = ?, heartbeat = ?, updated_at = ? "
+                "WHERE id = ? AND status IN ('failed', 'interrupted')",
+                (self.owner, now, stamp, row[0])
+            ).rowcount == 1
+            if resumed:
+                run_id = row[0]
+                rows = conn.execute(
+                    "SELECT row_index, render_state, send_state FROM run_rows WHERE run_id = ?", (run_id,)
+                ).fetchall()
+            else:
+                run_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO runs (id, run_key, status, created_at, updated_at, owner, heartbeat) "
+                    "VALUES (?, ?, 'running', ?, ?, ?, ?)",
+                    (run_id, key, stamp, stamp, self.owner, now)
+                )
+                rows = []
+            self._active.add(run_id)
+            # Beats only while this journal has a run open
+            self._heartbeat.start()
+        return JournalRun(self, run_id, resumed, {index: (render, send) for index, render, send in rows})
+
+    def heartbeat(self):
+        """Mark this journal's running runs as alive."""
+        with self._connect() as conn:
+            heartbeats.refresh(conn, "runs", "owner", self.owner, ("running",))
+
+    def _release(self, run_id):
+        with self._lock:
+            self._active.discard(run_id)
+            if not self._active:
+                self._heartbeat.stop()
+
+    def close(self):
+        """Stop the heartbeat thread. Runs still open stop being kept alive."""
+        with self._lock:
+            self._heartbeat.stop()
+
+
+class JournalRun:
+    """One run's rows in the journal. Every update is committed immediately (WAL keeps that cheap)."""
+
+    def __init__(self, journal, run_id, resumed, states):
+        self.journal = journal
+        self.id = run_id
+        self.resumed = resumed
+        self._states = states
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(journal.db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _write(self, sql, params):
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
+
+    def already_rendered(self, index):
+        """True if an earlier attempt of this run rendered the row."""
+        return self._states.get(index, (None, None))[0] == "done"
+
+    def already_sent(self, index):
+        """True if the row's email was delivered by an earlier attempt of this run."""
+        return self._states.get(index, (None, None))[1] == "sent"
+
+    def rendered(self, index, emp_id, name, error=None):
+        """Record the outcome of rendering a row; error marks it failed."""
+        self._write(
+            "INSERT INTO run_rows (run_id, row_index, emp_id, name, render_state, error, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (run_id, row_index) DO UPDATE SET "
+            "emp_id = excluded.emp_id, name = excluded.name, render_state = excluded.render_state, "
+            "error = excluded.error, updated_at = excluded.updated_at",
+            (self.id, index, emp_id, name, "failed" if error else "done", error, now_stamp())
+        )
+
+    def send_state(self, index, recipient, state, error=None):
+        """Record that a row's email was queued, sent or failed."""
+        if state not in SEND_STATES:
+            raise ValueError(f"Unknown send state: {state}")
+        self._write(
+            "UPDATE run_rows SET recipient = ?, send_state = ?, error = ?, updated_at = ? "
+            "WHERE run_id = ? AND row_index = ?",
+            (recipient, state, error, now_stamp(), self.id, index)
+        )
+
+    def finish(self, status):
+        """Set the run's final status and release it."""
+        if status not in RUN_STATUSES:
+            raise ValueError(f"Unknown run status: {status}")
+        try:
+            self._write("UPDATE runs SET status = ?, updated_at = ? WHERE id = ?", (status, now_stamp(), self.id))
+        finally:
+            self._conn.close()
+            self.journal._release(self.id)
+
+
+def error_report_csv(errors):
+    """Render error rows (dicts with ERROR_REPORT_FIELDS) as CSV text."""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=ERROR_REPORT_FIELDS)
+    writer.writeheader()
+    writer.writerows(errors)
+    return output.getvalue()
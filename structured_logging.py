@@ -0,0 +1,75 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+from metrics import Counter
+
+# Records waiting for the writer thread; beyond this they are dropped rather than blocking the caller
+LOG_QUEUE_SIZE = 10000
+
+LOG_RECORDS_DROPPED = Counter(
+    "appraisal_log_records_dropped_total", "Log records dropped because the log queue was full."
+)
+
+# Attributes every LogRecord has; anything else on a record came in through extra=
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: when the queue is full the record is counted and dropped."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def configure_logging(level="INFO", json_format=True, stream=None, queue_size=LOG_QUEUE_SIZE):
+    """Route the root logger through a bounded queue to a background thread that writes to stream.
+
+    Logging calls only format the message and enqueue it; the (possibly slow)
+    write to stderr happens on the listener thread. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(queue_size)
+    root = logging.getLogger()
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(_listener.stop)
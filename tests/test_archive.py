@@ -0,0 +1,117 @@
+import io
+import os
+import zipfile
+import zlib
+
+import pytest
+
+import archive
+from archive import ParallelZipWriter, ShardedZipWriter, parse_compression
+
+
+def _letters(count, size=2000):
+    """Distinct, compressible payloads that look a little like PDF bytes."""
+    return [(f"letter_{i:06d}.pdf", (b"%PDF-1.7 " + str(i).encode() * 50) * (size // 100)) for i in range(count)]
+
+
+def _check(path_or_file, expected):
+    """The archive reads back with zipfile: same names in order, CRCs and contents."""
+    with zipfile.ZipFile(path_or_file) as zf:
+        assert zf.testzip() is None
+        infos = zf.infolist()
+        assert [info.filename for info in infos] == [name for name, _data in expected]
+        for info, (_name, data) in zip(infos, expected):
+            assert info.file_size == len(data)
+            assert info.CRC == zlib.crc32(data)
+            assert zf.read(info) == data
+
+
+@pytest.mark.parametrize("compression", ["stored", "deflate", "deflate:1", "deflate:9"])
+@pytest.mark.parametrize("workers", [1, 4])
+def test_round_trip(tmp_path, compression, workers):
+    letters = _letters(50)
+    path = tmp_path / "letters.zip"
+    with ParallelZipWriter(path, compression, workers) as zipf:
+        for name, data in letters:
+            zipf.writestr(name, data)
+    _check(path, letters)
+
+
+def test_compression_workers_keep_submission_order(tmp_path):
+    # A small window forces writes to wait on the thread pool; sizes vary so entries finish out of order
+    letters = [(f"{i}.pdf", os.urandom(37 * (i % 7)) + b"x" * (50000 * (i % 5))) for i in range(200)]
+    path = tmp_path / "letters.zip"
+    with ParallelZipWriter(path, "deflate:6", workers=8, max_pending=3) as zipf:
+        for name, data in letters:
+            zipf.writestr(name, data)
+    with zipfile.ZipFile(path) as zf:
+        assert all(info.compress_type == zipfile.ZIP_DEFLATED for info in zf.infolist())
+    _check(path, letters)
+
+
+def test_write_to_file_object_and_from_disk(tmp_path):
+    source = tmp_path / "source.pdf"
+    source.write_bytes(b"%PDF-1.7 on disk")
+    buffer = io.BytesIO()
+    with ParallelZipWriter(buffer, "deflate", workers=2) as zipf:
+        zipf.write(str(source))
+        zipf.writestr("notes/ünïcode.txt", "text is written as UTF-8")
+    buffer.seek(0)
+    _check(buffer, [("source.pdf", b"%PDF-1.7 on disk"), ("notes/ünïcode.txt", "text is written as UTF-8".encode())])
+
+
+def test_more_than_65535_entries(tmp_path):
+    letters = [(f"{i}.pdf", str(i).encode()) for i in range(70000)]
+    path = tmp_path / "many.zip"
+    with ParallelZipWriter(path) as zipf:
+        for name, data in letters:
+            zipf.writestr(name, data)
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+        assert len(infos) == len(letters)
+        # Spot-check the ends and the entries either side of the classic limit
+        for position in (0, 65534, 65535, 65536, len(letters) - 1):
+            name, data = letters[position]
+            assert infos[position].filename == name
+            assert infos[position].CRC == zlib.crc32(data)
+            assert zf.read(infos[position]) == data
+
+
+@pytest.mark.parametrize("compression", ["stored", "deflate"])
+def test_zip64_sizes_and_offsets(tmp_path, monkeypatch, compression):
+    # Entries and offsets past a lowered limit take the same ZIP64 path as past 4 GiB, without writing 4 GiB
+    monkeypatch.setattr(archive, "_ZIP64_LIMIT", 10000)
+    monkeypatch.setattr(archive, "_ZIP64_COUNT_LIMIT", 5)
+    # Random bytes do not deflate, so compressed sizes pass the limit too
+    letters = [("small.pdf", b"tiny"), *((f"big_{i}.pdf", os.urandom(30000)) for i in range(8)), ("last.pdf", b"after the limit")]
+    path = tmp_path / "zip64.zip"
+    with ParallelZipWriter(path, compression, workers=4) as zipf:
+        for name, data in letters:
+            zipf.writestr(name, data)
+    _check(path, letters)
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+        # Sizes and offsets past the limit were only readable from the ZIP64 fields
+        assert all(info.compress_size >= 10000 for info in infos[1:-1])
+        assert infos[-1].header_offset >= 10000
+
+
+def test_parse_compression():
+    assert parse_compression("stored") == (archive.ZIP_STORED, None)
+    assert parse_compression("deflate") == (archive.ZIP_DEFLATED, archive.DEFAULT_DEFLATE_LEVEL)
+    assert parse_compression("deflate:9") == (archive.ZIP_DEFLATED, 9)
+    for spec in ("bzip2", "stored:1", "deflate:10"):
+        with pytest.raises(ValueError):
+            parse_compression(spec)
+
+
+def test_sharded_writer_splits_by_count_and_group(tmp_path):
+    letters = _letters(10, size=500)
+    with ShardedZipWriter(str(tmp_path), "letters", "deflate", workers=2, max_entries=3) as writer:
+        names = [writer.writestr(name, data, group="Sales" if i % 2 else "HR") for i, (name, data) in enumerate(letters)]
+    assert names[:2] == ["letters_HR_001.zip", "letters_Sales_001.zip"]
+    assert sorted(os.path.basename(path) for path in writer.paths) == [
+        "letters_HR_001.zip", "letters_HR_002.zip", "letters_Sales_001.zip", "letters_Sales_002.zip"
+    ]
+    for shard in set(names):
+        _check(tmp_path / shard, [letter for letter, name in zip(letters, names) if name == shard])
@@ -0,0 +1,38 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+app = pytest.importorskip("app")
+
+# Blanks, strings, zero, negatives, and amounts either side of one lakh (1e5)
+# and one crore (1e7), with paise that round either way
+VALUES = [
+    None, np.nan, "", " ", "nan", "NA", "n/a", "abc", "inf",
+    0, 0.0, "0", "0.00", -0.0,
+    0.004, 0.005, 7, 999.994, 999.995, 1000, 12345.6,
+    99999.99, 99999.995, 100000, 100000.01, 123456.785,
+    9999999.99, 9999999.995, 10000000, 12345678.905, 1e12 + 0.01,
+    -5, -0.5, -999.99, -1234.5, -123456.78, -12345678.9,
+    "1,23,456.78", " 2500.5 ", "-1,234.50", "1e5",
+]
+
+NUMBERS = [value for value in VALUES if value is None or isinstance(value, (int, float))]
+
+
+@pytest.mark.parametrize("value", VALUES, ids=repr)
+def test_object_column_matches_scalar(value):
+    column = pd.Series([value], dtype=object)
+    assert app.format_indian_currency_column(column).tolist() == [app.format_indian_currency(value)]
+
+
+@pytest.mark.parametrize("value", NUMBERS, ids=repr)
+def test_numeric_column_matches_scalar(value):
+    column = pd.Series([value], dtype=float)
+    assert app.format_indian_currency_column(column).tolist() == [app.format_indian_currency(column.iloc[0])]
+
+
+def test_mixed_column_keeps_order_and_index():
+    column = pd.Series(VALUES, dtype=object, index=range(100, 100 + len(VALUES)))
+    formatted = app.format_indian_currency_column(column)
+    assert formatted.index.equals(column.index)
+    assert formatted.tolist() == [app.format_indian_currency(value) for value in VALUES]
@@ -0,0 +1,66 @@
+import time
+
+from run_journal import RunJournal
+
+
+def _journal(tmp_path, **options):
+    return RunJournal(str(tmp_path / "runs.sqlite3"), **options)
+
+
+def test_resumed_run_reads_back_each_row_state(tmp_path):
+    journal = _journal(tmp_path)
+    run = journal.start("key")
+    assert not run.resumed
+    run.rendered(0, "AW0", "Sent")
+    run.send_state(0, "sent@example.com", "sent")
+    run.rendered(1, "AW1", "Queued")
+    run.send_state(1, "queued@example.com", "queued")
+    run.rendered(2, "AW2", "Broken", error="ValueError: bad row")
+    run.finish("interrupted")
+
+    resumed = journal.start("key")
+    assert resumed.resumed and resumed.id == run.id
+    assert [resumed.already_rendered(index) for index in range(4)] == [True, True, False, False]
+    assert [resumed.already_sent(index) for index in range(4)] == [True, False, False, False]
+    resumed.finish("done")
+
+    # A finished run is not resumed again
+    assert not journal.start("key").resumed
+
+
+def test_running_run_is_only_taken_over_once_its_heartbeat_is_stale(tmp_path):
+    first = _journal(tmp_path, heartbeat_seconds=0.05, stale_seconds=0.3)
+    second = _journal(tmp_path, heartbeat_seconds=0.05, stale_seconds=0.3)
+    run = first.start("key")
+    run.rendered(0, "AW0", "Employee")
+
+    # Still beating: the second journal starts its own run
+    time.sleep(0.4)
+    other = second.start("key")
+    assert not other.resumed
+    other.finish("done")
+
+    # The first process stops beating without finishing its run
+    first.close()
+    time.sleep(0.4)
+    taken = second.start("key")
+    assert taken.resumed and taken.id == run.id
+    assert taken.already_rendered(0)
+    taken.finish("done")
+
+
+def test_heartbeat_runs_only_while_a_run_is_open(tmp_path):
+    journal = _journal(tmp_path, heartbeat_seconds=0.05)
+    assert not journal._heartbeat.running
+    first = journal.start("one")
+    second = journal.start("two")
+    assert journal._heartbeat.running
+    first.finish("done")
+    assert journal._heartbeat.running
+    second.finish("failed")
+    assert not journal._heartbeat.running
+
+    journal.start("three")
+    assert journal._heartbeat.running
+    journal.close()
+    assert not journal._heartbeat.running
@@ -0,0 +1,94 @@
+import concurrent.futures
+import os
+import zipfile
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+app = pytest.importorskip("app")
+
+from mail_delivery import DeliveryResult  # noqa: E402
+from run_journal import RunJournal  # noqa: E402
+
+
+class Crash(BaseException):
+    """Stops a run the way a killed process would: no except clause of the run handles it."""
+
+
+class FakeEngine:
+    """Delivers every email at once, recording its recipient."""
+
+    def __init__(self, sent):
+        self.sent = sent
+        self.results = []
+        self.pending = 0
+
+    def submit(self, recipient, msg):
+        self.sent.append(recipient)
+        result = DeliveryResult(recipient, True, None)
+        self.results.append(result)
+        future = concurrent.futures.Future()
+        future.set_result(result)
+        return future
+
+    def close(self):
+        return self.results
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Patch out PyMuPDF and SMTP; returns a function running write_employee_zip into a ZIP and the rendered/sent logs."""
+    rendered, sent = [], []
+    crash_at = {}
+
+    def render(record, template, docs_folder, *args):
+        if record.index == crash_at.get("index"):
+            raise Crash()
+        rendered.append(record.index)
+        return f"letter {record.emp_id}".encode(), f"{record.file_name}.pdf"
+
+    class Template:
+        digest = "template"
+
+    monkeypatch.setattr(app, "load_template", lambda *args, **kwargs: Template())
+    monkeypatch.setattr(app, "render_prepared_record", render)
+    monkeypatch.setattr(app, "create_email_engine", lambda progress=None: FakeEngine(sent))
+    monkeypatch.setattr(app, "RUN_LETTERS_DIR", str(tmp_path / "run_letters"))
+    journal = RunJournal(str(tmp_path / "runs.sqlite3"))
+    monkeypatch.setattr(app, "_run_journal", journal)
+
+    rows = pd.DataFrame({
+        "Emp ID": [f"AW{i}" for i in range(10)],
+        "Name": [f"Employee {i}" for i in range(10)],
+        "Email Id": [f"employee{i}@example.com" for i in range(10)],
+    })
+    options = app.RenderOptions(workers=1, use_cache=False, in_memory=True)
+
+    def write(zip_name, crash_index=None):
+        crash_at["index"] = crash_index
+        zip_path = str(tmp_path / zip_name)
+        for _ in app.write_employee_zip(zip_path, rows, "template.pdf", str(tmp_path), options, resume_key="run"):
+            pass
+        return zip_path
+
+    yield write, rendered, sent
+    journal.close()
+
+
+def test_resumed_run_renders_and_sends_each_row_once(tmp_path, run):
+    write, rendered, sent = run
+
+    with pytest.raises(Crash):
+        write("first.zip", crash_index=6)
+    assert rendered == list(range(6))
+    assert os.listdir(tmp_path / "run_letters")
+
+    zip_path = write("second.zip")
+
+    assert sorted(rendered) == list(range(10))
+    assert sorted(sent) == sorted(f"employee{i}@example.com" for i in range(10))
+    with zipfile.ZipFile(zip_path) as archive:
+        letters = {name: archive.read(name) for name in archive.namelist()}
+    assert letters == {f"AW{i}_Employee_{i}.pdf": f"letter AW{i}".encode() for i in range(10)}
+    # The run is done, so its letters are no longer kept
+    assert not os.listdir(tmp_path / "run_letters")
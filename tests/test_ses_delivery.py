@@ -0,0 +1,161 @@
+import logging
+import queue
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("pandas")
+from botocore.exceptions import ClientError  # noqa: E402
+
+import inc_with_mail  # noqa: E402
+from mail_delivery import TokenBucket  # noqa: E402
+
+
+class StubSES:
+    """Stands in for the SES client: records every send, throttling or rejecting the recipients it is told to."""
+
+    def __init__(self, max_send_rate=10.0, throttle=None, reject=()):
+        self.max_send_rate = max_send_rate
+        # recipient -> how many more sends of theirs are throttled
+        self.throttle = dict(throttle or {})
+        self.reject = set(reject)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get_send_quota(self):
+        return {"Max24HourSend": 50000.0, "MaxSendRate": self.max_send_rate, "SentLast24Hours": 0.0}
+
+    def send_raw_email(self, Source, Destinations, RawMessage):
+        [recipient] = Destinations
+        with self._lock:
+            self.calls.append((time.monotonic(), recipient))
+            if self.throttle.get(recipient, 0) > 0:
+                self.throttle[recipient] -= 1
+                raise ClientError({"Error": {"Code": "Throttling", "Message": "Maximum sending rate exceeded."}}, "SendRawEmail")
+            if recipient in self.reject:
+                raise ClientError({"Error": {"Code": "MessageRejected", "Message": "Email address is not verified."}}, "SendRawEmail")
+            return {"MessageId": f"id-{len(self.calls)}"}
+
+    def sent(self, recipient):
+        return sum(1 for _when, to in self.calls if to == recipient)
+
+
+def _deliver(ses, messages, rate, workers=2, **options):
+    """Send messages through send_email_worker threads and return their DeliveryResults."""
+    email_queue = queue.Queue()
+    results = []
+    limiter = TokenBucket(rate)
+    threads = [
+        threading.Thread(target=inc_with_mail.send_email_worker, args=(email_queue, "hr@example.com", ses, limiter, results), kwargs=options)
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for recipient in messages:
+        email_queue.put((recipient, "Appraisal Letter", "Dear employee", (f"{recipient}.pdf", b"%PDF-1.7")))
+    for _ in threads:
+        email_queue.put(None)
+    for thread in threads:
+        thread.join()
+    return {result.recipient: result for result in results}
+
+
+def test_sends_stay_under_the_rate_limit():
+    ses = StubSES()
+    recipients = [f"employee{i}@example.com" for i in range(12)]
+    results = _deliver(ses, recipients, rate=5, workers=4)
+
+    assert sorted(results) == sorted(recipients)
+    assert all(result.ok and result.message_id for result in results.values())
+    # A burst of 5 (one second's worth of tokens), then no faster than 5 per second however many workers send
+    times = sorted(when for when, _recipient in ses.calls)
+    for position in range(5, len(times)):
+        assert times[position] - times[0] >= (position - 4) / 5 * 0.95
+
+
+def test_throttled_message_is_retried(monkeypatch):
+    monkeypatch.setattr(inc_with_mail, "THROTTLE_BACKOFF_SECONDS", 0.01)
+    ses = StubSES(throttle={"busy@example.com": 2, "stuck@example.com": 10})
+    results = _deliver(ses, ["busy@example.com", "stuck@example.com", "ok@example.com"], rate=100, max_retries=3)
+
+    # Throttled twice, then delivered on the third try
+    assert results["busy@example.com"].ok
+    assert ses.sent("busy@example.com") == 3
+    # Still throttled after every retry: reported as failed with SES's message
+    assert not results["stuck@example.com"].ok
+    assert results["stuck@example.com"].error == "Maximum sending rate exceeded."
+    assert ses.sent("stuck@example.com") == 4
+    assert results["ok@example.com"].ok
+    assert ses.sent("ok@example.com") == 1
+
+
+def test_rejected_message_is_reported_without_retry():
+    ses = StubSES(reject={"unverified@example.com"})
+    results = _deliver(ses, ["unverified@example.com", "ok@example.com"], rate=100)
+    assert not results["unverified@example.com"].ok
+    assert results["unverified@example.com"].error == "Email address is not verified."
+    assert ses.sent("unverified@example.com") == 1
+    assert results["ok@example.com"].message_id
+
+
+def _workbook(path, rows):
+    openpyxl = pytest.importorskip("openpyxl")
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Emp ID", "Name", "Email Id"])
+    for row in rows:
+        sheet.append(list(row))
+    workbook.save(path)
+    return str(path)
+
+
+@pytest.fixture
+def fake_render(monkeypatch):
+    """Skip PyMuPDF: the template is not compiled and each letter is a few bytes naming its employee."""
+    monkeypatch.setattr(inc_with_mail, "load_template", lambda *args, **kwargs: None)
+    monkeypatch.setattr(
+        inc_with_mail, "render_letter_bytes", lambda template, replacements, *args: f"%PDF {replacements['[Employee ID]']}".encode()
+    )
+
+
+def _emails_done(caplog):
+    [record] = [record for record in caplog.records if getattr(record, "event", None) == "emails_done"]
+    return record
+
+
+def test_merge_sends_through_the_injected_client(tmp_path, caplog, fake_render):
+    rows = [(f"AW{i}", f"Employee {i}", f"employee{i}@example.com") for i in range(5)]
+    rows.append(("AW9", "Unverified", "unverified@example.com"))
+    excel = _workbook(tmp_path / "employees.xlsx", rows)
+    ses = StubSES(max_send_rate=50, reject={"unverified@example.com"})
+
+    with caplog.at_level(logging.INFO, logger=inc_with_mail.__name__):
+        inc_with_mail.merge_employee_data_and_zip(
+            excel, "template.pdf", str(tmp_path / "out"), sender_email="hr@example.com", aws_region="us-east-1", ses_client=ses
+        )
+
+    assert sorted(recipient for _when, recipient in ses.calls) == sorted(email for _id, _name, email in rows)
+    assert _emails_done(caplog).failed_recipients == {"unverified@example.com": "Email address is not verified."}
+
+
+def test_render_error_still_delivers_and_reports_queued_emails(tmp_path, caplog, monkeypatch, fake_render):
+    rows = [(f"AW{i}", f"Employee {i}", f"employee{i}@example.com") for i in range(5)]
+    excel = _workbook(tmp_path / "employees.xlsx", rows)
+    ses = StubSES(max_send_rate=50)
+
+    def render(template, replacements, *args):
+        if replacements["[Employee ID]"] == "AW3":
+            raise RuntimeError("broken letter")
+        return b"%PDF"
+    monkeypatch.setattr(inc_with_mail, "render_letter_bytes", render)
+
+    with caplog.at_level(logging.INFO, logger=inc_with_mail.__name__), pytest.raises(RuntimeError, match="broken letter"):
+        inc_with_mail.merge_employee_data_and_zip(
+            excel, "template.pdf", str(tmp_path / "out"), sender_email="hr@example.com", aws_region="us-east-1", ses_client=ses
+        )
+
+    # The letters rendered before the error were all sent, and their results reported
+    assert sorted(recipient for _when, recipient in ses.calls) == [f"employee{i}@example.com" for i in range(3)]
+    assert _emails_done(caplog).failed_recipients == {}
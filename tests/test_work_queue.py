@@ -0,0 +1,124 @@
+import threading
+import time
+
+from work_queue import WorkQueue
+
+
+def _queue(tmp_path, **options):
+    return WorkQueue(str(tmp_path / "queue.sqlite3"), **options)
+
+
+def test_competing_workers_lease_each_task_once(tmp_path):
+    db_path = str(tmp_path / "queue.sqlite3")
+    run_id = WorkQueue(db_path).create_run({"rows_total": 40}, [{"start": i} for i in range(40)])
+    # Two independent queues, as two processes would have, each with several claiming threads
+    queues = [WorkQueue(db_path), WorkQueue(db_path)]
+    claimed = []
+    claimed_lock = threading.Lock()
+    start = threading.Barrier(8)
+
+    def claim_all(queue, worker):
+        start.wait()
+        while True:
+            task = queue.claim(worker, run_id)
+            if task is None:
+                return
+            with claimed_lock:
+                claimed.append(task.id)
+            assert queue.complete(task, worker, {"by": worker})
+
+    threads = [
+        threading.Thread(target=claim_all, args=(queues[i % 2], f"worker-{i}")) for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(set(claimed))
+    assert len(claimed) == 40
+    assert queues[0].progress(run_id) == {"pending": 0, "leased": 0, "done": 40, "failed": 0}
+
+
+def test_expired_lease_is_reclaimed_and_the_old_worker_cannot_complete(tmp_path):
+    first = _queue(tmp_path, lease_seconds=0.05)
+    second = _queue(tmp_path, lease_seconds=0.05)
+    run_id = first.create_run({}, [{"start": 0}])
+
+    task = first.claim("a", run_id)
+    assert task.attempts == 1
+    # Still leased: nothing for another worker
+    assert second.claim("b", run_id) is None
+
+    time.sleep(0.1)
+    retry = second.claim("b", run_id)
+    assert retry.id == task.id
+    assert retry.attempts == 2
+
+    # The worker presumed dead can no longer heartbeat, complete or fail the task
+    assert not first.heartbeat(task, "a")
+    assert not first.complete(task, "a", {"by": "a"})
+    assert not first.fail(task, "a", "late failure")
+    assert second.complete(retry, "b", {"by": "b"})
+
+    [(_task, state, result, error)] = first.tasks(run_id)
+    assert (state, result, error) == ("done", {"by": "b"}, None)
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    # Held well past lease_seconds, renewed in time
+    queue = _queue(tmp_path, lease_seconds=0.3)
+    run_id = queue.create_run({}, [{"start": 0}])
+    task = queue.claim("a", run_id)
+    for _ in range(6):
+        time.sleep(0.1)
+        assert queue.heartbeat(task, "a")
+    assert queue.claim("b", run_id) is None
+    assert queue.complete(task, "a", {})
+
+
+def test_double_completion_keeps_the_first_result(tmp_path):
+    queue = _queue(tmp_path)
+    run_id = queue.create_run({}, [{"start": 0}])
+    task = queue.claim("a", run_id)
+    assert queue.complete(task, "a", {"archive": "first.zip"})
+    assert not queue.complete(task, "a", {"archive": "second.zip"})
+    [(_task, state, result, _error)] = queue.tasks(run_id)
+    assert (state, result) == ("done", {"archive": "first.zip"})
+
+
+def test_failed_task_is_retried_until_max_attempts(tmp_path):
+    queue = _queue(tmp_path, max_attempts=2)
+    run_id = queue.create_run({}, [{"start": 0}])
+
+    assert queue.fail(queue.claim("a", run_id), "a", "first")
+    assert queue.progress(run_id)["pending"] == 1
+    task = queue.claim("b", run_id)
+    assert task.attempts == 2
+    assert queue.fail(task, "b", "second")
+
+    assert queue.claim("c", run_id) is None
+    [(_task, state, _result, error)] = queue.tasks(run_id)
+    assert (state, error) == ("failed", "second")
+
+
+def test_expired_lease_on_the_last_attempt_fails_the_task(tmp_path):
+    queue = _queue(tmp_path, lease_seconds=0.05, max_attempts=1)
+    run_id = queue.create_run({}, [{"start": 0}])
+    queue.claim("a", run_id)
+    time.sleep(0.1)
+    assert queue.progress(run_id) == {"pending": 0, "leased": 0, "done": 0, "failed": 1}
+    [(_task, _state, _result, error)] = queue.tasks(run_id)
+    assert error == "Worker stopped responding"
+
+
+def test_claims_are_limited_to_the_run_asked_for(tmp_path):
+    queue = _queue(tmp_path)
+    first_run = queue.create_run({"name": "first"}, [{"start": 0}])
+    second_run = queue.create_run({"name": "second"}, [{"start": 0}])
+    assert queue.run_params(second_run) == {"name": "second"}
+
+    task = queue.claim("a", second_run)
+    assert task.run_id == second_run
+    assert queue.claim("a", second_run) is None
+    assert queue.claim("a").run_id == first_run
@@ -0,0 +1,196 @@
+import collections
+import contextlib
+import datetime
+import json
+import sqlite3
+import time
+import uuid
+
+# Task lifecycle: pending -> leased -> done | failed. A leased task whose lease
+# runs out (its worker died or hung) goes back to pending, until it has been
+# attempted max_attempts times and is failed instead.
+TASK_STATES = ("pending", "leased", "done", "failed")
+
+# How long a claimed task belongs to its worker without a heartbeat
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS queue_runs (
+        id TEXT PRIMARY KEY,
+        params TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_owner TEXT,
+        lease_expires REAL,
+        result TEXT,
+        error TEXT,
+        updated_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, run_id)",
+)
+
+# A claimed task; attempts counts this attempt
+Task = collections.namedtuple("Task", ["id", "run_id", "payload", "attempts"])
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class WorkQueue:
+    """Durable SQLite queue of tasks that any number of worker processes lease, run and report on.
+
+    A run is a set of tasks sharing parameters (both JSON). claim() leases the
+    oldest pending task to a worker for lease_seconds, which the worker extends
+    with heartbeat() while it works; complete() and fail() only take effect
+    while the worker still holds the lease, so a worker that was presumed dead
+    cannot overwrite the attempt that replaced it. Expired leases are recovered
+    by claim() and progress(). Every call uses its own connection and an
+    immediate transaction, so processes on the same host can share the database.
+    """
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Open a connection inside a write transaction that commits on success and is always closed."""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            # Take the write lock up front so two workers cannot claim the same task
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def create_run(self, params, payloads):
+        """Store a run's parameters and one pending task per payload, and return the run ID."""
+        run_id = uuid.uuid4().hex
+        now = _now()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO queue_runs (id, params, created_at) VALUES (?, ?, ?)", (run_id, json.dumps(params), now)
+            )
+            conn.executemany(
+                "INSERT INTO tasks (run_id, payload, state, updated_at) VALUES (?, ?, 'pending', ?)",
+                [(run_id, json.dumps(payload), now) for payload in payloads]
+            )
+        return run_id
+
+    def run_params(self, run_id):
+        """Return the parameters a run was created with."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT params FROM queue_runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown queue run: {run_id}")
+        return json.loads(row[0])
+
+    def _expire_leases(self, conn):
+        now = time.time()
+        conn.execute(
+            "UPDATE tasks SET state = 'failed', lease_owner = NULL, updated_at = ?, "
+            "error = COALESCE(error, 'Worker stopped responding') "
+            "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (_now(), now, self.max_attempts)
+        )
+        conn.execute(
+            "UPDATE tasks SET state = 'pending', lease_owner = NULL, updated_at = ? "
+            "WHERE state = 'leased' AND lease_expires < ?",
+            (_now(), now)
+        )
+
+    def claim(self, worker, run_id=None):
+        """Lease the oldest pending task, of run_id if given, to worker. None when nothing is pending."""
+        with self._connect() as conn:
+            self._expire_leases(conn)
+            if run_id is None:
+                row = conn.execute(
+                    "SELECT id, run_id, payload, attempts FROM tasks WHERE state = 'pending' ORDER BY id LIMIT 1"
+                ).fetchone()
+            else:
+                row = conn.execute(
+                    "SELECT id, run_id, payload, attempts FROM tasks WHERE state = 'pending' AND run_id = ? "
+                    "ORDER BY id LIMIT 1",
+                    (run_id,)
+                ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET state = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, "
+                "updated_at = ? WHERE id = ?",
+                (worker, time.time() + self.lease_seconds, _now(), row[0])
+            )
+        return Task(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+    def _update_leased(self, task, worker, assignments, params):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE tasks SET {assignments}, updated_at = ? WHERE id = ? AND state = 'leased' AND lease_owner = ?",
+                (*params, _now(), task.id, worker)
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, task, worker):
+        """Extend worker's lease on task. False if the lease was lost."""
+        return self._update_leased(task, worker, "lease_expires = ?", (time.time() + self.lease_seconds,))
+
+    def complete(self, task, worker, result):
+        """Record the result of task. False, recording nothing, if worker no longer holds the lease."""
+        return self._update_leased(
+            task, worker, "state = 'done', result = ?, error = NULL, lease_owner = NULL", (json.dumps(result),)
+        )
+
+    def fail(self, task, worker, error):
+        """Give up this attempt at task: it is retried, or failed once it has had max_attempts."""
+        return self._update_leased(
+            task, worker,
+            "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, lease_owner = NULL",
+            (self.max_attempts, error)
+        )
+
+    def progress(self, run_id):
+        """Return the number of tasks of a run in each state, recovering expired leases first."""
+        with self._connect() as conn:
+            self._expire_leases(conn)
+            rows = conn.execute("SELECT state, COUNT(*) FROM tasks WHERE run_id = ? GROUP BY state", (run_id,)).fetchall()
+        counts = dict.fromkeys(TASK_STATES, 0)
+        counts.update(rows)
+        return counts
+
+    def tasks(self, run_id):
+        """Return every task of a run in creation order, as (Task, state, result, error)."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, run_id, payload, attempts, state, result, error FROM tasks WHERE run_id = ? ORDER BY id",
+                (run_id,)
+            ).fetchall()
+        return [
+            (Task(task_id, run, json.loads(payload), attempts), state, json.loads(result) if result else None, error)
+            for task_id, run, payload, attempts, state, result, error in rows
+        ]
@@ -0,0 +1,127 @@
+import os
+
+import openpyxl
+import pandas as pd
+
+# Rows per DataFrame handed to the rendering pipeline
+CHUNK_SIZE = 1000
+
+# Sheet row (numbered as in Excel) of the header; data starts on the next row
+HEADER_ROW = 1
+
+
+def _cell_value(value):
+    """Mirror pandas.read_excel: integral floats come back as int."""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class WorkbookReader:
+    """Stream the first worksheet of a workbook as DataFrame chunks.
+
+    .xlsx/.xlsm files are read with openpyxl in read-only mode, so memory use
+    stays flat however many rows the sheet has. Other formats (.xls) fall back
+    to pandas.read_excel and are sliced into chunks.
+
+    The header row is read once and resolved against expected_columns: a
+    header that only differs in surrounding whitespace or case is renamed to
+    the expected name, and expected columns that are still absent are listed
+    in missing_columns.
+
+    Every chunk is indexed by sheet row number, as Excel shows it, so rows
+    can be reported in terms the person fixing the sheet can find. Blank
+    rows are skipped but still counted. pandas drops blank rows of .xls
+    files before they get here, so there the numbers are only exact for
+    sheets without blank rows.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE, expected_columns=()):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._workbook = None
+        self._sheet = None
+        self._rows = None
+        self._df = None
+
+        if os.path.splitext(path)[1].lower() in ('.xlsx', '.xlsm'):
+            self._workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+            sheet = self._sheet = self._workbook.worksheets[0]
+            self._rows = sheet.iter_rows(values_only=True)
+            header = next(self._rows, ())
+            # Read-only sheets report the stored dimension, which may be missing or include blank rows
+            self.row_estimate = max((sheet.max_row or 1) - 1, 0)
+        else:
+            self._df = pd.read_excel(path)
+            header = list(self._df.columns)
+            self.row_estimate = len(self._df)
+
+        self.columns = self._resolve_header(header, expected_columns)
+        self.missing_columns = [column for column in expected_columns if column not in self.columns]
+        if self._df is not None:
+            self._df.columns = self.columns
+
+    @staticmethod
+    def _resolve_header(header, expected_columns):
+        expected = {str(column).strip().lower(): column for column in expected_columns}
+        columns = []
+        for position, name in enumerate(header):
+            if name is None:
+                columns.append(f"Unnamed: {position}")
+                continue
+            columns.append(expected.get(str(name).strip().lower(), name))
+        return columns
+
+    def chunks(self, min_row=None, max_row=None, start=0):
+        """Yield (start, DataFrame) pairs, start being the position of the chunk's first row.
+
+        Positions count the non-blank rows only; the DataFrame index holds their sheet row numbers.
+        min_row and max_row limit the read to those sheet rows (inclusive), without
+        reading the rows before them into DataFrames; start is then the position of
+        the first non-blank row from min_row on, as an earlier full read found it.
+        """
+        first_row = HEADER_ROW + 1 if min_row is None else min_row
+        if self._df is not None:
+            # pandas has already dropped the blank rows, so position and sheet row are a fixed offset apart
+            first = first_row - HEADER_ROW - 1
+            last = len(self._df) if max_row is None else min(len(self._df), max_row - HEADER_ROW)
+            for offset in range(first, last, self.chunk_size):
+                chunk = self._df.iloc[offset:min(offset + self.chunk_size, last)]
+                yield start, chunk.set_axis(pd.RangeIndex(HEADER_ROW + 1 + offset, HEADER_ROW + 1 + offset + len(chunk)))
+                start += len(chunk)
+            return
+
+        rows = self._rows
+        if min_row is not None or max_row is not None:
+            rows = self._sheet.iter_rows(min_row=first_row, max_row=max_row, values_only=True)
+
+        width = len(self.columns)
+        chunk = []
+        sheet_rows = []
+        # Read-only sheets fill in the rows missing from the file, so counting gives the sheet row
+        for sheet_row, row in enumerate(rows, first_row):
+            # Skip fully empty rows, including the trailing ones Excel often leaves behind
+            if all(value is None for value in row):
+                continue
+            values = [_cell_value(value) for value in row[:width]]
+            values.extend([None] * (width - len(values)))
+            chunk.append(values)
+            sheet_rows.append(sheet_row)
+            if len(chunk) >= self.chunk_size:
+                yield start, pd.DataFrame(chunk, columns=self.columns, index=sheet_rows)
+                start += len(chunk)
+                chunk = []
+                sheet_rows = []
+        if chunk:
+            yield start, pd.DataFrame(chunk, columns=self.columns, index=sheet_rows)
+
+    def close(self):
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()